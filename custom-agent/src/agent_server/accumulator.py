@@ -0,0 +1,104 @@
+import re
+from typing import Any, Callable, Optional
+
+# The characters that decide where a JSON value ends: escapes (with the escaped character when
+# it is in the same fragment), quotes and brackets
+_JSON_TOKENS = re.compile(r'\\.?|["{}\[\]]', re.DOTALL)
+
+
+class _ToolCallBuffer:
+    __slots__ = ("id", "name", "parts", "depth", "in_string", "escaped", "complete")
+
+    def __init__(self, id: Optional[str], name: Optional[str]):
+        self.id = id
+        self.name = name
+        self.parts: list[str] = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.complete = False
+
+    def scan(self, fragment: str) -> bool:
+        """Track JSON nesting across fragments; True on the fragment that closes the arguments"""
+        if self.complete:
+            return False
+        start = 0
+        if self.escaped:
+            self.escaped = False
+            start = 1
+        for match in _JSON_TOKENS.finditer(fragment, start):
+            token = match.group()
+            if self.in_string:
+                if token == '"':
+                    self.in_string = False
+                elif token == "\\":
+                    # The escaped character is in the next fragment
+                    self.escaped = True
+            elif token == '"':
+                self.in_string = True
+            elif token in "{[":
+                self.depth += 1
+            elif token in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.complete = True
+                    return True
+        return False
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "type": "function",
+            "function": {"name": self.name, "arguments": "".join(self.parts)},
+        }
+
+
+class StreamAccumulator:
+    """Assembles a streamed chat completion from openai `ChatCompletionChunk` objects.
+
+    Reads chunk attributes directly instead of converting every chunk to a dict, and collects
+    text and tool call argument fragments in lists that are joined once at the end. Tool call
+    fragments are grouped by their index, so any number of calls can stream interleaved.
+
+    If `on_tool_call` is set, it is called with each tool call as soon as its arguments form a
+    complete JSON object, while the rest of the response is still streaming. Calls whose
+    arguments never close (such as empty arguments) are only available from tool_calls().
+    """
+
+    def __init__(self, on_tool_call: Optional[Callable[[dict[str, Any]], None]] = None):
+        self.on_tool_call = on_tool_call
+        self.id: Optional[str] = None
+        self._text: list[str] = []
+        self._tool_calls: dict[int, _ToolCallBuffer] = {}
+
+    def add(self, chunk: Any) -> Optional[str]:
+        """Fold a chunk in and return its text delta, if it has one"""
+        self.id = chunk.id
+        if not chunk.choices:
+            return None
+        delta = chunk.choices[0].delta
+        if delta.tool_calls:
+            for fragment in delta.tool_calls:
+                buffer = self._tool_calls.get(fragment.index)
+                function = fragment.function
+                if buffer is None:
+                    buffer = self._tool_calls[fragment.index] = _ToolCallBuffer(
+                        fragment.id, function.name if function else None
+                    )
+                if function is not None and function.arguments:
+                    buffer.parts.append(function.arguments)
+                    if self.on_tool_call is not None and buffer.scan(function.arguments):
+                        self.on_tool_call(buffer.to_dict())
+            return None
+        content = delta.content
+        if content is not None:
+            self._text.append(content)
+        return content
+
+    @property
+    def text(self) -> str:
+        return "".join(self._text)
+
+    def tool_calls(self) -> list[dict[str, Any]]:
+        """The assembled tool calls in index order, in chat completions format"""
+        return [self._tool_calls[index].to_dict() for index in sorted(self._tool_calls)]
@@ -8,14 +8,18 @@ from langchain_core.messages import BaseMessage
 from langchain_core.runnables import RunnableLambda
 from mlflow.langchain.output_parsers import ChatCompletionOutputParser
 
+from agent_server.context import ContextWindow
 from agent_server.mlflow_config import setup_mlflow
-from agent_server.server import create_server, invoke, stream
+from agent_server.server import create_server, invoke, run_workers, server_workers, stream
 
 # Enable MLflow tracing
 mlflow.langchain.autolog()
 
 llm = ChatDatabricks(model="databricks-claude-sonnet-4")
 
+# Token budget for the prompt; older history is trimmed to fit (see ContextWindow)
+context_window = ContextWindow(max_tokens=100_000)
+
 # Define components
 prompt = ChatPromptTemplate.from_template(
     """Previous conversation:
@@ -27,10 +31,11 @@ User's question:
 
 # Chain definition
 chain = (
-    {
-        "question": itemgetter("messages")
-        | RunnableLambda(lambda messages: messages[-1]["content"]),
-        "chat_history": itemgetter("messages") | RunnableLambda(lambda messages: messages[:-1]),
+    itemgetter("messages")
+    | RunnableLambda(context_window.fit)
+    | {
+        "question": RunnableLambda(lambda messages: messages[-1]["content"]),
+        "chat_history": RunnableLambda(lambda messages: messages[:-1]),
     }
     | prompt
     | llm
@@ -53,11 +58,32 @@ async def stream(
         yield chunk
 
 
-def main():
-    server = create_server()
+def server_kwargs() -> dict:
+    """Options for create_server(), shared by main() and create_app() so that every worker
+    process serves the same configuration. Built per process, so stores and exporters with
+    their own connections or threads aren't shared across a fork."""
+    return {
+        # See AgentServer for the available options, e.g.
+        # "max_concurrent_invokes": 64,
+        # "trace_sampler": RatioTraceSampler(0.1),
+    }
+
+
+def create_app():
+    """App factory used by each worker process when serving with multiple workers."""
     setup_mlflow()
+    return create_server(**server_kwargs()).app
+
+
+def main():
     print("Single endpoint: POST /invocations")
+    if server_workers() > 1:
+        # Each worker process builds its own server with create_app()
+        run_workers("agent_server.agent:create_app")
+        return
 
+    server = create_server(**server_kwargs())
+    setup_mlflow()
     server.run()
 
 
@@ -0,0 +1,133 @@
+import json
+from typing import Any, Callable, Optional
+
+# Rough average for English text and JSON with BPE tokenizers; good enough for budgeting
+CHARS_PER_TOKEN = 4
+# Per-message framing (role, separators) added by chat templates
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """Fast local token estimate from the character count"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def estimate_message_tokens(message: dict[str, Any]) -> int:
+    """Token estimate for a chat completions message, including its tool calls"""
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += estimate_tokens(content)
+    elif content:
+        tokens += estimate_tokens(json.dumps(content))
+    for tool_call in message.get("tool_calls") or ():
+        function = tool_call.get("function") or {}
+        tokens += estimate_tokens(function.get("name") or "")
+        tokens += estimate_tokens(function.get("arguments") or "")
+    return tokens
+
+
+class ContextWindow:
+    """Keeps the chat completions messages sent to an LLM within a token budget.
+
+    `fit()` leaves the leading system messages and the current turn (the last user message and
+    everything after it) intact, and applies these strategies to the rest, oldest first, until
+    the estimate fits in `max_tokens - reserve_tokens`:
+
+    1. Truncate every tool output to `max_tool_output_tokens`, if set (current turn included).
+    2. Replace old tool outputs with a short placeholder (`drop_tool_outputs`).
+    3. Drop the oldest messages (sliding window). With a `summarize` hook, the dropped messages
+       are replaced by a system message holding the summary it returns; `summary_tokens` is
+       reserved for it. The hook runs on every LLM call that overflows, so make it cheap or
+       cache inside it.
+
+    The input list is never modified; messages that change are copied.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int,
+        reserve_tokens: int = 4096,
+        max_tool_output_tokens: Optional[int] = None,
+        drop_tool_outputs: bool = True,
+        tool_output_placeholder: str = "[tool output omitted to save context]",
+        summarize: Optional[Callable[[list[dict[str, Any]]], str]] = None,
+        summary_tokens: int = 1024,
+    ):
+        self.max_tokens = max_tokens
+        self.reserve_tokens = reserve_tokens
+        self.max_tool_output_tokens = max_tool_output_tokens
+        self.drop_tool_outputs = drop_tool_outputs
+        self.tool_output_placeholder = tool_output_placeholder
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+
+    def budget(self, tools: Optional[list[dict]] = None) -> int:
+        """Tokens available for messages once the completion and tool specs are accounted for"""
+        budget = self.max_tokens - self.reserve_tokens
+        if tools:
+            budget -= estimate_tokens(json.dumps(tools))
+        return budget
+
+    def _truncate_tool_output(self, message: dict[str, Any]) -> dict[str, Any]:
+        content = message.get("content")
+        max_chars = self.max_tool_output_tokens * CHARS_PER_TOKEN
+        if message.get("role") != "tool" or not isinstance(content, str):
+            return message
+        if len(content) <= max_chars:
+            return message
+        return {**message, "content": content[:max_chars] + "... [truncated]"}
+
+    def fit(
+        self, messages: list[dict[str, Any]], tools: Optional[list[dict]] = None
+    ) -> list[dict[str, Any]]:
+        """Return messages trimmed to the budget; the same list if it already fits"""
+        budget = self.budget(tools)
+        if self.max_tool_output_tokens is not None:
+            truncated = [self._truncate_tool_output(message) for message in messages]
+            if any(new is not old for new, old in zip(truncated, messages)):
+                messages = truncated
+        counts = [estimate_message_tokens(message) for message in messages]
+        total = sum(counts)
+        if total <= budget:
+            return messages
+
+        head = 0
+        while head < len(messages) and messages[head].get("role") == "system":
+            head += 1
+        tail = len(messages) - 1
+        while tail > head and messages[tail].get("role") != "user":
+            tail -= 1
+
+        messages = list(messages)
+        if self.drop_tool_outputs:
+            placeholder_tokens = MESSAGE_OVERHEAD_TOKENS + estimate_tokens(
+                self.tool_output_placeholder
+            )
+            for i in range(head, tail):
+                if total <= budget:
+                    return messages
+                if messages[i].get("role") == "tool" and counts[i] > placeholder_tokens:
+                    messages[i] = {**messages[i], "content": self.tool_output_placeholder}
+                    total += placeholder_tokens - counts[i]
+                    counts[i] = placeholder_tokens
+            if total <= budget:
+                return messages
+
+        if self.summarize is not None:
+            budget -= self.summary_tokens
+        cut = head
+        while cut < tail and total > budget:
+            total -= counts[cut]
+            cut += 1
+        # Tool results can't be sent without the assistant message that requested them
+        while cut < tail and messages[cut].get("role") == "tool":
+            cut += 1
+        dropped = messages[head:cut]
+        kept = messages[:head] + messages[cut:]
+        if dropped and self.summarize is not None:
+            summary = {"role": "system", "content": SUMMARY_PREFIX + self.summarize(dropped)}
+            kept.insert(head, summary)
+        return kept
@@ -1,33 +1,113 @@
+import asyncio
+import functools
 import inspect
-import json
+import itertools
 import logging
+import os
 import time
+from contextlib import asynccontextmanager
 from dataclasses import asdict, is_dataclass
-from typing import Any, Callable, Literal, Optional, Type
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Callable,
+    Literal,
+    Optional,
+    Sequence,
+    Type,
+    get_type_hints,
+)
 
-import mlflow
-import mlflow.tracing
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
-from mlflow.pyfunc import ResponsesAgent
+from fastapi.responses import Response, StreamingResponse
 from mlflow.tracing.trace_manager import InMemoryTraceManager
 from mlflow.types.responses import (
     ResponsesAgentRequest,
     ResponsesAgentResponse,
     ResponsesAgentStreamEvent,
 )
-from pydantic import BaseModel
+from mlflow.types.responses_helpers import (
+    ResponseCompletedEvent,
+    ResponseErrorEvent,
+    ResponseOutputItemDoneEvent,
+    ResponseTextAnnotationDeltaEvent,
+    ResponseTextDeltaEvent,
+)
+from pydantic import BaseModel, TypeAdapter
+
+from agent_server import serialization
+from agent_server.admission import AdmissionController, AdmissionRejected, AdmissionSlot
+from agent_server.cancellation import (
+    CLIENT_DISCONNECTED,
+    DEADLINE_EXCEEDED,
+    CancelToken,
+    RequestCancelled,
+    iterate_until_deadline,
+    set_current_token,
+)
+from agent_server.coalescing import RequestCoalescer
+from agent_server.completion_cache import completion_cache_stats
+from agent_server.executor import SyncExecutor
+from agent_server.metrics import CONTENT_TYPE, ServerMetrics
+from agent_server.sessions import SessionStore, SessionTurn, session_turn
+from agent_server.sse import SSEWriter, coalesce
+from agent_server.tools import tool_cache_stats
+from agent_server.tracing import (
+    PendingSpan,
+    RequestOutcome,
+    StreamOutputReducer,
+    TraceExporter,
+    TraceSampler,
+    start_deferred_span,
+)
 
 _invoke_function: Optional[Callable] = None
 _stream_function: Optional[Callable] = None
 
 
+def _is_same_handler(registered: Optional[Callable], func: Callable) -> bool:
+    """Whether func is a re-import of the already registered handler.
+
+    Worker processes (and reloads) can import the agent module more than once, e.g. once as
+    `__mp_main__` and once by its package name, so handlers are matched by definition site
+    rather than by identity.
+    """
+    if registered is None:
+        return False
+    registered_code = getattr(registered, "__code__", None)
+    func_code = getattr(func, "__code__", None)
+    return (
+        registered_code is not None
+        and func_code is not None
+        and registered.__qualname__ == func.__qualname__
+        and registered_code.co_filename == func_code.co_filename
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _request_type(func: Callable) -> Optional[Type[BaseModel]]:
+    """The pydantic class func's first parameter is annotated with, if any.
+
+    Agent functions annotated with the request model (e.g. `request: ResponsesAgentRequest`)
+    get the validated request object instead of the request dict.
+    """
+    try:
+        parameters = list(inspect.signature(func).parameters)
+        hint = get_type_hints(func).get(parameters[0]) if parameters else None
+    except Exception:
+        return None
+    if isinstance(hint, type) and issubclass(hint, BaseModel):
+        return hint
+    return None
+
+
 def invoke():
     """Decorator to register a function as an invoke endpoint. Can only be used once."""
 
     def decorator(func: Callable):
         global _invoke_function
-        if _invoke_function is not None:
+        if _invoke_function is not None and not _is_same_handler(_invoke_function, func):
             raise ValueError("invoke decorator can only be used once")
         _invoke_function = func
         return func
@@ -40,7 +120,7 @@ def stream():
 
     def decorator(func: Callable):
         global _stream_function
-        if _stream_function is not None:
+        if _stream_function is not None and not _is_same_handler(_stream_function, func):
             raise ValueError("stream decorator can only be used once")
         _stream_function = func
         return func
@@ -51,64 +131,540 @@ def stream():
 AgentType = Literal["agent/v1/responses"]
 
 
+class _AdmittedStreamingResponse(StreamingResponse):
+    """Holds an admission slot until the stream is fully sent or the client disconnects.
+
+    The body is closed as soon as sending stops, so an abandoned stream stops the agent right
+    away instead of whenever the generator is garbage collected.
+    """
+
+    def __init__(self, content: Any, slot: AdmissionSlot, **kwargs):
+        super().__init__(content, **kwargs)
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            try:
+                aclose = getattr(self.body_iterator, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+            finally:
+                self.slot.release()
+
+
 class AgentServer:
-    def __init__(self, agent_type: Optional[AgentType] = None):
+    def __init__(
+        self,
+        agent_type: Optional[AgentType] = None,
+        sync_workers: Optional[int] = None,
+        validate_first_chunks: Optional[int] = None,
+        validate_every_nth_chunk: Optional[int] = None,
+        sse_flush_interval: Optional[float] = None,
+        sse_flush_bytes: int = 16384,
+        stream_trace_max_items: Optional[int] = 1000,
+        trace_exporter: Optional[TraceExporter] = None,
+        trace_sampler: Optional[TraceSampler] = None,
+        trace_max_payload_chars: Optional[int] = None,
+        max_concurrent_invokes: Optional[int] = None,
+        max_concurrent_streams: Optional[int] = None,
+        admission_queue_size: int = 64,
+        admission_queue_timeout: Optional[float] = 10.0,
+        admission_retry_after: float = 1.0,
+        session_store: Optional[SessionStore] = None,
+        request_timeout: Optional[float] = None,
+        coalesce_requests: bool = False,
+        coalesce_key_fields: Optional[Sequence[str]] = None,
+        batch_concurrency: int = 8,
+    ):
+        """
+        Set `sse_flush_interval` (seconds) to coalesce small SSE frames into a single write,
+        flushed after that interval or once `sse_flush_bytes` have been buffered.
+        `stream_trace_max_items` caps how many output items a stream span keeps.
+        With a `trace_exporter`, request spans are finalized and exported on its background
+        worker instead of on the request path. `trace_sampler` decides which requests are traced
+        (see `RatioTraceSampler`) and `trace_max_payload_chars` truncates large span payloads.
+        `max_concurrent_invokes` and `max_concurrent_streams` cap in-flight requests per
+        endpoint kind. Excess requests wait in a queue of `admission_queue_size` for up to
+        `admission_queue_timeout` seconds; a full queue gets a 429 and a timed out wait a 503,
+        both with a Retry-After of `admission_retry_after` seconds.
+        With a `session_store`, requests that set `custom_inputs.session_id` only send the new
+        input items; the server prepends the stored history and saves each completed turn.
+        `request_timeout` (seconds, from arrival) cancels requests that run longer: invoke
+        requests get a 504 and streams end with an error event. Agents are also cancelled when
+        the client disconnects; synchronous agents see both through `cancellation.CancelToken`.
+        With `coalesce_requests`, identical concurrent requests (compared on
+        `coalesce_key_fields`, or the whole request) share a single agent execution; session
+        and return_trace requests always run on their own.
+        `POST /invocations/batch` runs up to `batch_concurrency` items of a batch at a time.
+        """
+        if session_store is not None and agent_type != "agent/v1/responses":
+            raise ValueError("session_store requires agent_type 'agent/v1/responses'")
         self.agent_type = agent_type
-        self.validator = AgentValidator(agent_type)
-        self.app = FastAPI(title="Agent Server", version="0.0.1")
+        self.stream_trace_max_items = stream_trace_max_items
+        self.trace_exporter = trace_exporter
+        self.trace_sampler = trace_sampler or TraceSampler()
+        self.trace_max_payload_chars = trace_max_payload_chars
+        self.sse_flush_interval = sse_flush_interval
+        self.sse_flush_bytes = sse_flush_bytes
+        self.session_store = session_store
+        self.request_timeout = request_timeout
+        self.coalescer = RequestCoalescer(coalesce_key_fields) if coalesce_requests else None
+        self.batch_concurrency = batch_concurrency
+        self.validator = AgentValidator(
+            agent_type,
+            validate_first_chunks=validate_first_chunks,
+            validate_every_nth_chunk=validate_every_nth_chunk,
+        )
+        # Synchronous @invoke()/@stream() functions run here instead of on the event loop
+        self.sync_executor = SyncExecutor(sync_workers)
+        self.admission: dict[str, AdmissionController] = {
+            endpoint: AdmissionController(
+                limit, admission_queue_size, admission_queue_timeout, admission_retry_after
+            )
+            for endpoint, limit in (
+                ("invoke", max_concurrent_invokes),
+                ("stream", max_concurrent_streams),
+            )
+            if limit is not None
+        }
+        self.metrics = ServerMetrics()
+        self.metrics.add_collector(self._collect_metrics)
+        if trace_exporter is not None:
+            trace_exporter.on_span_exported = self.metrics.trace_export_latency.observe
+        self.app = FastAPI(title="Agent Server", version="0.0.1", lifespan=self._lifespan)
         self.logger = logging.getLogger(__name__)
         self._setup_routes()
 
+    @asynccontextmanager
+    async def _lifespan(self, app: FastAPI):
+        yield
+        self.sync_executor.shutdown()
+        if self.trace_exporter is not None:
+            self.trace_exporter.shutdown()
+
+    def _collect_metrics(self) -> None:
+        for state, value in self.sync_executor.stats().items():
+            self.metrics.sync_executor.set(value, state=state)
+        if self.trace_exporter is not None:
+            for stat, value in self.trace_exporter.stats().items():
+                self.metrics.trace_exporter.set(value, stat=stat)
+        for endpoint, controller in self.admission.items():
+            for stat, value in controller.stats().items():
+                self.metrics.admission.set(value, endpoint=endpoint, stat=stat)
+        for tool, stats in tool_cache_stats().items():
+            for stat, value in stats.items():
+                self.metrics.tool_cache.set(value, tool=tool, stat=stat)
+        if self.coalescer is not None:
+            for stat, value in self.coalescer.stats().items():
+                self.metrics.coalescing.set(value, stat=stat)
+        for cache, stats in completion_cache_stats().items():
+            for stat, value in stats.items():
+                self.metrics.completion_cache.set(value, cache=cache, stat=stat)
+
+    async def _admit(self, endpoint: str) -> AdmissionSlot:
+        """Wait for capacity on endpoint, or raise a 429/503 HTTPException with Retry-After"""
+        controller = self.admission.get(endpoint)
+        if controller is None:
+            return AdmissionSlot(None)
+        try:
+            slot = await controller.acquire()
+        except AdmissionRejected as e:
+            self.metrics.requests.inc(endpoint=endpoint, status="rejected")
+            self.logger.warning(
+                "Request rejected",
+                extra={"endpoint": endpoint, "status_code": e.status_code, "error": e.detail},
+            )
+            raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+        self.metrics.admission_wait.observe(slot.wait_s, endpoint=endpoint)
+        return slot
+
+    @staticmethod
+    def _elapsed_ms(start_time: float) -> float:
+        """Milliseconds since start_time, a time.perf_counter() reading"""
+        return round((time.perf_counter() - start_time) * 1000, 2)
+
     @staticmethod
     def _get_databricks_output(trace_id: str) -> dict:
         with InMemoryTraceManager.get_instance().get_trace(trace_id) as trace:
             return {"trace": trace.to_mlflow_trace().to_dict()}
 
     def _setup_routes(self):
+        @self.app.get("/metrics")
+        async def metrics_endpoint():
+            return Response(content=self.metrics.render(), media_type=CONTENT_TYPE)
+
         @self.app.post("/invocations")
         async def invocations_endpoint(request: Request):
-            start_time = time.time()
+            start_time = time.perf_counter()
+            token = CancelToken(self.request_timeout)
 
+            # Read the raw body once; sizes are measured from its byte length
+            body = await request.body()
             try:
-                data = await request.json()
+                request_data = serialization.loads(body)
             except Exception as e:
+                self.metrics.requests.inc(endpoint="unknown", status="bad_request")
                 raise HTTPException(
                     status_code=400, detail=f"Invalid JSON in request body: {str(e)}"
                 )
+            if not isinstance(request_data, dict):
+                self.metrics.requests.inc(endpoint="unknown", status="bad_request")
+                raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+
+            # Remove stream parameter from data before validation
+            is_streaming = request_data.pop("stream", False)
+            return_trace = request_data.get("databricks_options", {}).get("return_trace", False)
 
             # Log incoming request
             self.logger.info(
                 "Request received",
                 extra={
                     "agent_type": self.agent_type,
-                    "request_size": len(json.dumps(data)),
-                    "stream_requested": data.get("stream", False),
+                    "request_size": len(body),
+                    "stream_requested": is_streaming,
                 },
             )
 
-            # Check if streaming is requested
-            is_streaming = data.get("stream", False)
-            return_trace = data.get("databricks_options", {}).get("return_trace", False)
+            endpoint = "stream" if is_streaming else "invoke"
+            validated = self._validate_request(request_data, endpoint)
 
-            # Remove stream parameter from data before validation
-            request_data = {k: v for k, v in data.items() if k != "stream"}
+            turn = session_turn(request_data) if self.session_store is not None else None
+            if turn is not None:
+                # Validated without the stored history, so it can't be passed to the agent
+                validated = None
+            coalesce_key = self._coalesce_key(endpoint, request_data, turn, return_trace)
+            slot = await self._admit(endpoint)
+            if is_streaming:
+                try:
+                    request_data = await self._load_session(request_data, turn)
+                    return await self._handle_stream_request(
+                        request_data,
+                        start_time,
+                        return_trace,
+                        slot,
+                        token,
+                        turn,
+                        coalesce_key,
+                        validated=validated,
+                    )
+                except BaseException:
+                    slot.release()
+                    raise
 
-            # Validate request parameters based on agent type
+            self.metrics.in_flight.inc(endpoint="invoke")
             try:
-                self.validator.validate_request(request_data)
-            except ValueError as e:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Invalid parameters for {self.agent_type}: {e}",
+                request_data = await self._load_session(request_data, turn)
+                return await self._cancel_on_disconnect(
+                    request,
+                    token,
+                    self._handle_invoke_request(
+                        request_data,
+                        start_time,
+                        return_trace,
+                        token,
+                        turn,
+                        coalesce_key,
+                        validated=validated,
+                    ),
                 )
+            finally:
+                self.metrics.in_flight.dec(endpoint="invoke")
+                slot.release()
 
-            if is_streaming:
-                return await self._handle_stream_request(request_data, start_time, return_trace)
-            else:
-                return await self._handle_invoke_request(request_data, start_time, return_trace)
+        @self.app.post("/invocations/batch")
+        async def batch_endpoint(request: Request):
+            body = await request.body()
+            try:
+                items = self._parse_batch(body)
+            except Exception as e:
+                self.metrics.requests.inc(endpoint="batch", status="bad_request")
+                raise HTTPException(status_code=400, detail=f"Invalid batch request body: {e}")
+
+            self.logger.info(
+                "Batch request received",
+                extra={
+                    "agent_type": self.agent_type,
+                    "request_size": len(body),
+                    "items": len(items),
+                },
+            )
+            # No slot of its own: every item is admitted as an invoke request
+            return _AdmittedStreamingResponse(
+                self._run_batch(items), AdmissionSlot(None), media_type="application/x-ndjson"
+            )
+
+    def _validate_request(self, request_data: dict, endpoint: str) -> Any:
+        """Validate request parameters based on agent type, returning the validated request or
+        raising a 400 HTTPException"""
+        validation_start = time.perf_counter()
+        try:
+            return self.validator.validate_request(request_data)
+        except ValueError as e:
+            self.metrics.requests.inc(endpoint=endpoint, status="bad_request")
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid parameters for {self.agent_type}: {e}",
+            )
+        finally:
+            self.metrics.validation_latency.observe(
+                time.perf_counter() - validation_start, kind="request"
+            )
+
+    def _coalesce_key(
+        self, endpoint: str, request_data: dict, turn: Optional[SessionTurn], return_trace: bool
+    ) -> Optional[str]:
+        if self.coalescer is None or turn is not None or return_trace:
+            return None
+        return self.coalescer.key(endpoint, request_data)
+
+    @staticmethod
+    def _parse_batch(body: bytes) -> list[Any]:
+        """The items of a JSON array or NDJSON batch body. An NDJSON line that isn't valid JSON
+        becomes its exception, so it fails on its own instead of failing the batch."""
+        if body.lstrip().startswith(b"["):
+            items = serialization.loads(body)
+            if not isinstance(items, list):
+                raise ValueError("expected a JSON array")
+            return items
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(serialization.loads(line))
+            except Exception as e:
+                items.append(ValueError(f"Invalid JSON: {e}"))
+        return items
+
+    async def _run_batch(self, items: list[Any]) -> AsyncGenerator[bytes, None]:
+        """Run batch items with bounded concurrency, yielding an NDJSON line as each finishes"""
+        start_time = time.perf_counter()
+        pending: dict[asyncio.Task, CancelToken] = {}
+        queued = enumerate(items)
+        failed = 0
+        try:
+            while True:
+                for index, item in itertools.islice(queued, self.batch_concurrency - len(pending)):
+                    token = CancelToken(self.request_timeout)
+                    pending[asyncio.ensure_future(self._run_batch_item(index, item, token))] = token
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    del pending[task]
+                    index, body, error = task.result()
+                    if error is None:
+                        yield b'{"index":%d,"response":%s}\n' % (index, body)
+                    else:
+                        failed += 1
+                        yield serialization.dumps({"index": index, "error": error}) + b"\n"
+        finally:
+            # The client went away: stop the items still running
+            for task, token in pending.items():
+                token.cancel(CLIENT_DISCONNECTED)
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        self.metrics.requests.inc(endpoint="batch", status="ok")
+        self.logger.info(
+            "Batch response sent",
+            extra={
+                "duration_ms": self._elapsed_ms(start_time),
+                "items": len(items),
+                "failed": failed,
+            },
+        )
+
+    async def _run_batch_item(
+        self, index: int, item: Any, token: CancelToken
+    ) -> tuple[int, Optional[bytes], Optional[dict]]:
+        """Run one batch item as an invoke request: (index, response body, error)"""
+        start_time = time.perf_counter()
+        try:
+            if isinstance(item, Exception):
+                self.metrics.requests.inc(endpoint="invoke", status="bad_request")
+                raise HTTPException(status_code=400, detail=str(item))
+            if not isinstance(item, dict):
+                self.metrics.requests.inc(endpoint="invoke", status="bad_request")
+                raise HTTPException(status_code=400, detail="Request must be a JSON object")
+            if item.pop("stream", False):
+                self.metrics.requests.inc(endpoint="invoke", status="bad_request")
+                raise HTTPException(status_code=400, detail="Batch items can't be streamed")
+            return_trace = item.get("databricks_options", {}).get("return_trace", False)
+            validated = self._validate_request(item, "invoke")
+
+            turn = session_turn(item) if self.session_store is not None else None
+            if turn is not None:
+                validated = None
+            coalesce_key = self._coalesce_key("invoke", item, turn, return_trace)
+            slot = await self._admit("invoke")
+            self.metrics.in_flight.inc(endpoint="invoke")
+            try:
+                item = await self._load_session(item, turn)
+                response = await self._handle_invoke_request(
+                    item, start_time, return_trace, token, turn, coalesce_key, validated=validated
+                )
+            finally:
+                self.metrics.in_flight.dec(endpoint="invoke")
+                slot.release()
+            return index, response.body, None
+        except HTTPException as e:
+            return index, None, {"status_code": e.status_code, "detail": e.detail}
+        except Exception as e:
+            return index, None, {"status_code": 500, "detail": str(e)}
+
+    @staticmethod
+    async def _cancel_on_disconnect(request: Request, token: CancelToken, handler: Any) -> Any:
+        """Await the handler coroutine, cancelling it if the client disconnects first"""
+        task = asyncio.ensure_future(handler)
+
+        async def watch():
+            while (await request.receive())["type"] != "http.disconnect":
+                pass
+            token.cancel(CLIENT_DISCONNECTED)
+            task.cancel()
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            return await task
+        except asyncio.CancelledError:
+            # Cancelled by the watcher outside of the agent call, e.g. while saving the session
+            if asyncio.current_task().cancelling() or token.reason != CLIENT_DISCONNECTED:
+                raise
+            raise HTTPException(status_code=499, detail=f"Request cancelled: {token.reason}")
+        finally:
+            watcher.cancel()
+
+    def _agent_request(self, func: Callable, data: dict, validated: Any = None) -> Any:
+        """The request to pass to func: the validated request object if func's first parameter
+        is annotated with its class, so it isn't validated again, and the request dict otherwise"""
+        request_type = _request_type(func)
+        if request_type is None:
+            return data
+        if not isinstance(validated, request_type):
+            validated = self.validator.validate_request(data)
+        return validated if isinstance(validated, request_type) else data
+
+    async def _invoke_agent(self, func: Callable, request: Any) -> Any:
+        if inspect.iscoroutinefunction(func):
+            return await func(request)
+        return await self.sync_executor.run(func, request)
+
+    def _agent_chunks(self, func: Callable, request: Any) -> AsyncIterator:
+        if inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func):
+            return func(request)
+        return self.sync_executor.iterate(func, request)
 
-    async def _handle_invoke_request(self, data: dict, start_time: float, return_trace: bool):
-        """Handle non-streaming invoke requests"""
+    async def _call_agent(
+        self, func: Callable, request: Any, token: CancelToken, coalesce_key: Optional[str] = None
+    ) -> Any:
+        """Run the invoke function, raising RequestCancelled once the request is abandoned.
+        With a `coalesce_key`, identical concurrent requests share one run."""
+        set_current_token(token)
+        timeout = asyncio.timeout(token.remaining())
+        try:
+            async with timeout:
+                if coalesce_key is not None:
+                    return await self.coalescer.run(
+                        coalesce_key,
+                        functools.partial(self._invoke_agent, func, request),
+                        self.request_timeout,
+                    )
+                return await self._invoke_agent(func, request)
+        except TimeoutError:
+            if not timeout.expired():
+                raise
+            token.cancel(DEADLINE_EXCEEDED)
+            raise RequestCancelled(DEADLINE_EXCEEDED) from None
+        except asyncio.CancelledError:
+            if token.reason != CLIENT_DISCONNECTED:
+                raise
+            raise RequestCancelled(CLIENT_DISCONNECTED) from None
+
+    @staticmethod
+    def _failure_status(e: Exception) -> tuple[str, int]:
+        """The metrics status and HTTP status code for a failed request"""
+        if isinstance(e, RequestCancelled):
+            if e.reason == DEADLINE_EXCEEDED:
+                return "timeout", 504
+            return "disconnected", 499
+        return "error", 500
+
+    async def _session_call(self, method: Callable, *args: Any) -> Any:
+        if self.session_store.blocking:
+            return await self.sync_executor.run(method, *args)
+        return method(*args)
+
+    async def _load_session(self, data: dict, turn: Optional[SessionTurn]) -> dict:
+        """Prepend the session's stored history to the new input items"""
+        if turn is None:
+            return data
+        history = await self._session_call(self.session_store.load, turn.session_id)
+        return {**data, "input": history + turn.new_items}
+
+    async def _save_session(self, turn: Optional[SessionTurn], output_items: list[dict]) -> None:
+        """Append a completed turn to its session; the response is still sent if this fails"""
+        if turn is None:
+            return
+        try:
+            await self._session_call(
+                self.session_store.append, turn.session_id, turn.new_items + output_items
+            )
+        except Exception as e:
+            self.logger.error(
+                "Failed to save session turn",
+                extra={"session_id": turn.session_id, "error": str(e)},
+            )
+
+    def _pending_span(
+        self,
+        span: Optional[Any],
+        head_sample: Optional[bool],
+        endpoint: str,
+        duration_ms: float,
+        return_trace: bool,
+        **kwargs,
+    ) -> PendingSpan:
+        """Build the PendingSpan for a completed request, applying tail sampling"""
+        pending = PendingSpan(span, max_payload_chars=self.trace_max_payload_chars, **kwargs)
+        if head_sample is None and not self.trace_sampler.sample_tail(
+            RequestOutcome(endpoint, duration_ms / 1000, pending.error, return_trace)
+        ):
+            pending.drop_payloads()
+        return pending
+
+    async def _finish_span(self, pending: PendingSpan) -> None:
+        """Hand a finished request span to the trace exporter, or finalize it inline"""
+        if pending.span is None:
+            return
+        if self.trace_exporter is not None:
+            await self.trace_exporter.submit(pending)
+        else:
+            finish_start = time.perf_counter()
+            pending.finish()
+            self.metrics.trace_export_latency.observe(time.perf_counter() - finish_start)
+
+    async def _get_databricks_output_async(self, pending: PendingSpan) -> dict:
+        """Build the databricks_output for return_trace off the event loop"""
+        # The returned trace has to include this span's payloads
+        pending.record()
+        return await self.sync_executor.run(self._get_databricks_output, pending.span.trace_id)
+
+    async def _handle_invoke_request(
+        self,
+        data: dict,
+        start_time: float,
+        return_trace: bool,
+        token: CancelToken,
+        turn: Optional[SessionTurn] = None,
+        coalesce_key: Optional[str] = None,
+        validated: Any = None,
+    ):
+        """Handle non-streaming invoke requests. `validated` is the request as validated for
+        the agent type, if already done."""
         # Use the single invoke function
         if _invoke_function is None:
             raise HTTPException(status_code=500, detail="No invoke function registered")
@@ -116,43 +672,75 @@ class AgentServer:
         func = _invoke_function
         func_name = func.__name__
 
+        # Session requests are traced as sent, without the stored history
+        trace_inputs = turn.request if turn is not None else data
+
         # Check if function is async or sync and execute with tracing
+        head_sample = self.trace_sampler.sample_head(trace_inputs, return_trace)
+        span = None
         try:
-            with mlflow.start_span(name=f"{func_name}_invoke") as span:
-                span.set_inputs(data)
-                if inspect.iscoroutinefunction(func):
-                    result = await func(data)
-                else:
-                    result = func(data)
-
-                result = self.validator.validate_and_convert_result(result)
-                duration = round(time.time() - start_time, 2)
-                span.set_attribute("duration_ms", duration)
-                span.set_outputs(result)
+            with start_deferred_span(f"{func_name}_invoke", head_sample is not False) as span:
+                request = self._agent_request(func, data, validated)
+                result = await self._call_agent(func, request, token, coalesce_key)
 
-                if return_trace:
-                    databricks_output = self._get_databricks_output(span.trace_id)
+                validation_start = time.perf_counter()
+                result = self.validator.validate_invoke_result(result)
+                self.metrics.validation_latency.observe(
+                    time.perf_counter() - validation_start, kind="response"
+                )
+            # A pydantic result is kept as its validated instance and dumped straight to JSON;
+            # it is only converted to a dict where one is needed
+            as_dict = (
+                functools.partial(result.model_dump, exclude_none=True)
+                if isinstance(result, BaseModel)
+                else lambda: result
+            )
+            duration = self._elapsed_ms(start_time)
+            pending = self._pending_span(
+                span,
+                head_sample,
+                "invoke",
+                duration,
+                return_trace,
+                inputs=trace_inputs,
+                outputs=as_dict,
+                attributes={"duration_ms": duration},
+            )
+            if turn is not None:
+                await self._save_session(turn, as_dict().get("output") or [])
 
-            result["databricks_output"] = databricks_output
+            response = result
+            if return_trace and span is not None:
+                databricks_output = await self._get_databricks_output_async(pending)
+                response = {**as_dict(), "databricks_output": databricks_output}
 
-            # Log response details
-            self.logger.info(
-                "Response sent",
-                extra={
-                    "endpoint": "invoke",
-                    "duration_ms": duration,
-                    "response_size": len(json.dumps(result)),
-                    "function_name": func_name,
-                    "return_trace": return_trace,
-                },
+            # Serialize once; the same bytes are measured and sent
+            serialization_start = time.perf_counter()
+            if isinstance(response, BaseModel):
+                body = response.model_dump_json(exclude_none=True).encode("utf-8")
+            else:
+                body = serialization.dumps(response)
+            self.metrics.serialization_latency.observe(
+                time.perf_counter() - serialization_start, endpoint="invoke"
             )
 
-            return result
-
         except Exception as e:
-            duration = round(time.time() - start_time, 2)
-            span.set_attribute("duration_ms", duration)
-            span.set_outputs(f"Error: {str(e)}")
+            duration = self._elapsed_ms(start_time)
+            status, status_code = self._failure_status(e)
+            self.metrics.requests.inc(endpoint="invoke", status=status)
+            self.metrics.request_latency.observe(duration / 1000, endpoint="invoke")
+            await self._finish_span(
+                self._pending_span(
+                    span,
+                    head_sample,
+                    "invoke",
+                    duration,
+                    return_trace,
+                    inputs=trace_inputs,
+                    attributes={"duration_ms": duration},
+                    error=str(e),
+                )
+            )
 
             self.logger.error(
                 "Error response sent",
@@ -165,10 +753,38 @@ class AgentServer:
                 },
             )
 
-            raise HTTPException(status_code=500, detail=str(e))
+            raise HTTPException(status_code=status_code, detail=str(e))
+
+        await self._finish_span(pending)
+        self.metrics.requests.inc(endpoint="invoke", status="ok")
+        self.metrics.request_latency.observe(self._elapsed_ms(start_time) / 1000, endpoint="invoke")
 
-    async def _handle_stream_request(self, data: dict, start_time: float, return_trace: bool):
-        """Handle streaming requests"""
+        # Log response details
+        self.logger.info(
+            "Response sent",
+            extra={
+                "endpoint": "invoke",
+                "duration_ms": duration,
+                "response_size": len(body),
+                "function_name": func_name,
+                "return_trace": return_trace,
+            },
+        )
+
+        return Response(content=body, media_type="application/json")
+
+    async def _handle_stream_request(
+        self,
+        data: dict,
+        start_time: float,
+        return_trace: bool,
+        slot: AdmissionSlot,
+        token: CancelToken,
+        turn: Optional[SessionTurn] = None,
+        coalesce_key: Optional[str] = None,
+        validated: Any = None,
+    ):
+        """Handle streaming requests; the response releases `slot` once the stream ends"""
         # Use the single stream function
         if _stream_function is None:
             raise HTTPException(status_code=500, detail="No stream function registered")
@@ -176,40 +792,92 @@ class AgentServer:
         func = _stream_function
         func_name = func.__name__
 
-        # Collect all chunks for tracing
-        all_chunks = []
+        # Fold chunks into the span output as they arrive
+        reducer = StreamOutputReducer(self.agent_type, max_items=self.stream_trace_max_items)
+        sse = SSEWriter()
+
+        # Session requests are traced as sent, without the stored history
+        trace_inputs = turn.request if turn is not None else data
+        head_sample = self.trace_sampler.sample_head(trace_inputs, return_trace)
 
         async def generate():
-            nonlocal all_chunks
+            span = None
+            finished = False
+            status = "disconnected"
+            last_chunk_time = None
+            # Completed output items, kept in full for the session history
+            output_items = []
+            self.metrics.in_flight.inc(endpoint="stream")
+            # Agent code sees the token through a context variable, including sync agents on
+            # the executor, which copies this context
+            set_current_token(token)
             try:
-                with mlflow.start_span(name=f"{func_name}_stream") as span:
-                    span.set_inputs(data)
-                    if inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func):
-                        async for chunk in func(data):
-                            chunk = self.validator.validate_and_convert_result(chunk, stream=True)
-                            all_chunks.append(chunk)
-                            yield f"data: {json.dumps({'chunk': chunk})}\n\n"
+                with start_deferred_span(f"{func_name}_stream", head_sample is not False) as span:
+                    request = self._agent_request(func, data, validated)
+                    if coalesce_key is not None:
+                        chunks = self.coalescer.stream(
+                            coalesce_key,
+                            functools.partial(self._agent_chunks, func, request),
+                            self.request_timeout,
+                        )
                     else:
-                        for chunk in func(data):
-                            chunk = self.validator.validate_and_convert_result(chunk, stream=True)
-                            all_chunks.append(chunk)
-                            yield f"data: {json.dumps({'chunk': chunk})}\n\n"
-
-                    # Log the full streaming session
-                    duration = round(time.time() - start_time, 2)
-                    span.set_attribute("duration_ms", duration)
-                    if self.agent_type == "agent/v1/responses":
-                        span.set_outputs(ResponsesAgent.responses_agent_output_reducer(all_chunks))
-                    # TODO: add additional streaming output reducers for different agent types
-                    else:
-                        span.set_outputs(all_chunks)
+                        chunks = self._agent_chunks(func, request)
+                    if token.deadline is not None:
+                        chunks = iterate_until_deadline(chunks, token)
+                    async for chunk in chunks:
+                        chunk_time = time.perf_counter()
+                        if last_chunk_time is None:
+                            self.metrics.time_to_first_chunk.observe(chunk_time - start_time)
+                        else:
+                            self.metrics.inter_chunk_latency.observe(chunk_time - last_chunk_time)
+                        last_chunk_time = chunk_time
+
+                        chunk = self.validator.validate_and_convert_result(
+                            chunk, stream=True, chunk_index=reducer.chunk_count
+                        )
+                        reducer.add(chunk)
+                        if turn is not None and chunk.get("type") == "response.output_item.done":
+                            output_items.append(chunk["item"])
+                        encode_start = time.perf_counter()
+                        self.metrics.validation_latency.observe(
+                            encode_start - chunk_time, kind="chunk"
+                        )
+                        frame = sse.chunk(chunk)
+                        self.metrics.serialization_latency.observe(
+                            time.perf_counter() - encode_start, endpoint="stream"
+                        )
+                        yield frame
+
+                # Log the full streaming session
+                duration = self._elapsed_ms(start_time)
+                attributes = {"duration_ms": duration}
+                if reducer.dropped_items:
+                    attributes["dropped_output_items"] = reducer.dropped_items
+                # TODO: add additional streaming output reducers for different agent types
+                pending = self._pending_span(
+                    span,
+                    head_sample,
+                    "stream",
+                    duration,
+                    return_trace,
+                    inputs=trace_inputs,
+                    outputs=reducer.output,
+                    attributes=attributes,
+                )
+
+                if return_trace and span is not None:
+                    databricks_output = await self._get_databricks_output_async(pending)
+                    yield sse.data({"databricks_output": databricks_output})
+
+                # Save before [DONE] so the client's next turn sees this one
+                await self._save_session(turn, output_items)
 
-                    if return_trace:
-                        databricks_output = self._get_databricks_output(span.trace_id)
-                        yield f"data: {json.dumps({'databricks_output': databricks_output})}\n\n"
+                # Send [DONE] signal
+                yield sse.done()
 
-                    # Send [DONE] signal
-                    yield "data: [DONE]\n\n"
+                finished = True
+                status = "ok"
+                await self._finish_span(pending)
 
                 # Log streaming response completion
                 self.logger.info(
@@ -217,16 +885,30 @@ class AgentServer:
                     extra={
                         "endpoint": "stream",
                         "duration_ms": duration,
-                        "total_chunks": len(all_chunks),
+                        "total_chunks": reducer.chunk_count,
                         "function_name": func_name,
                         "return_trace": return_trace,
                     },
                 )
 
             except Exception as e:
-                duration = round(time.time() - start_time, 2)
-                span.set_attribute("duration_ms", duration)
-                span.set_outputs(f"Error: {str(e)}")
+                duration = self._elapsed_ms(start_time)
+                status, _ = self._failure_status(e)
+                if not finished:
+                    finished = True
+                    await self._finish_span(
+                        self._pending_span(
+                            span,
+                            head_sample,
+                            "stream",
+                            duration,
+                            return_trace,
+                            inputs=trace_inputs,
+                            outputs=reducer.output,
+                            attributes={"duration_ms": duration},
+                            error=str(e),
+                        )
+                    )
 
                 self.logger.error(
                     "Streaming response error",
@@ -235,62 +917,196 @@ class AgentServer:
                         "duration_ms": duration,
                         "error": str(e),
                         "function_name": func_name,
-                        "chunks_sent": len(all_chunks),
+                        "chunks_sent": reducer.chunk_count,
                         "return_trace": return_trace,
                     },
                 )
 
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                yield sse.data({"error": str(e)})
 
-        return StreamingResponse(generate(), media_type="text/event-stream")
+            finally:
+                if status == "disconnected":
+                    # Stops synchronous agents still running on the executor
+                    token.cancel(CLIENT_DISCONNECTED)
+                self.metrics.in_flight.dec(endpoint="stream")
+                self.metrics.requests.inc(endpoint="stream", status=status)
+                self.metrics.request_latency.observe(
+                    time.perf_counter() - start_time, endpoint="stream"
+                )
+                # The client went away before the stream completed
+                if span is not None and not finished:
+                    PendingSpan(
+                        span,
+                        inputs=trace_inputs,
+                        outputs=reducer.output,
+                        attributes={"duration_ms": self._elapsed_ms(start_time)},
+                        error="Stream closed before completion",
+                        max_payload_chars=self.trace_max_payload_chars,
+                    ).finish()
+
+        frames = generate()
+        if self.sse_flush_interval:
+            frames = coalesce(frames, self.sse_flush_interval, self.sse_flush_bytes)
+        return _AdmittedStreamingResponse(frames, slot, media_type="text/event-stream")
+
+    def run(
+        self,
+        host: str = "0.0.0.0",
+        port: int = 8000,
+        workers: Optional[int] = None,
+        app_factory: Optional[str] = None,
+        reload: bool = False,
+        timeout_graceful_shutdown: Optional[int] = 30,
+    ):
+        """Serve the app with uvicorn.
 
-    def run(self, host: str = "0.0.0.0", port: int = 8000):
+        With a single worker the app is served in-process. With multiple workers (or reload),
+        every worker process imports `app_factory` ("module:callable" returning a FastAPI app),
+        which re-registers the `@invoke()`/`@stream()` functions in that process. Sending SIGHUP
+        to the main process restarts workers one at a time; on shutdown in-flight requests are
+        drained for up to `timeout_graceful_shutdown` seconds.
+        """
         import uvicorn
 
-        uvicorn.run(self.app, host=host, port=port)
+        if server_workers(workers) <= 1 and not reload:
+            uvicorn.run(
+                self.app,
+                host=host,
+                port=port,
+                timeout_graceful_shutdown=timeout_graceful_shutdown,
+            )
+            return
+
+        if app_factory is None:
+            raise ValueError(
+                "app_factory ('module:callable') is required to run with multiple workers or reload"
+            )
+        run_workers(app_factory, host, port, workers, reload, timeout_graceful_shutdown)
+
+
+# Concrete event models that ResponsesAgentStreamEvent re-validates itself against by type
+_RESPONSES_STREAM_EVENT_CLASSES: dict[str, Type[BaseModel]] = {
+    "response.output_item.done": ResponseOutputItemDoneEvent,
+    "response.output_text.delta": ResponseTextDeltaEvent,
+    "response.output_text.annotation.added": ResponseTextAnnotationDeltaEvent,
+    "error": ResponseErrorEvent,
+    "response.completed": ResponseCompletedEvent,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _type_adapter(pydantic_class: Type[BaseModel]) -> TypeAdapter:
+    """Compiled validator for pydantic_class, built once per class"""
+    return TypeAdapter(pydantic_class)
 
 
 class AgentValidator:
-    def __init__(self, agent_type: Optional[AgentType] = None):
+    def __init__(
+        self,
+        agent_type: Optional[AgentType] = None,
+        validate_first_chunks: Optional[int] = None,
+        validate_every_nth_chunk: Optional[int] = None,
+    ):
+        """
+        Stream chunks are all validated by default. For high-throughput stream endpoints, set
+        `validate_first_chunks` and/or `validate_every_nth_chunk` to validate only the first N
+        chunks of each stream and every Kth chunk after that.
+        """
+        if validate_first_chunks is not None and validate_first_chunks < 0:
+            raise ValueError("validate_first_chunks must be at least 0")
+        if validate_every_nth_chunk is not None and validate_every_nth_chunk < 1:
+            raise ValueError("validate_every_nth_chunk must be at least 1")
         self.agent_type = agent_type
+        self.validate_first_chunks = validate_first_chunks
+        self.validate_every_nth_chunk = validate_every_nth_chunk
         self.logger = logging.getLogger(__name__)
 
-    def validate_pydantic(self, pydantic_class: Type[BaseModel], data: Any) -> None:
-        """Generic pydantic validator that throws an error if the data is invalid"""
+    def validate_pydantic(self, pydantic_class: Type[BaseModel], data: Any) -> BaseModel:
+        """Generic pydantic validator that throws an error if the data is invalid.
+
+        Returns the validated instance; already-typed instances are returned without
+        re-validation.
+        """
         if isinstance(data, pydantic_class):
-            return
+            return data
         try:
-            pydantic_class(**data)
+            return _type_adapter(pydantic_class).validate_python(data)
         except Exception as e:
             raise ValueError(
                 f"Invalid data for {pydantic_class.__name__} (agent_type: {self.agent_type}): {e}"
             )
 
-    def validate_invoke_response(self, result: Any) -> None:
+    def validate_invoke_response(self, result: Any) -> Any:
         """Validate the invoke response"""
         if self.agent_type == "agent/v1/responses":
-            self.validate_pydantic(ResponsesAgentResponse, result)
+            return self.validate_pydantic(ResponsesAgentResponse, result)
         # TODO: add additional validation for different agent types
+        return result
 
-    def validate_stream_response(self, result: Any) -> None:
+    def validate_stream_response(self, result: Any) -> Any:
         """Validate a stream event for agent/v1/responses (ResponsesAgent)"""
         if self.agent_type == "agent/v1/responses":
-            self.validate_pydantic(ResponsesAgentStreamEvent, result)
+            # Validate dict events against their concrete event model directly, skipping the
+            # generic model that dumps itself and re-validates against the same class
+            event_class = (
+                _RESPONSES_STREAM_EVENT_CLASSES.get(result.get("type"))
+                if isinstance(result, dict)
+                else None
+            )
+            if event_class is not None and isinstance(
+                result.get("custom_outputs"), (dict, type(None))
+            ):
+                return self.validate_pydantic(event_class, result)
+            return self.validate_pydantic(ResponsesAgentStreamEvent, result)
         # TODO: add additional validation for different agent types
+        return result
 
-    def validate_request(self, data: dict) -> None:
+    def validate_request(self, data: dict) -> Any:
         """Validate request parameters based on agent type"""
         if self.agent_type == "agent/v1/responses":
-            self.validate_pydantic(ResponsesAgentRequest, data)
+            return self.validate_pydantic(ResponsesAgentRequest, data)
         # TODO: add additional validation for different agent types
+        return data
+
+    def should_validate_chunk(self, chunk_index: int) -> bool:
+        """Whether the stream chunk at chunk_index is selected for validation"""
+        first = self.validate_first_chunks
+        every = self.validate_every_nth_chunk
+        if first is None and every is None:
+            return True
+        first = first or 0
+        if chunk_index < first:
+            return True
+        return every is not None and (chunk_index - first) % every == 0
+
+    def validate_invoke_result(self, result: Any) -> Any:
+        """Validate an invoke result and return it ready to serialize: dicts as they are, and
+        pydantic results as their validated instance, so they are dumped to JSON only once"""
+        validated = self.validate_invoke_response(result)
+        if isinstance(result, dict):
+            return result
+        if isinstance(validated, BaseModel):
+            return validated
+        return self._to_dict(result)
 
-    def validate_and_convert_result(self, result: Any, stream: bool = False) -> dict:
+    def validate_and_convert_result(
+        self, result: Any, stream: bool = False, chunk_index: Optional[int] = None
+    ) -> dict:
         """Validate and convert the result into a dictionary if necessary"""
+        validated = result
         if stream:
-            self.validate_stream_response(result)
+            if chunk_index is None or self.should_validate_chunk(chunk_index):
+                validated = self.validate_stream_response(result)
         else:
-            self.validate_invoke_response(result)
+            validated = self.validate_invoke_response(result)
 
+        # Dicts are already plain data; the validated model only confirmed their shape
+        if isinstance(result, dict):
+            return result
+        return self._to_dict(validated if isinstance(validated, BaseModel) else result)
+
+    @staticmethod
+    def _to_dict(result: Any) -> dict:
         if isinstance(result, BaseModel):
             return result.model_dump(exclude_none=True)
         elif is_dataclass(result):
@@ -304,5 +1120,41 @@ class AgentValidator:
 
 
 # Factory function to create server with specific agent type
-def create_server(agent_type: Optional[AgentType] = None) -> AgentServer:
-    return AgentServer(agent_type)
+def create_server(agent_type: Optional[AgentType] = None, **kwargs) -> AgentServer:
+    return AgentServer(agent_type, **kwargs)
+
+
+def server_workers(workers: Optional[int] = None) -> int:
+    """The number of worker processes to serve with: `workers`, or AGENT_SERVER_WORKERS"""
+    if workers is None:
+        workers = int(os.getenv("AGENT_SERVER_WORKERS", "1"))
+    return workers
+
+
+def run_workers(
+    app_factory: str,
+    host: str = "0.0.0.0",
+    port: int = 8000,
+    workers: Optional[int] = None,
+    reload: bool = False,
+    timeout_graceful_shutdown: Optional[int] = 30,
+):
+    """Serve `app_factory` ("module:callable" returning a FastAPI app) with uvicorn worker
+    processes that each import it, without building a server in this process. See
+    AgentServer.run()."""
+    import uvicorn
+
+    workers = server_workers(workers)
+    logging.getLogger(__name__).info(
+        "Starting agent server workers",
+        extra={"workers": workers, "app_factory": app_factory, "reload": reload},
+    )
+    uvicorn.run(
+        app_factory,
+        factory=True,
+        host=host,
+        port=port,
+        workers=None if reload else workers,
+        reload=reload,
+        timeout_graceful_shutdown=timeout_graceful_shutdown,
+    )
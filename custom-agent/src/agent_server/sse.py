@@ -0,0 +1,81 @@
+import asyncio
+import contextvars
+from typing import Any, AsyncGenerator, AsyncIterator, Optional
+
+from agent_server import serialization
+
+DONE_DATA = b"[DONE]"
+
+
+class SSEWriter:
+    """Encodes server-sent event frames directly to bytes, numbering each with an `id:` field"""
+
+    def __init__(self):
+        self._next_id = 0
+
+    def frame(self, data: bytes) -> bytes:
+        event_id = self._next_id
+        self._next_id += 1
+        return b"id: %d\ndata: %s\n\n" % (event_id, data)
+
+    def chunk(self, chunk: Any) -> bytes:
+        """Frame a stream chunk as `{"chunk": ...}` without building the wrapper dict"""
+        return self.frame(b'{"chunk":' + serialization.dumps(chunk) + b"}")
+
+    def data(self, obj: Any) -> bytes:
+        return self.frame(serialization.dumps(obj))
+
+    def done(self) -> bytes:
+        return self.frame(DONE_DATA)
+
+
+async def coalesce(
+    frames: AsyncIterator[bytes],
+    flush_interval: float,
+    flush_bytes: Optional[int] = None,
+) -> AsyncGenerator[bytes, None]:
+    """Merge small frames into fewer writes.
+
+    Buffered frames are flushed once `flush_bytes` have accumulated or `flush_interval` seconds
+    after the first buffered frame, whichever comes first, even if the source is idle.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = frames.__aiter__()
+    # Every step of the source runs in the same context so context managers opened inside it
+    # (e.g. MLflow spans) can be exited on a later step
+    ctx = contextvars.copy_context()
+    buffer: list[bytes] = []
+    buffered = 0
+    deadline: Optional[float] = None
+    pending: Optional[asyncio.Task] = None
+    try:
+        while True:
+            if pending is None:
+                pending = loop.create_task(iterator.__anext__(), context=ctx)
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if done:
+                step, pending = pending, None
+                try:
+                    frame = step.result()
+                except StopAsyncIteration:
+                    break
+                buffer.append(frame)
+                buffered += len(frame)
+                if deadline is None:
+                    deadline = loop.time() + flush_interval
+                if flush_bytes is None or buffered < flush_bytes:
+                    continue
+            yield b"".join(buffer)
+            buffer.clear()
+            buffered = 0
+            deadline = None
+        if buffer:
+            yield b"".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,479 @@
+"""Tool-calling ResponsesAgents that stream chat completions and run tools concurrently.
+
+`ToolCallingAgent` runs on the server's sync thread pool and `AsyncToolCallingAgent` on its
+event loop. agent.py configures one of them with an LLM endpoint and tools.
+"""
+
+import asyncio
+import functools
+import inspect
+import json
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Callable, Generator, Optional
+from uuid import uuid4
+
+import httpx
+import mlflow
+from databricks.sdk import WorkspaceClient
+from databricks.sdk.config import Config
+from mlflow.entities import SpanType
+from mlflow.pyfunc import ResponsesAgent
+from mlflow.types.responses import (
+    ResponsesAgentRequest,
+    ResponsesAgentResponse,
+    ResponsesAgentStreamEvent,
+)
+from openai import AsyncOpenAI, OpenAI
+from openai.types.chat import ChatCompletionChunk
+from pydantic import BaseModel
+
+from agent_server.accumulator import StreamAccumulator
+from agent_server.cancellation import raise_if_cancelled
+from agent_server.completion_cache import CompletionCache
+from agent_server.context import ContextWindow
+from agent_server.messages import TOOL_CALL_CONTENT, to_chat_messages
+from agent_server.tools import ToolResultCache, ToolRunner
+
+
+class ToolInfo(BaseModel):
+    """
+    Class representing a tool for the agent.
+    - "name" (str): The name of the tool.
+    - "spec" (dict): JSON description of the tool (matches OpenAI Responses format)
+    - "exec_fn" (Callable): Function that implements the tool logic
+    - "cacheable" (bool): Whether results can be reused for identical arguments. Only enable
+      this for deterministic tools.
+    - "cache_ttl" (float | None): Seconds a cached result stays valid, or None for no expiry
+    - "cache_max_entries" (int): Number of results kept before evicting the least recently used
+    - "timeout" (float | None): Seconds a call may run before the request fails with
+      ToolTimeoutError, or None for no limit
+    """
+
+    name: str
+    spec: dict
+    exec_fn: Callable
+    cacheable: bool = False
+    cache_ttl: Optional[float] = 300.0
+    cache_max_entries: int = 256
+    timeout: Optional[float] = None
+
+
+@functools.cache
+def get_model_serving_client() -> OpenAI:
+    """
+    Returns the process-wide model serving client. It is created once and shared by all
+    requests; its connection pool keeps connections alive and it is safe to use from the
+    server's sync worker threads.
+    """
+    return WorkspaceClient().serving_endpoints.get_open_ai_client()
+
+
+@dataclass
+class ConversationContext:
+    """
+    Per-request conversation state, in completion-message format. The messages are sent to the
+    LLM as-is, so they are only ever appended to, never re-converted.
+    """
+
+    messages: list[dict[str, Any]] = field(default_factory=list)
+    # Tool calls started while the LLM response was still streaming, by call id
+    started_tool_calls: dict[str, Any] = field(default_factory=dict)
+
+
+class ToolCallingAgent(ResponsesAgent):
+    """
+    Class representing a tool-calling Agent
+
+    The agent holds no per-request state: each request gets its own ConversationContext, so a
+    single instance can run many agent loops concurrently.
+    """
+
+    def __init__(
+        self,
+        llm_endpoint: str,
+        tools: list[ToolInfo],
+        model_serving_client: Optional[OpenAI] = None,
+        tool_runner: Optional[ToolRunner] = None,
+        context_window: Optional[ContextWindow] = None,
+        completion_cache: Optional[CompletionCache] = None,
+        system_prompt: Optional[str] = None,
+    ):
+        """Initializes the ToolCallingAgent with tools."""
+        self.llm_endpoint = llm_endpoint
+        self.model_serving_client: OpenAI = model_serving_client or get_model_serving_client()
+        # Runs the tool calls of a turn concurrently, shared by all requests
+        self.tool_runner = tool_runner or ToolRunner()
+        self._tools_dict = {tool.name: tool for tool in tools}
+        self._tool_caches = self._create_tool_caches(tools)
+        self.context_window = context_window
+        self.completion_cache = completion_cache
+        self.system_prompt = system_prompt
+
+    @staticmethod
+    def _create_tool_caches(tools: list[ToolInfo]) -> dict[str, ToolResultCache]:
+        """Result caches shared by all requests, for tools declared cacheable"""
+        return {
+            tool.name: ToolResultCache(tool.name, tool.cache_max_entries, tool.cache_ttl)
+            for tool in tools
+            if tool.cacheable
+        }
+
+    def get_tool_specs(self) -> list[dict]:
+        """Returns tool specifications in the format OpenAI expects."""
+        return [tool_info.spec for tool_info in self._tools_dict.values()]
+
+    @mlflow.trace(span_type=SpanType.TOOL)
+    def execute_tool(self, tool_name: str, args: dict) -> Any:
+        """Executes the specified tool with the given arguments."""
+        exec_fn = self._tools_dict[tool_name].exec_fn
+        if (cache := self._tool_caches.get(tool_name)) is not None:
+            return cache.get_or_call(args, functools.partial(exec_fn, **args))
+        return exec_fn(**args)
+
+    def prep_msgs_for_llm(self, messages: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """
+        Convert Responses API items to ChatCompletion messages. Each request's input is
+        converted once; messages added during the agent loop are already in this format.
+        """
+        return to_chat_messages(messages)
+
+    def _llm_messages(self, ctx: ConversationContext) -> list[dict[str, Any]]:
+        """The history to send to the LLM, trimmed to the context window if one is set"""
+        if self.context_window is None:
+            return ctx.messages
+        return self.context_window.fit(ctx.messages, self.get_tool_specs())
+
+    def _create_completion(
+        self, messages: list[dict[str, Any]], tools: list[dict]
+    ) -> Generator[ChatCompletionChunk, None, None]:
+        # The context manager closes the connection if the request is abandoned mid-stream
+        with self.model_serving_client.chat.completions.create(
+            model=self.llm_endpoint, messages=messages, tools=tools, stream=True
+        ) as stream:
+            yield from stream
+
+    def call_llm(self, ctx: ConversationContext) -> Generator[ChatCompletionChunk, None, None]:
+        messages = self._llm_messages(ctx)
+        tools = self.get_tool_specs()
+        create = functools.partial(self._create_completion, messages, tools)
+        if self.completion_cache is None:
+            return create()
+        key = self.completion_cache.key(self.llm_endpoint, messages, tools)
+        return self.completion_cache.stream(key, create)
+
+    def _tool_call_to_run(self, tool_call: dict[str, Any]) -> Callable[[], Any]:
+        return functools.partial(
+            self.execute_tool,
+            tool_name=tool_call["function"]["name"],
+            args=json.loads(tool_call["function"]["arguments"] or "{}"),
+        )
+
+    def _start(self, tool_call: dict[str, Any]) -> Future:
+        timeout = self._tools_dict[tool_call["function"]["name"]].timeout
+        return self.tool_runner.start(self._tool_call_to_run(tool_call), timeout)
+
+    def start_tool_call(self, ctx: ConversationContext, tool_call: dict[str, Any]) -> None:
+        """Start a tool call as soon as its arguments have streamed, while the LLM keeps going"""
+        ctx.started_tool_calls[tool_call["id"]] = self._start(tool_call)
+
+    def handle_tool_calls(
+        self, ctx: ConversationContext, tool_calls: list[dict[str, Any]]
+    ) -> Generator[ResponsesAgentStreamEvent, None, None]:
+        """
+        Execute tool calls concurrently, yield a ResponsesStreamEvent w/ each tool output as it
+        completes, and add the outputs to the running message history in call order
+        """
+        # Most calls were started during the LLM stream; start the rest, e.g. calls from the input
+        started = [
+            ctx.started_tool_calls.pop(tool_call["id"], None) or self._start(tool_call)
+            for tool_call in tool_calls
+        ]
+        results = [None] * len(tool_calls)
+        for index, result in self.tool_runner.results(started):
+            # Cast tool result to a string, since not all tools return as tring
+            results[index] = str(result)
+            yield ResponsesAgentStreamEvent(
+                type="response.output_item.done",
+                item=self.create_function_call_output_item(
+                    tool_calls[index]["id"],
+                    results[index],
+                ),
+            )
+        ctx.messages.extend(
+            {"role": "tool", "content": result, "tool_call_id": tool_call["id"]}
+            for tool_call, result in zip(tool_calls, results)
+        )
+
+    def _end_llm_turn(
+        self,
+        ctx: ConversationContext,
+        llm_content: str,
+        tool_calls: list[dict[str, Any]],
+        msg_id: Optional[str],
+    ) -> list[ResponsesAgentStreamEvent]:
+        """Add the aggregated LLM output to the history and return its `output_item.done` events"""
+        # Append the message in the exact form sent to the LLM on the next turn
+        content = llm_content if llm_content or not tool_calls else TOOL_CALL_CONTENT
+        llm_output = {"role": "assistant", "content": content, "tool_calls": tool_calls}
+        ctx.messages.append(llm_output)
+
+        events = []
+        # yield an `output_item.done` `output_text` event that aggregates the stream
+        # this enables tracing and payload logging
+        if llm_content:
+            events.append(
+                ResponsesAgentStreamEvent(
+                    type="response.output_item.done",
+                    item=self.create_text_output_item(llm_content, msg_id),
+                )
+            )
+        # yield an `output_item.done` `function_call` event for each tool call
+        for tool_call in tool_calls:
+            events.append(
+                ResponsesAgentStreamEvent(
+                    type="response.output_item.done",
+                    item=self.create_function_call_item(
+                        str(uuid4()),
+                        tool_call["id"],
+                        tool_call["function"]["name"],
+                        tool_call["function"]["arguments"],
+                    ),
+                )
+            )
+        return events
+
+    def _max_iterations_event(self) -> ResponsesAgentStreamEvent:
+        return ResponsesAgentStreamEvent(
+            type="response.output_item.done",
+            item=self.create_text_output_item("Max iterations reached. Stopping.", str(uuid4())),
+        )
+
+    def call_and_run_tools(
+        self,
+        ctx: ConversationContext,
+        max_iter: int = 10,
+    ) -> Generator[ResponsesAgentStreamEvent, None, None]:
+        try:
+            for _ in range(max_iter):
+                last_msg = ctx.messages[-1]
+                if tool_calls := last_msg.get("tool_calls", None):
+                    yield from self.handle_tool_calls(ctx, tool_calls)
+                elif last_msg.get("role", None) == "assistant":
+                    return
+                else:
+                    # aggregate the chat completions stream to add to internal state, starting
+                    # each tool call as soon as its arguments are complete
+                    stream = StreamAccumulator(functools.partial(self.start_tool_call, ctx))
+                    for chunk in self.call_llm(ctx):
+                        # Threads can't be cancelled; stop once the request is abandoned
+                        raise_if_cancelled()
+                        if (content := stream.add(chunk)) is not None:
+                            yield ResponsesAgentStreamEvent(
+                                **self.create_text_delta(content, item_id=stream.id)
+                            )
+                    yield from self._end_llm_turn(
+                        ctx, stream.text, stream.tool_calls(), stream.id
+                    )
+
+            yield self._max_iterations_event()
+        finally:
+            # Calls started for a response that failed or was abandoned
+            for started in ctx.started_tool_calls.values():
+                started.cancel()
+
+    def _create_context(self, request: ResponsesAgentRequest) -> ConversationContext:
+        ctx = ConversationContext(self.prep_msgs_for_llm([i.model_dump() for i in request.input]))
+        if self.system_prompt:
+            ctx.messages.insert(0, {"role": "system", "content": self.system_prompt})
+        return ctx
+
+    def predict(self, request: ResponsesAgentRequest) -> ResponsesAgentResponse:
+        outputs = [
+            event.item
+            for event in self.predict_stream(request)
+            if event.type == "response.output_item.done"
+        ]
+        return ResponsesAgentResponse(output=outputs, custom_outputs=request.custom_inputs)
+
+    def predict_stream(
+        self, request: ResponsesAgentRequest
+    ) -> Generator[ResponsesAgentStreamEvent, None, None]:
+        yield from self.call_and_run_tools(self._create_context(request))
+
+
+class DatabricksAuth(httpx.Auth):
+    """
+    Authenticates each request with the workspace credentials, refreshing them as needed.
+    A refresh can block on the network, so async clients run it in a worker thread.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+
+    def sync_auth_flow(self, request: httpx.Request):
+        request.headers.update(self.config.authenticate())
+        yield request
+
+    async def async_auth_flow(self, request: httpx.Request):
+        request.headers.update(await asyncio.to_thread(self.config.authenticate))
+        yield request
+
+
+@functools.cache
+def get_async_model_serving_client() -> AsyncOpenAI:
+    """
+    Returns the process-wide async model serving client. Every request on the event loop
+    shares its pool of keep-alive connections to the serving endpoint.
+    """
+    config = WorkspaceClient().config
+    return AsyncOpenAI(
+        base_url=config.host + "/serving-endpoints",
+        api_key="no-token",  # requests are authenticated by DatabricksAuth
+        http_client=httpx.AsyncClient(
+            auth=DatabricksAuth(config),
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=200),
+            timeout=httpx.Timeout(600.0, connect=10.0),
+        ),
+    )
+
+
+class AsyncToolCallingAgent(ToolCallingAgent):
+    """
+    Async variant of ToolCallingAgent
+
+    LLM calls stream through the async client and tools run as tasks on the event loop
+    (synchronous tools in a worker thread), so one process can serve thousands of concurrent
+    streams without a thread per request.
+    """
+
+    def __init__(
+        self,
+        llm_endpoint: str,
+        tools: list[ToolInfo],
+        model_serving_client: Optional[AsyncOpenAI] = None,
+        tool_runner: Optional[ToolRunner] = None,
+        context_window: Optional[ContextWindow] = None,
+        completion_cache: Optional[CompletionCache] = None,
+        system_prompt: Optional[str] = None,
+    ):
+        """Initializes the AsyncToolCallingAgent with tools."""
+        super().__init__(
+            llm_endpoint,
+            tools,
+            model_serving_client=model_serving_client or get_async_model_serving_client(),
+            tool_runner=tool_runner,
+            context_window=context_window,
+            completion_cache=completion_cache,
+            system_prompt=system_prompt,
+        )
+
+    @mlflow.trace(span_type=SpanType.TOOL)
+    async def execute_tool(self, tool_name: str, args: dict) -> Any:
+        """Executes the specified tool with the given arguments."""
+        exec_fn = self._tools_dict[tool_name].exec_fn
+        if inspect.iscoroutinefunction(exec_fn):
+            call = functools.partial(exec_fn, **args)
+        else:
+            call = functools.partial(asyncio.to_thread, exec_fn, **args)
+        if (cache := self._tool_caches.get(tool_name)) is not None:
+            return await cache.aget_or_call(args, call)
+        return await call()
+
+    def _start(self, tool_call: dict[str, Any]) -> asyncio.Task:
+        timeout = self._tools_dict[tool_call["function"]["name"]].timeout
+        return self.tool_runner.astart(self._tool_call_to_run(tool_call), timeout)
+
+    async def _create_completion(
+        self, messages: list[dict[str, Any]], tools: list[dict]
+    ) -> AsyncGenerator[ChatCompletionChunk, None]:
+        # The context manager closes the connection if the request is abandoned mid-stream
+        async with await self.model_serving_client.chat.completions.create(
+            model=self.llm_endpoint, messages=messages, tools=tools, stream=True
+        ) as stream:
+            async for chunk in stream:
+                yield chunk
+
+    def call_llm(self, ctx: ConversationContext) -> AsyncGenerator[ChatCompletionChunk, None]:
+        messages = self._llm_messages(ctx)
+        tools = self.get_tool_specs()
+        create = functools.partial(self._create_completion, messages, tools)
+        if self.completion_cache is None:
+            return create()
+        key = self.completion_cache.key(self.llm_endpoint, messages, tools)
+        return self.completion_cache.astream(key, create)
+
+    async def handle_tool_calls(
+        self, ctx: ConversationContext, tool_calls: list[dict[str, Any]]
+    ) -> AsyncGenerator[ResponsesAgentStreamEvent, None]:
+        """
+        Execute tool calls concurrently, yield a ResponsesStreamEvent w/ each tool output as it
+        completes, and add the outputs to the running message history in call order
+        """
+        # Most calls were started during the LLM stream; start the rest, e.g. calls from the input
+        started = [
+            ctx.started_tool_calls.pop(tool_call["id"], None) or self._start(tool_call)
+            for tool_call in tool_calls
+        ]
+        results = [None] * len(tool_calls)
+        async for index, result in self.tool_runner.aresults(started):
+            # Cast tool result to a string, since not all tools return as tring
+            results[index] = str(result)
+            yield ResponsesAgentStreamEvent(
+                type="response.output_item.done",
+                item=self.create_function_call_output_item(
+                    tool_calls[index]["id"],
+                    results[index],
+                ),
+            )
+        ctx.messages.extend(
+            {"role": "tool", "content": result, "tool_call_id": tool_call["id"]}
+            for tool_call, result in zip(tool_calls, results)
+        )
+
+    async def call_and_run_tools(
+        self,
+        ctx: ConversationContext,
+        max_iter: int = 10,
+    ) -> AsyncGenerator[ResponsesAgentStreamEvent, None]:
+        try:
+            for _ in range(max_iter):
+                last_msg = ctx.messages[-1]
+                if tool_calls := last_msg.get("tool_calls", None):
+                    async for event in self.handle_tool_calls(ctx, tool_calls):
+                        yield event
+                elif last_msg.get("role", None) == "assistant":
+                    return
+                else:
+                    # aggregate the chat completions stream to add to internal state, starting
+                    # each tool call as soon as its arguments are complete
+                    stream = StreamAccumulator(functools.partial(self.start_tool_call, ctx))
+                    async for chunk in self.call_llm(ctx):
+                        if (content := stream.add(chunk)) is not None:
+                            yield ResponsesAgentStreamEvent(
+                                **self.create_text_delta(content, item_id=stream.id)
+                            )
+                    for event in self._end_llm_turn(
+                        ctx, stream.text, stream.tool_calls(), stream.id
+                    ):
+                        yield event
+
+            yield self._max_iterations_event()
+        finally:
+            # Calls started for a response that failed or was abandoned
+            for started in ctx.started_tool_calls.values():
+                started.cancel()
+
+    async def predict(self, request: ResponsesAgentRequest) -> ResponsesAgentResponse:
+        outputs = [
+            event.item
+            async for event in self.predict_stream(request)
+            if event.type == "response.output_item.done"
+        ]
+        return ResponsesAgentResponse(output=outputs, custom_outputs=request.custom_inputs)
+
+    async def predict_stream(
+        self, request: ResponsesAgentRequest
+    ) -> AsyncGenerator[ResponsesAgentStreamEvent, None]:
+        async for event in self.call_and_run_tools(self._create_context(request)):
+            yield event
@@ -0,0 +1,510 @@
+import asyncio
+import inspect
+import io
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Any, Callable, Generator, Literal, Optional, Union
+
+import mlflow
+from mlflow.entities import LiveSpan, SpanStatusCode
+from mlflow.tracing.provider import detach_span_from_context, set_span_in_context
+from mlflow.types.responses import ResponsesAgentResponse
+
+from agent_server import serialization
+
+DropPolicy = Literal["drop", "block"]
+
+
+class StreamOutputReducer:
+    """Folds stream chunks into the span output as they arrive.
+
+    For agent/v1/responses only `response.output_item.done` items are kept, so memory per stream
+    grows with the output rather than with the number of events. Text deltas are aggregated
+    until their item completes; if it never does (e.g. the stream failed midway) the text is
+    output as a message of its own. Other agent types keep the chunks themselves. At most
+    `max_items` items are output, counting those messages; the rest are counted in
+    `dropped_items`.
+    """
+
+    def __init__(self, agent_type: Optional[str] = None, max_items: Optional[int] = 1000):
+        self.agent_type = agent_type
+        self.max_items = max_items
+        self.chunk_count = 0
+        self._dropped = 0
+        self._items: list[Any] = []
+        self._pending_text: dict[Optional[str], io.StringIO] = {}
+
+    @property
+    def dropped_items(self) -> int:
+        if self.max_items is None:
+            return self._dropped
+        # _items never exceeds max_items, so pending text past the cap is dropped from output()
+        return self._dropped + max(0, len(self._items) + len(self._pending_text) - self.max_items)
+
+    def _keep(self, item: Any) -> None:
+        if self.max_items is not None and len(self._items) >= self.max_items:
+            self._dropped += 1
+        else:
+            self._items.append(item)
+
+    def _complete_text(self, item: Any) -> None:
+        """Discard the pending delta text that a completed item carries"""
+        if not isinstance(item, dict):
+            return
+        if self._pending_text.pop(item.get("id"), None) is not None or not self._pending_text:
+            return
+        # The deltas may use another id than the done item (or none); match them on the text
+        if item.get("type") != "message" or not isinstance(item.get("content"), list):
+            return
+        text = "".join(
+            part.get("text") or ""
+            for part in item["content"]
+            if isinstance(part, dict) and part.get("type") == "output_text"
+        )
+        for item_id, pending in self._pending_text.items():
+            if pending.getvalue() == text:
+                del self._pending_text[item_id]
+                return
+
+    def add(self, chunk: dict) -> None:
+        self.chunk_count += 1
+        if self.agent_type != "agent/v1/responses":
+            self._keep(chunk)
+            return
+
+        chunk_type = chunk.get("type")
+        if chunk_type == "response.output_item.done":
+            item = chunk.get("item")
+            self._complete_text(item)
+            self._keep(item)
+        elif chunk_type == "response.output_text.delta":
+            item_id = chunk.get("item_id")
+            if item_id not in self._pending_text:
+                self._pending_text[item_id] = io.StringIO()
+            self._pending_text[item_id].write(chunk.get("delta") or "")
+
+    def output(self) -> Any:
+        """The span output for the chunks seen so far"""
+        if self.agent_type != "agent/v1/responses":
+            return list(self._items)
+
+        items = list(self._items)
+        # Text that never got an output_item.done, within what is left of max_items
+        pending = list(self._pending_text.items())
+        if self.max_items is not None:
+            pending = pending[: max(0, self.max_items - len(items))]
+        for item_id, text in pending:
+            items.append(
+                {
+                    "type": "message",
+                    "role": "assistant",
+                    "id": item_id or "",
+                    "content": [{"type": "output_text", "text": text.getvalue()}],
+                }
+            )
+        return ResponsesAgentResponse(output=items).model_dump(exclude_none=True)
+
+
+@dataclass
+class RequestOutcome:
+    """What a tail sampling decision can look at once a request has completed"""
+
+    endpoint: str
+    duration_s: float
+    error: Optional[str] = None
+    return_trace: bool = False
+
+
+class TraceSampler:
+    """Decides which requests to /invocations are traced.
+
+    `sample_head` runs before the agent is called: True traces the request with its payloads,
+    False traces nothing for the request, including spans the agent or autologging would
+    start inside it (on MLflow versions without `mlflow.tracing.context(enabled=...)` those
+    still become traces of their own), and None defers to `sample_tail`, which runs after
+    completion and decides whether the span keeps its inputs and outputs. Subclass to plug in
+    a custom policy; the base class traces everything.
+    """
+
+    def sample_head(self, request: dict, return_trace: bool) -> Optional[bool]:
+        return True
+
+    def sample_tail(self, outcome: RequestOutcome) -> bool:
+        return True
+
+
+class RatioTraceSampler(TraceSampler):
+    """Traces a `ratio` of requests, plus every failed, slow or return_trace request.
+
+    Requests outside the ratio still get a span when errors or latency can promote them, but
+    its payloads are only recorded if the request failed (`always_on_error`) or took at least
+    `latency_threshold_s`.
+    """
+
+    def __init__(
+        self,
+        ratio: float = 1.0,
+        always_on_error: bool = True,
+        always_on_return_trace: bool = True,
+        latency_threshold_s: Optional[float] = None,
+        seed: Optional[int] = None,
+    ):
+        self.ratio = ratio
+        self.always_on_error = always_on_error
+        self.always_on_return_trace = always_on_return_trace
+        self.latency_threshold_s = latency_threshold_s
+        self._random = random.Random(seed)
+
+    def sample_head(self, request: dict, return_trace: bool) -> Optional[bool]:
+        if return_trace and self.always_on_return_trace:
+            return True
+        if self._random.random() < self.ratio:
+            return True
+        if self.always_on_error or self.latency_threshold_s is not None:
+            return None
+        return False
+
+    def sample_tail(self, outcome: RequestOutcome) -> bool:
+        if outcome.error is not None and self.always_on_error:
+            return True
+        return (
+            self.latency_threshold_s is not None
+            and outcome.duration_s >= self.latency_threshold_s
+        )
+
+
+def truncate_payload(payload: Any, max_chars: int) -> Any:
+    """Replace payloads whose JSON form exceeds max_chars with a truncated preview"""
+    try:
+        encoded = serialization.dumps(payload)
+    except TypeError:
+        return payload
+    if len(encoded) <= max_chars:
+        return payload
+    return {
+        "truncated": True,
+        "size": len(encoded),
+        "preview": encoded[:max_chars].decode("utf-8", errors="ignore"),
+    }
+
+
+def _tracing_disabled():
+    """Context in which MLflow starts no spans, where the installed MLflow supports it"""
+    context = getattr(mlflow.tracing, "context", None)
+    if context is None or "enabled" not in inspect.signature(context).parameters:
+        return nullcontext()
+    return context(enabled=False)
+
+
+@contextmanager
+def start_deferred_span(
+    name: str, enabled: bool = True
+) -> Generator[Optional[LiveSpan], None, None]:
+    """Start a span that is active for the duration of the block but is not ended by it.
+
+    The caller ends the span with a `PendingSpan`, which lets finalization (payload
+    serialization, span end, export) happen after the response has been sent. When `enabled`
+    is False it yields None and tracing is turned off for the block, so spans started inside
+    it don't become root traces of their own.
+    """
+    if not enabled:
+        with _tracing_disabled():
+            yield None
+        return
+    span = mlflow.start_span_no_context(name, parent_span=mlflow.get_current_active_span())
+    token = set_span_in_context(span) if isinstance(span, LiveSpan) else None
+    try:
+        yield span
+    finally:
+        if token is not None:
+            detach_span_from_context(token)
+
+
+@dataclass
+class PendingSpan:
+    """Everything needed to finalize a span started with `start_deferred_span`.
+
+    `outputs` may be a zero-argument callable, evaluated when the payloads are recorded.
+    Payloads larger than `max_payload_chars` of JSON are truncated. Without a span (the
+    request was not sampled) finishing is a no-op.
+    """
+
+    span: Optional[LiveSpan]
+    inputs: Any = None
+    outputs: Union[Any, Callable[[], Any]] = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+    max_payload_chars: Optional[int] = None
+    end_time_ns: int = field(default_factory=time.time_ns)
+    _recorded: bool = field(default=False, init=False, repr=False)
+
+    @property
+    def status(self) -> str:
+        return SpanStatusCode.ERROR if self.error is not None else SpanStatusCode.OK
+
+    def drop_payloads(self) -> None:
+        """Keep the span but do not record its inputs and outputs"""
+        self.inputs = None
+        self.outputs = None
+        self.attributes["payloads_sampled_out"] = True
+
+    def record(self) -> None:
+        """Set the payloads and attributes on the span (once)"""
+        if self._recorded or self.span is None:
+            return
+        if callable(self.outputs):
+            self.outputs = self.outputs()
+        if self.error is not None:
+            self.outputs = f"Error: {self.error}"
+        if self.max_payload_chars is not None:
+            self.inputs = truncate_payload(self.inputs, self.max_payload_chars)
+            self.outputs = truncate_payload(self.outputs, self.max_payload_chars)
+        if self.inputs is not None:
+            self.span.set_inputs(self.inputs)
+        if self.outputs is not None:
+            self.span.set_outputs(self.outputs)
+        self.span.set_attributes(self.attributes)
+        self._recorded = True
+
+    def finish(self) -> Optional[dict]:
+        """Record payloads, end the span and return a summary record for trace sinks"""
+        if self.span is None:
+            return None
+        self.record()
+        self.span.end(status=self.status, end_time_ns=self.end_time_ns)
+        return {
+            "trace_id": self.span.trace_id,
+            "name": self.span.name,
+            "status": self.status.value,
+            "start_time_ns": self.span.start_time_ns,
+            "end_time_ns": self.end_time_ns,
+            "attributes": self.attributes,
+            "inputs": self.inputs,
+            "outputs": self.outputs,
+        }
+
+    def drop(self) -> None:
+        """End the span without recording payloads, e.g. when the export queue is full"""
+        if self.span is None:
+            return
+        self.span.end(
+            attributes={**self.attributes, "payload_dropped": True},
+            status=self.status,
+            end_time_ns=self.end_time_ns,
+        )
+
+
+class TraceSink(ABC):
+    """Destination for finished span records, written in batches by the TraceExporter"""
+
+    @abstractmethod
+    def export(self, records: list[dict]) -> None: ...
+
+    def close(self) -> None:
+        pass
+
+
+class InMemoryTraceSink(TraceSink):
+    """Keeps the most recent `max_records` records in memory, e.g. for tests"""
+
+    def __init__(self, max_records: Optional[int] = 10000):
+        self.records: deque[dict] = deque(maxlen=max_records)
+
+    def export(self, records: list[dict]) -> None:
+        self.records.extend(records)
+
+
+class JsonlTraceSink(TraceSink):
+    """Appends records to a local JSON Lines file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, records: list[dict]) -> None:
+        for record in records:
+            self._file.write(json.dumps(record, default=str) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class TraceExporter:
+    """Finalizes and exports request spans on a background thread.
+
+    Spans are queued in a bounded queue and finished in batches of up to `max_batch_size`;
+    ending a span hands it to MLflow's configured trace destination, and the batch's records
+    are written to `sinks`. When the queue is full, the "drop" policy ends the span right away
+    without its payloads, while "block" waits up to `block_timeout` seconds for room first.
+    """
+
+    def __init__(
+        self,
+        sinks: Optional[list[TraceSink]] = None,
+        max_queue_size: int = 1000,
+        max_batch_size: int = 64,
+        flush_interval: float = 1.0,
+        drop_policy: DropPolicy = "drop",
+        block_timeout: float = 1.0,
+    ):
+        self.sinks = sinks or []
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.drop_policy = drop_policy
+        self.block_timeout = block_timeout
+        # Called with the seconds spent finishing each span, e.g. to feed a latency histogram
+        self.on_span_exported: Optional[Callable[[float], None]] = None
+        self.logger = logging.getLogger(__name__)
+        self._queue: queue.Queue[Optional[PendingSpan]] = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._exported = 0
+        self._dropped = 0
+        self._failed = 0
+        self._batches = 0
+        self._export_seconds = 0.0
+        self._worker = threading.Thread(
+            target=self._run, name="agent-server-trace-exporter", daemon=True
+        )
+        self._worker.start()
+
+    def _count(self, name: str, value: Union[int, float] = 1) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    async def submit(self, pending: PendingSpan) -> bool:
+        """Queue a span for finalization. Returns False if it was dropped."""
+        self._count("_submitted")
+        try:
+            self._queue.put_nowait(pending)
+            return True
+        except queue.Full:
+            pass
+
+        if self.drop_policy == "block":
+            # Waits in a thread, so the event loop keeps serving other requests meanwhile
+            return await asyncio.to_thread(self._put_or_drop, pending, self.block_timeout)
+        return self._put_or_drop(pending, None)
+
+    def _put_or_drop(self, pending: PendingSpan, timeout: Optional[float]) -> bool:
+        """Queue the span, waiting up to `timeout` seconds for room (not at all if None)"""
+        try:
+            if timeout is None:
+                self._queue.put_nowait(pending)
+            else:
+                self._queue.put(pending, timeout=timeout)
+            return True
+        except queue.Full:
+            self._count("_dropped")
+            pending.drop()
+            return False
+
+    def _drain(self) -> None:
+        """End every queued span without its payloads"""
+        while True:
+            try:
+                pending = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if pending is not None:
+                self._count("_dropped")
+                pending.drop()
+
+    def _stop_worker(self) -> None:
+        """Drop what is queued and queue the sentinel in its place"""
+        while True:
+            self._drain()
+            try:
+                self._queue.put_nowait(None)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self) -> None:
+        while True:
+            try:
+                pending = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            stop = pending is None
+            if pending is not None:
+                batch.append(pending)
+            while not stop and len(batch) < self.max_batch_size:
+                try:
+                    pending = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stop = True
+                else:
+                    batch.append(pending)
+            if batch:
+                self._export(batch)
+            if stop:
+                return
+
+    def _export(self, batch: list[PendingSpan]) -> None:
+        start = time.perf_counter()
+        records = []
+        for pending in batch:
+            span_start = time.perf_counter()
+            try:
+                if (record := pending.finish()) is not None:
+                    records.append(record)
+                if self.on_span_exported is not None:
+                    self.on_span_exported(time.perf_counter() - span_start)
+            except Exception as e:
+                self._count("_failed")
+                self.logger.warning("Failed to finalize span", extra={"error": str(e)})
+        for sink in self.sinks:
+            try:
+                sink.export(records)
+            except Exception as e:
+                self._count("_failed")
+                self.logger.warning(
+                    "Failed to export trace records",
+                    extra={"sink": type(sink).__name__, "error": str(e)},
+                )
+        with self._lock:
+            self._exported += len(records)
+            self._batches += 1
+            self._export_seconds += time.perf_counter() - start
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "submitted": self._submitted,
+                "exported": self._exported,
+                "dropped": self._dropped,
+                "failed": self._failed,
+                "batches": self._batches,
+                "export_seconds": self._export_seconds,
+            }
+
+    def shutdown(self, timeout: Optional[float] = 10.0) -> None:
+        """Finish everything still queued, then close the sinks.
+
+        Spans the worker hasn't finished within `timeout` seconds are ended without their
+        payloads instead.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            self._stop_worker()
+        self._worker.join(max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+        if self._worker.is_alive():
+            self._stop_worker()
+        for sink in self.sinks:
+            sink.close()
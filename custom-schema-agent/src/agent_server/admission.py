@@ -0,0 +1,123 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Optional
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; maps onto an HTTP error with Retry-After"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class AdmissionSlot:
+    """A granted slot. release() is idempotent so every exit path can call it."""
+
+    def __init__(self, controller: Optional["AdmissionController"], wait_s: float = 0.0):
+        self._controller = controller
+        self.wait_s = wait_s
+
+    def release(self) -> None:
+        controller, self._controller = self._controller, None
+        if controller is not None:
+            controller._release()
+
+
+class AdmissionController:
+    """Caps concurrent requests with a bounded FIFO wait queue.
+
+    Up to `max_in_flight` requests run at once. Further requests wait for a slot in a queue of
+    at most `max_queue` entries for up to `queue_timeout` seconds (no limit if None). A full
+    queue is rejected with 429 and a wait that times out with 503, both with `retry_after`.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        max_queue: int = 0,
+        queue_timeout: Optional[float] = None,
+        retry_after: float = 1.0,
+    ):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._admitted = 0
+        self._rejected_queue_full = 0
+        self._rejected_timeout = 0
+
+    async def acquire(self) -> AdmissionSlot:
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self._admitted += 1
+            return AdmissionSlot(self)
+
+        if len(self._waiters) >= self.max_queue:
+            self._rejected_queue_full += 1
+            raise AdmissionRejected(
+                429,
+                f"Server is at capacity ({self.in_flight} in flight, "
+                f"{len(self._waiters)} queued)",
+                self.retry_after,
+            )
+
+        start = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # A slot was handed over just as the wait ended; pass it on
+                self._release()
+            else:
+                waiter.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._rejected_timeout += 1
+            raise AdmissionRejected(
+                503,
+                f"Timed out after {self.queue_timeout}s waiting for capacity",
+                self.retry_after,
+            ) from None
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+        self._admitted += 1
+        return AdmissionSlot(self, time.perf_counter() - start)
+
+    def _release(self) -> None:
+        # Hand the slot straight to the oldest live waiter so in_flight never dips below the
+        # limit while others are queued
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "admitted": self._admitted,
+            "rejected_queue_full": self._rejected_queue_full,
+            "rejected_timeout": self._rejected_timeout,
+        }
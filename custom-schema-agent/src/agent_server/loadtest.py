@@ -0,0 +1,407 @@
+"""Load test for /invocations: concurrent requests, with latency, throughput and memory reports.
+
+Run with `python -m agent_server.loadtest [options]`. By default the server runs in-process with
+a synthetic agent, so the results measure the server itself; pass --agent-module to load a real
+agent, or --url to drive a server already listening on a local socket.
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from agent_server import serialization
+from agent_server.bench import synthetic_history
+
+# The /invocations request the in-process target sends; copied per request since the app
+# adds its own keys to the scope
+_SCOPE = {
+    "type": "http",
+    "asgi": {"version": "3.0", "spec_version": "2.3"},
+    "http_version": "1.1",
+    "method": "POST",
+    "scheme": "http",
+    "path": "/invocations",
+    "raw_path": b"/invocations",
+    "query_string": b"",
+    "root_path": "",
+    "client": ("127.0.0.1", 0),
+    "server": ("127.0.0.1", 80),
+}
+
+
+@dataclass
+class RequestResult:
+    kind: str
+    status: int
+    latency_s: float
+    # Streams only: time to the first event, and the gaps between consecutive events
+    ttfc_s: Optional[float] = None
+    gaps_s: list[float] = field(default_factory=list)
+
+
+def _measure(
+    kind: str, start: float, end: float, status: int, pieces: list[tuple[float, bytes]]
+) -> RequestResult:
+    """Build a RequestResult from the timestamped body pieces of one response"""
+    result = RequestResult(kind, status, end - start)
+    if kind != "stream":
+        return result
+    # An SSE event is complete once its blank line arrives; a piece can hold several events
+    event_times = [at for at, piece in pieces for _ in range(piece.count(b"\n\n"))]
+    if event_times:
+        result.ttfc_s = event_times[0] - start
+        result.gaps_s = [later - earlier for earlier, later in zip(event_times, event_times[1:])]
+    return result
+
+
+class InProcessTarget:
+    """Calls the ASGI app directly, timestamping each body message as the app sends it"""
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def post(self, body: bytes) -> tuple[int, list[tuple[float, bytes]]]:
+        status = 0
+        pieces = []
+        received = False
+        finished = asyncio.Event()
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await finished.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                if message.get("body"):
+                    pieces.append((time.perf_counter(), message["body"]))
+                if not message.get("more_body", False):
+                    finished.set()
+
+        headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ]
+        await self.app({**_SCOPE, "headers": headers}, receive, send)
+        finished.set()
+        return status, pieces
+
+    async def close(self) -> None:
+        pass
+
+
+class SocketTarget:
+    """Posts to a running server over HTTP, timestamping each body piece as it is read"""
+
+    def __init__(self, url: str, concurrency: int):
+        import httpx
+
+        self.client = httpx.AsyncClient(
+            base_url=url,
+            timeout=None,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        )
+
+    async def post(self, body: bytes) -> tuple[int, list[tuple[float, bytes]]]:
+        pieces = []
+        async with self.client.stream(
+            "POST", "/invocations", content=body, headers={"content-type": "application/json"}
+        ) as response:
+            async for piece in response.aiter_raw():
+                pieces.append((time.perf_counter(), piece))
+        return response.status_code, pieces
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def _rss_bytes(pid: int) -> Optional[int]:
+    """Resident set size of a process, or None where /proc isn't available"""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler:
+    """Samples the RSS of a process every `interval` seconds while a run is going"""
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.start = _rss_bytes(pid)
+        self.peak = self.start
+        self._task: Optional[asyncio.Task] = None
+
+    async def _sample(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            rss = _rss_bytes(self.pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def __enter__(self) -> "RssSampler":
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._task.cancel()
+
+    def stats(self) -> Optional[dict]:
+        end = _rss_bytes(self.pid)
+        if self.start is None or end is None:
+            return None
+        mb = 1024 * 1024
+        return {
+            "start_mb": round(self.start / mb, 1),
+            "peak_mb": round(max(self.peak, end) / mb, 1),
+            "end_mb": round(end / mb, 1),
+        }
+
+
+def _distribution(values: list[float]) -> Optional[dict]:
+    """Count, mean, nearest-rank percentiles and max of a list of seconds"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def percentile(p: float) -> float:
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": ordered[-1],
+    }
+
+
+def build_requests(args: argparse.Namespace, count: int) -> list[tuple[str, bytes]]:
+    """(kind, body) for each request of the run, serialized up front so the client's own JSON
+    work stays out of the measurements"""
+    rng = random.Random(args.seed)
+    seeds: list[Optional[dict]] = [None]
+    if args.input:
+        with open(args.input, "rb") as f:
+            seeds = [serialization.loads(line) for line in f if line.strip()]
+    history = synthetic_history(args.history_turns, args.payload_size)
+    text = "lorem ipsum " * (args.payload_size // 12)
+    requests = []
+    for i in range(count):
+        seed = seeds[i % len(seeds)]
+        request = dict(seed) if seed is not None else {"input": [{"role": "user", "content": text}]}
+        request.pop("stream", None)
+        request["input"] = history + list(request.get("input") or [])
+        kind = "stream" if rng.random() < args.stream_ratio else "invoke"
+        if kind == "stream":
+            request["stream"] = True
+        if rng.random() < args.return_trace_ratio:
+            request["databricks_options"] = {"return_trace": True}
+        requests.append((kind, serialization.dumps(request)))
+    return requests
+
+
+def register_synthetic_agent(chunks: int, chunk_delay: float) -> None:
+    """Register an async agent that streams `chunks` text deltas, `chunk_delay` seconds apart,
+    and answers invoke requests after the same total delay"""
+    from agent_server.server import invoke, stream
+
+    def message(text: str) -> dict:
+        return {
+            "type": "message",
+            "role": "assistant",
+            "id": "msg_loadtest",
+            "content": [{"type": "output_text", "text": text}],
+        }
+
+    @invoke()
+    async def synthetic_invoke(request: dict) -> dict:
+        await asyncio.sleep(chunks * chunk_delay)
+        return {"output": [message("token " * chunks)]}
+
+    @stream()
+    async def synthetic_stream(request: dict):
+        for _ in range(chunks):
+            await asyncio.sleep(chunk_delay)
+            yield {
+                "type": "response.output_text.delta",
+                "item_id": "msg_loadtest",
+                "delta": "token ",
+            }
+        yield {"type": "response.output_item.done", "item": message("token " * chunks)}
+
+
+async def _drive(target: Any, requests: list[tuple[str, bytes]], concurrency: int) -> list:
+    """Send every request with `concurrency` clients, each sending its next request as soon as
+    the previous response ends"""
+    pending = iter(requests)
+    results = []
+
+    async def client():
+        for kind, body in pending:
+            start = time.perf_counter()
+            try:
+                status, pieces = await target.post(body)
+            except Exception:
+                status, pieces = 0, []
+            results.append(_measure(kind, start, time.perf_counter(), status, pieces))
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _parse_option(option: str) -> tuple[str, Any]:
+    name, _, value = option.partition("=")
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+async def run(args: argparse.Namespace) -> dict:
+    """Run the load test described by args and return its report"""
+    server = None
+    if args.url:
+        target = SocketTarget(args.url, args.concurrency)
+        pid = args.server_pid
+    else:
+        from agent_server.server import create_server
+
+        if args.agent_module:
+            importlib.import_module(args.agent_module)
+        else:
+            register_synthetic_agent(args.chunks, args.chunk_delay)
+        server = create_server(args.agent_type, **dict(map(_parse_option, args.server_option)))
+        target = InProcessTarget(server.app)
+        pid = os.getpid()
+
+    requests = build_requests(args, args.warmup + args.requests)
+    try:
+        await _drive(target, requests[: args.warmup], args.concurrency)
+        rss = RssSampler(pid) if pid is not None else None
+        start = time.perf_counter()
+        if rss is not None:
+            with rss:
+                results = await _drive(target, requests[args.warmup :], args.concurrency)
+        else:
+            results = await _drive(target, requests[args.warmup :], args.concurrency)
+        duration = time.perf_counter() - start
+    finally:
+        await target.close()
+        if server is not None:
+            server.sync_executor.shutdown()
+
+    status_codes: dict[str, int] = {}
+    for result in results:
+        status_codes[str(result.status)] = status_codes.get(str(result.status), 0) + 1
+    ok = [result for result in results if result.status == 200]
+    streams = [result for result in ok if result.kind == "stream"]
+    return {
+        "commit": _git_commit(),
+        "target": args.url or "in-process",
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "url", "server_pid")
+        },
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "status_codes": status_codes,
+        "duration_s": duration,
+        "throughput_rps": len(results) / duration if duration else 0.0,
+        "latency_s": {
+            kind: _distribution([r.latency_s for r in ok if kind in ("all", r.kind)])
+            for kind in ("all", "invoke", "stream")
+        },
+        "ttfc_s": _distribution([r.ttfc_s for r in streams if r.ttfc_s is not None]),
+        "inter_chunk_gap_s": _distribution([gap for r in streams for gap in r.gaps_s]),
+        "rss": rss.stats() if rss is not None else None,
+    }
+
+
+def _print_report(report: dict) -> None:
+    print(
+        f"{report['target']}: {report['requests']} requests ({report['errors']} errors) "
+        f"in {report['duration_s']:.2f}s, {report['throughput_rps']:.1f} requests/s"
+    )
+    rows = {f"latency {kind}": dist for kind, dist in report["latency_s"].items()}
+    rows["time to first chunk"] = report["ttfc_s"]
+    rows["inter-chunk gap"] = report["inter_chunk_gap_s"]
+    for name, dist in rows.items():
+        if dist is None:
+            continue
+        print(
+            f"  {name:<20} p50 {dist['p50'] * 1000:>9.2f} ms  p95 {dist['p95'] * 1000:>9.2f} ms"
+            f"  p99 {dist['p99'] * 1000:>9.2f} ms  max {dist['max'] * 1000:>9.2f} ms"
+        )
+    if report["rss"] is not None:
+        rss = report["rss"]
+        print(
+            f"  {'rss':<20} start {rss['start_mb']} MB  peak {rss['peak_mb']} MB"
+            f"  end {rss['end_mb']} MB"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Base URL of a running server, e.g. http://127.0.0.1:8000")
+    parser.add_argument("--server-pid", type=int, help="PID of the --url server, to report RSS")
+    parser.add_argument("--agent-module", help="Module registering the agent to run in-process")
+    parser.add_argument("--agent-type", default="agent/v1/responses")
+    parser.add_argument(
+        "--server-option",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="AgentServer keyword argument for the in-process server; VALUE is parsed as JSON",
+    )
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--stream-ratio", type=float, default=0.5)
+    parser.add_argument("--return-trace-ratio", type=float, default=0.0)
+    parser.add_argument("--history-turns", type=int, default=0)
+    parser.add_argument("--payload-size", type=int, default=200, help="Characters per text item")
+    parser.add_argument("--input", help="JSONL file of requests to cycle through")
+    parser.add_argument("--chunks", type=int, default=20, help="Synthetic agent stream length")
+    parser.add_argument("--chunk-delay", type=float, default=0.001)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    _print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import asyncio
+import contextvars
+import threading
+import time
+from typing import AsyncGenerator, AsyncIterator, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+DEADLINE_EXCEEDED = "deadline exceeded"
+CLIENT_DISCONNECTED = "client disconnected"
+
+
+class RequestCancelled(Exception):
+    """Raised in agent code once its request is abandoned, so the remaining work is skipped"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Request cancelled: {reason}")
+        self.reason = reason
+
+
+class CancelToken:
+    """Cancellation state of one request: set when the client disconnects or its deadline passes.
+
+    Async agents are cancelled directly; the token lets synchronous agent code running in
+    worker threads notice, via raise_if_cancelled() or add_callback().
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.reason: Optional[str] = None
+        self._lock = threading.Lock()
+        self._callbacks: list[Callable[[], None]] = []
+
+    def cancel(self, reason: str) -> None:
+        """Cancel with `reason`; only the first call has an effect"""
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    @property
+    def cancelled(self) -> bool:
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel(DEADLINE_EXCEEDED)
+        return self.reason is not None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left until the deadline, or None without one"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def add_callback(self, callback: Callable[[], None]) -> None:
+        """Call `callback` on cancellation (right away if already cancelled). Deadlines only
+        trigger callbacks once they are observed, so waiters should also honor remaining()."""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def raise_if_cancelled(self) -> None:
+        if self.cancelled:
+            raise RequestCancelled(self.reason)
+
+
+_current_token: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar(
+    "agent_server_cancel_token", default=None
+)
+
+
+def current_token() -> Optional[CancelToken]:
+    """The CancelToken of the request being handled, if any"""
+    return _current_token.get()
+
+
+def set_current_token(token: CancelToken) -> None:
+    _current_token.set(token)
+
+
+def raise_if_cancelled() -> None:
+    """Raise RequestCancelled if the current request was abandoned; cheap to call per chunk"""
+    token = _current_token.get()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+async def iterate_until_deadline(
+    items: AsyncIterator[T], token: CancelToken
+) -> AsyncGenerator[T, None]:
+    """Yield from `items`, raising RequestCancelled if the next item misses the token's deadline.
+
+    The deadline only interrupts waits for the next item, never the consumer's work between items.
+    """
+    iterator = items.__aiter__()
+    loop = asyncio.get_running_loop()
+    deadline = None if token.deadline is None else loop.time() + token.remaining()
+    try:
+        while True:
+            timeout = asyncio.timeout_at(deadline)
+            try:
+                async with timeout:
+                    item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            except TimeoutError:
+                if not timeout.expired():
+                    raise
+                token.cancel(DEADLINE_EXCEEDED)
+                raise RequestCancelled(DEADLINE_EXCEEDED) from None
+            yield item
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
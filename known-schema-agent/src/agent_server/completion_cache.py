@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Generator, Iterator, Optional
+
+from agent_server import serialization
+
+# Every CompletionCache in the process, so the server can export their stats
+_CACHES: "weakref.WeakSet[CompletionCache]" = weakref.WeakSet()
+_CACHES_LOCK = threading.Lock()
+
+
+class CompletionCacheBackend(ABC):
+    """Storage for cached completions: each entry is the chunk list of one streamed response.
+
+    Set `blocking` on backends that do I/O so async callers run them in a thread.
+    """
+
+    blocking = False
+    # Entries removed to stay within the size bound
+    evictions = 0
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[list[dict]]:
+        """The stored chunks, or None if the key is missing or expired"""
+
+    @abstractmethod
+    def set(self, key: str, chunks: list[dict], ttl: Optional[float]) -> None: ...
+
+    @abstractmethod
+    def clear(self) -> None: ...
+
+    @abstractmethod
+    def size(self) -> int:
+        """Number of stored entries. Called on the event loop for every /metrics scrape, so it
+        must not do I/O"""
+
+
+class InMemoryCompletionBackend(CompletionCacheBackend):
+    """Per-process backend keeping the `max_entries` most recently used completions"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[list[dict]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, chunks: list[dict], ttl: Optional[float]) -> None:
+        expires_at = time.monotonic() + ttl if ttl is not None else float("inf")
+        with self._lock:
+            self._entries[key] = (expires_at, chunks)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class SqliteCompletionBackend(CompletionCacheBackend):
+    """Local disk backend in a SQLite file, so cached completions survive restarts and are
+    shared by workers. Keeps the `max_entries` most recently used completions.
+
+    `size()` is the entry count as of this process's last write, so it doesn't query the file.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int = 100_000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                chunks BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS completions_expires_at ON completions (expires_at);
+            CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions (accessed_at);
+            """
+        )
+        self._size = self._count()
+
+    def _count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    def get(self, key: str) -> Optional[list[dict]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT chunks FROM completions WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key))
+        return serialization.loads(row[0])
+
+    def set(self, key: str, chunks: list[dict], ttl: Optional[float]) -> None:
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else float("inf")
+        encoded = serialization.dumps(chunks)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO completions (key, expires_at, accessed_at, chunks) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, expires_at, now, encoded),
+                )
+                self._conn.execute("DELETE FROM completions WHERE expires_at <= ?", (now,))
+                evicted = self._conn.execute(
+                    "DELETE FROM completions WHERE key IN (SELECT key FROM completions "
+                    "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                ).rowcount
+                # Writes follow an LLM call, so counting here is cheap next to the miss
+                size = self._count()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self.evictions += evicted
+            self._size = size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM completions")
+            self._size = 0
+
+    def size(self) -> int:
+        return self._size
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def _encode_chunk(chunk: Any) -> dict:
+    return chunk.to_dict()
+
+
+def _decode_chunk(data: dict) -> Any:
+    from openai.types.chat import ChatCompletionChunk
+
+    return ChatCompletionChunk.model_validate(data)
+
+
+class CompletionCache:
+    """Exact-match cache of streamed LLM completions.
+
+    Entries are keyed on a hash of the model, messages, tool specs and any other request
+    parameters, and hold every chunk of the response, so a hit is replayed as a stream of the
+    same chunks. Only streams that run to completion are stored. Entries expire after `ttl`
+    seconds (never if None). Concurrent misses on the same key each call the LLM.
+
+    `name` labels the cache's stats in /metrics and must be unique among live caches; by
+    default the first cache is "llm" and later ones "llm_2", "llm_3", ...
+
+    Only enable this where repeating an earlier answer to an identical request is acceptable,
+    e.g. with temperature 0 or for fixed prompts.
+    """
+
+    def __init__(
+        self,
+        backend: Optional[CompletionCacheBackend] = None,
+        ttl: Optional[float] = 3600.0,
+        name: Optional[str] = None,
+        encode: Callable[[Any], dict] = _encode_chunk,
+        decode: Callable[[dict], Any] = _decode_chunk,
+    ):
+        self.backend = backend or InMemoryCompletionBackend()
+        self.ttl = ttl
+        self.encode = encode
+        self.decode = decode
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        with _CACHES_LOCK:
+            taken = {cache.name for cache in _CACHES}
+            if name is None:
+                name, suffix = "llm", 2
+                while name in taken:
+                    name, suffix = f"llm_{suffix}", suffix + 1
+            elif name in taken:
+                raise ValueError(f"A CompletionCache named {name!r} already exists")
+            self.name = name
+            _CACHES.add(self)
+
+    @staticmethod
+    def key(model: str, messages: list[dict], tools: Optional[list[dict]] = None, **params) -> str:
+        request = {"model": model, "messages": messages, "tools": tools or [], **params}
+        canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[list[dict]]:
+        chunks = self.backend.get(key)
+        with self._lock:
+            if chunks is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return chunks
+
+    def _store(self, key: str, chunks: list[dict]) -> None:
+        self.backend.set(key, chunks, self.ttl)
+
+    def stream(self, key: str, create: Callable[[], Iterator[Any]]) -> Generator[Any, None, None]:
+        """Replay the cached response for key, or stream create() through and cache it"""
+        cached = self._lookup(key)
+        if cached is not None:
+            for data in cached:
+                yield self.decode(data)
+            return
+        recorded = []
+        for chunk in create():
+            recorded.append(self.encode(chunk))
+            yield chunk
+        self._store(key, recorded)
+
+    async def astream(
+        self, key: str, create: Callable[[], AsyncIterator[Any]]
+    ) -> AsyncGenerator[Any, None]:
+        """Async stream(); blocking backends are called from a worker thread"""
+        if self.backend.blocking:
+            cached = await asyncio.to_thread(self._lookup, key)
+        else:
+            cached = self._lookup(key)
+        if cached is not None:
+            for data in cached:
+                yield self.decode(data)
+            return
+        recorded = []
+        async for chunk in create():
+            recorded.append(self.encode(chunk))
+            yield chunk
+        if self.backend.blocking:
+            await asyncio.to_thread(self._store, key, recorded)
+        else:
+            self._store(key, recorded)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self._hits, self._misses
+        return {
+            "size": self.backend.size(),
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            "evictions": self.backend.evictions,
+        }
+
+
+def completion_cache_stats() -> dict[str, dict]:
+    """Stats of every live CompletionCache, by name"""
+    return {cache.name: cache.stats() for cache in list(_CACHES)}
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import mlflow
+import pytest
+
+
+@pytest.fixture(autouse=True, scope="session")
+def mlflow_tracking(tmp_path_factory):
+    """Keep traces created by the tests in a throwaway store"""
+    root = tmp_path_factory.mktemp("mlflow")
+    mlflow.set_tracking_uri(f"sqlite:///{root / 'mlflow.db'}")
+    mlflow.set_experiment(
+        experiment_id=mlflow.create_experiment("tests", artifact_location=root.as_uri())
+    )
+
+
+def completion_chunk(delta: dict, finish_reason=None) -> dict:
+    return {
+        "id": "chatcmpl-test",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "fake-llm",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+class FakeChatCompletions:
+    """Local chat-completions server that streams scripted responses, one per request.
+
+    A response is a list of chunks; a number in it pauses the stream for that many seconds and
+    bytes are written as they are, e.g. to send a malformed event.
+    """
+
+    def __init__(self):
+        self.requests: list[dict] = []
+        self.responses: list[list] = []
+        # time.monotonic() at which each response finished streaming
+        self.finished_at: list[float] = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                fake.requests.append(json.loads(body))
+                chunks = fake.responses.pop(0)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for chunk in chunks:
+                    if isinstance(chunk, (int, float)):
+                        time.sleep(chunk)
+                    elif isinstance(chunk, bytes):
+                        self.wfile.write(chunk)
+                    else:
+                        self.wfile.write(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+                self.wfile.write(b"data: [DONE]\n\n")
+                fake.finished_at.append(time.monotonic())
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def fake_llm():
+    server = FakeChatCompletions()
+    yield server
+    server.close()
+
+
+@dataclass
+class ASGIResponse:
+    status: int = 0
+    headers: dict[str, str] = field(default_factory=dict)
+    body: bytes = b""
+    # Set as each body piece arrives
+    received: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def json(self):
+        return json.loads(self.body)
+
+    def lines(self) -> list[dict]:
+        return [json.loads(line) for line in self.body.splitlines()]
+
+    def events(self) -> list:
+        """The data of each SSE event, parsed unless it is [DONE]"""
+        events = []
+        for line in self.body.decode().splitlines():
+            if line.startswith("data: "):
+                data = line[len("data: ") :]
+                events.append(data if data == "[DONE]" else json.loads(data))
+        return events
+
+    async def wait_for(self, text: str, timeout: float = 5.0) -> None:
+        """Wait until the body read so far contains text"""
+        async with asyncio.timeout(timeout):
+            while text.encode() not in self.body:
+                self.received.clear()
+                await self.received.wait()
+
+
+async def asgi_post(
+    app,
+    path: str,
+    payload=None,
+    content: bytes = None,
+    disconnect: asyncio.Event = None,
+    response: ASGIResponse = None,
+) -> ASGIResponse:
+    """POST straight to an ASGI app, so tests can run requests concurrently, read a stream as it
+    is sent, and disconnect midway by setting `disconnect`"""
+    body = content if content is not None else json.dumps(payload).encode()
+    response = response or ASGIResponse()
+    disconnect = disconnect or asyncio.Event()
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if disconnect.is_set():
+            raise OSError("client disconnected")
+        if message["type"] == "http.response.start":
+            response.status = message["status"]
+            response.headers = {k.decode(): v.decode() for k, v in message["headers"]}
+        elif message["type"] == "http.response.body":
+            response.body += message.get("body", b"")
+            response.received.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 1234),
+        "server": ("testserver", 80),
+    }
+    try:
+        await app(scope, receive, send)
+    except OSError:
+        if not disconnect.is_set():
+            raise
+    return response
@@ -0,0 +1,113 @@
+import json
+
+import pytest
+from conftest import completion_chunk
+from openai.types.chat import ChatCompletionChunk
+
+from agent_server.accumulator import StreamAccumulator
+
+
+def tool_call_chunk(index: int, arguments: str, id=None, name=None) -> ChatCompletionChunk:
+    function = {"arguments": arguments}
+    if name is not None:
+        function["name"] = name
+    tool_call = {"index": index, "function": function}
+    if id is not None:
+        tool_call["id"] = id
+    return ChatCompletionChunk.model_validate(completion_chunk({"tool_calls": [tool_call]}))
+
+
+def accumulate(*fragments: tuple[int, str]) -> tuple[StreamAccumulator, list[tuple[int, dict]]]:
+    """Feed (index, arguments fragment) pairs; returns the accumulator and, for each completed
+    call, the number of fragments fed when it was reported"""
+    completed = []
+    fed = 0
+    stream = StreamAccumulator(lambda call: completed.append((fed, call)))
+    seen = set()
+    for index, arguments in fragments:
+        fed += 1
+        if index in seen:
+            stream.add(tool_call_chunk(index, arguments))
+        else:
+            seen.add(index)
+            stream.add(tool_call_chunk(index, arguments, id=f"call_{index}", name="tool"))
+    return stream, completed
+
+
+def test_arguments_in_a_single_fragment():
+    stream, completed = accumulate((0, '{"city": "Paris"}'))
+    assert [(fed, call["function"]["arguments"]) for fed, call in completed] == [
+        (1, '{"city": "Paris"}')
+    ]
+    assert completed[0][1]["id"] == "call_0"
+    assert completed[0][1]["function"]["name"] == "tool"
+
+
+def test_empty_object_arguments():
+    stream, completed = accumulate((0, "{"), (0, "}"))
+    assert [(fed, call["function"]["arguments"]) for fed, call in completed] == [(2, "{}")]
+
+
+@pytest.mark.parametrize(
+    "fragments",
+    [
+        ['{"q": "a}b"}'],
+        ['{"q": "', "}", "]", '"}'],
+        ['{"q": "[{"', ', "r": [1, {"s": "]"}]}'],
+        ['{"q": ', '"}}}"', "}"],
+    ],
+)
+def test_brackets_inside_strings_do_not_close_the_arguments(fragments):
+    json.loads("".join(fragments))
+    stream, completed = accumulate(*((0, fragment) for fragment in fragments))
+    assert [fed for fed, _ in completed] == [len(fragments)]
+    assert completed[0][1]["function"]["arguments"] == "".join(fragments)
+
+
+@pytest.mark.parametrize(
+    "fragments",
+    [
+        # An escaped quote whose backslash ends a fragment
+        ['{"q": "say \\', '"} \\" here"}'],
+        # An escaped backslash split across fragments, followed by the closing quote
+        ['{"q": "C:\\', '\\"}'],
+        # An escaped backslash and an escaped quote back to back, split in between
+        ['{"q": "\\\\', '\\"}', '"}'],
+        # Every character in its own fragment
+        list('{"q": "a\\"}\\\\", "r": {}}'),
+    ],
+)
+def test_escapes_split_across_fragments(fragments):
+    arguments = "".join(fragments)
+    json.loads(arguments)
+    stream, completed = accumulate(*((0, fragment) for fragment in fragments))
+    assert [fed for fed, _ in completed] == [len(fragments)]
+    assert completed[0][1]["function"]["arguments"] == arguments
+
+
+def test_interleaved_calls_closing_out_of_order():
+    stream, completed = accumulate(
+        (0, '{"city": '),
+        (1, '{"city": "Rome"'),
+        (2, "{"),
+        (1, "}"),
+        (0, '"Paris"'),
+        (2, "}"),
+        (0, "}"),
+    )
+    assert [(fed, call["id"]) for fed, call in completed] == [
+        (4, "call_1"),
+        (6, "call_2"),
+        (7, "call_0"),
+    ]
+    assert [call["function"]["arguments"] for call in stream.tool_calls()] == [
+        '{"city": "Paris"}',
+        '{"city": "Rome"}',
+        "{}",
+    ]
+
+
+def test_calls_are_reported_once():
+    stream, completed = accumulate((0, "{}"), (0, " "))
+    assert len(completed) == 1
+    assert stream.tool_calls()[0]["function"]["arguments"] == "{} "
@@ -0,0 +1,179 @@
+import asyncio
+
+import pytest
+from conftest import ASGIResponse, asgi_post
+
+from agent_server import server
+from agent_server.admission import AdmissionController, AdmissionRejected
+
+REQUEST = {"input": [{"role": "user", "content": "hi"}]}
+
+
+def reply(text: str) -> dict:
+    return {
+        "type": "message",
+        "role": "assistant",
+        "id": "msg-1",
+        "content": [{"type": "output_text", "text": text}],
+    }
+
+
+@pytest.fixture
+def blocking_invoke(monkeypatch):
+    """An invoke function that waits for `release` to be set; `entered` is set once it runs"""
+    state = {"entered": asyncio.Event(), "release": asyncio.Event()}
+
+    async def invoke(request):
+        state["entered"].set()
+        await state["release"].wait()
+        return {"output": [reply("done")]}
+
+    monkeypatch.setattr(server, "_invoke_function", invoke)
+    return state
+
+
+@pytest.fixture
+def blocking_stream(monkeypatch):
+    """A stream function that sends one delta, then waits for `release` before finishing"""
+    state = {"release": asyncio.Event()}
+
+    async def stream(request):
+        yield {"type": "response.output_text.delta", "item_id": "msg-1", "delta": "hel"}
+        await state["release"].wait()
+        yield {"type": "response.output_item.done", "item": reply("hello")}
+
+    monkeypatch.setattr(server, "_stream_function", stream)
+    return state
+
+
+def test_a_full_queue_is_rejected_with_429_and_retry_after(blocking_invoke):
+    agent_server = server.create_server(
+        "agent/v1/responses",
+        max_concurrent_invokes=1,
+        admission_queue_size=0,
+        admission_retry_after=2.5,
+    )
+
+    async def main():
+        first = asyncio.ensure_future(asgi_post(agent_server.app, "/invocations", REQUEST))
+        await blocking_invoke["entered"].wait()
+        rejected = await asgi_post(agent_server.app, "/invocations", REQUEST)
+        blocking_invoke["release"].set()
+        return await first, rejected
+
+    first, rejected = asyncio.run(main())
+    assert first.status == 200
+    assert rejected.status == 429
+    assert rejected.headers["retry-after"] == "3"
+    assert agent_server.admission["invoke"].stats()["rejected_queue_full"] == 1
+
+
+def test_a_queued_request_that_times_out_gets_503_and_retry_after(blocking_invoke):
+    agent_server = server.create_server(
+        "agent/v1/responses",
+        max_concurrent_invokes=1,
+        admission_queue_size=1,
+        admission_queue_timeout=0.1,
+    )
+
+    async def main():
+        first = asyncio.ensure_future(asgi_post(agent_server.app, "/invocations", REQUEST))
+        await blocking_invoke["entered"].wait()
+        timed_out = await asgi_post(agent_server.app, "/invocations", REQUEST)
+        blocking_invoke["release"].set()
+        return await first, timed_out
+
+    first, timed_out = asyncio.run(main())
+    assert first.status == 200
+    assert timed_out.status == 503
+    assert timed_out.headers["retry-after"] == "1"
+    assert agent_server.admission["invoke"].stats()["rejected_timeout"] == 1
+
+
+def test_a_queued_request_runs_once_a_slot_frees_up(blocking_invoke):
+    agent_server = server.create_server(
+        "agent/v1/responses", max_concurrent_invokes=1, admission_queue_size=1
+    )
+
+    async def main():
+        first = asyncio.ensure_future(asgi_post(agent_server.app, "/invocations", REQUEST))
+        await blocking_invoke["entered"].wait()
+        queued = asyncio.ensure_future(asgi_post(agent_server.app, "/invocations", REQUEST))
+        await asyncio.sleep(0.05)
+        assert agent_server.admission["invoke"].stats()["queued"] == 1
+        blocking_invoke["release"].set()
+        return await first, await queued
+
+    first, queued = asyncio.run(main())
+    assert (first.status, queued.status) == (200, 200)
+    assert agent_server.admission["invoke"].stats()["in_flight"] == 0
+
+
+def test_a_stream_holds_its_slot_until_the_body_is_sent(blocking_stream):
+    agent_server = server.create_server(
+        "agent/v1/responses", max_concurrent_streams=1, admission_queue_size=0
+    )
+    request = {**REQUEST, "stream": True}
+
+    async def main():
+        first = ASGIResponse()
+        task = asyncio.ensure_future(
+            asgi_post(agent_server.app, "/invocations", request, response=first)
+        )
+        # The response has started, but the stream still holds the slot
+        await first.wait_for("hel")
+        rejected = await asgi_post(agent_server.app, "/invocations", request)
+        blocking_stream["release"].set()
+        await task
+        after = await asgi_post(agent_server.app, "/invocations", request)
+        return first, rejected, after
+
+    first, rejected, after = asyncio.run(main())
+    assert first.events()[-1] == "[DONE]"
+    assert rejected.status == 429
+    assert after.status == 200
+    assert agent_server.admission["stream"].stats()["in_flight"] == 0
+
+
+def test_a_stream_releases_its_slot_when_the_client_disconnects(blocking_stream):
+    agent_server = server.create_server(
+        "agent/v1/responses", max_concurrent_streams=1, admission_queue_size=0
+    )
+    request = {**REQUEST, "stream": True}
+
+    async def main():
+        first = ASGIResponse()
+        disconnect = asyncio.Event()
+        task = asyncio.ensure_future(
+            asgi_post(
+                agent_server.app, "/invocations", request, disconnect=disconnect, response=first
+            )
+        )
+        await first.wait_for("hel")
+        disconnect.set()
+        # The disconnect alone ends the first stream, which never got to finish
+        await asyncio.wait_for(task, 5)
+        assert agent_server.admission["stream"].stats()["in_flight"] == 0
+        blocking_stream["release"].set()
+        return first, await asgi_post(agent_server.app, "/invocations", request)
+
+    first, after = asyncio.run(main())
+    assert "[DONE]" not in first.body.decode()
+    assert after.status == 200
+    assert agent_server.admission["stream"].stats()["in_flight"] == 0
+
+
+def test_a_timed_out_wait_leaves_no_slot_or_waiter_behind():
+    async def main():
+        controller = AdmissionController(1, max_queue=2, queue_timeout=0.05)
+        held = await controller.acquire()
+        waiter = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await waiter
+        held.release()
+        return controller.stats()
+
+    stats = asyncio.run(main())
+    assert stats["in_flight"] == 0
+    assert stats["queued"] == 0
@@ -0,0 +1,149 @@
+import asyncio
+import io
+import json
+
+import pytest
+from conftest import asgi_post
+
+from agent_server import server
+from agent_server.batch import BatchRunner
+
+
+def reply(text: str) -> dict:
+    return {
+        "type": "message",
+        "role": "assistant",
+        "id": "msg-1",
+        "content": [{"type": "output_text", "text": text}],
+    }
+
+
+def run_batch(monkeypatch, invoke, requests, **kwargs) -> dict[int, dict]:
+    monkeypatch.setattr(server, "_invoke_function", invoke)
+    runner = BatchRunner(**kwargs)
+    output = io.BytesIO()
+    try:
+        asyncio.run(runner.run(iter(enumerate(requests)), output))
+    finally:
+        runner.shutdown()
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    return {line["index"]: line for line in lines}
+
+
+def test_agents_without_a_known_schema_get_their_requests_as_sent(monkeypatch):
+    async def invoke(request):
+        return {"messages": request["messages"] + [{"role": "assistant", "content": "hi"}]}
+
+    lines = run_batch(
+        monkeypatch, invoke, [{"messages": [{"role": "user", "content": "hello"}]}], agent_type=None
+    )
+    assert lines[0]["response"]["messages"][-1] == {"role": "assistant", "content": "hi"}
+
+
+def test_errors_use_the_batch_endpoint_format(monkeypatch):
+    async def invoke(request):
+        raise RuntimeError("boom")
+
+    requests = [ValueError("Invalid JSON: oops"), {"input": "not a list"}, {"input": []}]
+    lines = run_batch(monkeypatch, invoke, requests)
+    assert lines[0]["error"] == {"status_code": 400, "detail": "Invalid JSON: oops"}
+    assert lines[1]["error"]["status_code"] == 400
+    assert lines[2]["error"] == {"status_code": 500, "detail": "boom"}
+
+
+@pytest.fixture
+def echo_agent(monkeypatch) -> dict:
+    """Registers an invoke function that answers with the user's text after the delay given for
+    it in `delays`, tracking how many calls run at once"""
+    state = {"delays": {}, "running": 0, "max_running": 0}
+
+    async def invoke(request):
+        text = request["input"][0]["content"]
+        state["running"] += 1
+        state["max_running"] = max(state["max_running"], state["running"])
+        try:
+            await asyncio.sleep(state["delays"].get(text, 0.01))
+        finally:
+            state["running"] -= 1
+        return {"output": [reply(text)]}
+
+    monkeypatch.setattr(server, "_invoke_function", invoke)
+    return state
+
+
+def batch_item(text: str, **extra) -> dict:
+    return {"input": [{"role": "user", "content": text}], **extra}
+
+
+def answer(line: dict) -> str:
+    return line["response"]["output"][0]["content"][0]["text"]
+
+
+@pytest.mark.parametrize("ndjson", [False, True])
+def test_batch_endpoint_yields_results_in_completion_order(echo_agent, ndjson):
+    echo_agent["delays"] = {"slow": 0.3, "fast": 0.0, "medium": 0.15}
+    items = [batch_item(text) for text in ["slow", "fast", "medium"]]
+    if ndjson:
+        content = b"\n".join(json.dumps(item).encode() for item in items) + b"\n"
+    else:
+        content = json.dumps(items).encode()
+    agent_server = server.create_server("agent/v1/responses")
+    response = asyncio.run(asgi_post(agent_server.app, "/invocations/batch", content=content))
+
+    assert response.status == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = response.lines()
+    assert [(line["index"], answer(line)) for line in lines] == [
+        (1, "fast"),
+        (2, "medium"),
+        (0, "slow"),
+    ]
+
+
+def test_batch_endpoint_fails_bad_lines_on_their_own(echo_agent):
+    content = b"\n".join(
+        [
+            json.dumps(batch_item("first")).encode(),
+            b'{"input": [',
+            b"",
+            json.dumps(batch_item("streamed", stream=True)).encode(),
+            b"[1, 2]",
+            json.dumps({"input": "not a list"}).encode(),
+            json.dumps(batch_item("last")).encode(),
+        ]
+    )
+    agent_server = server.create_server("agent/v1/responses")
+    response = asyncio.run(asgi_post(agent_server.app, "/invocations/batch", content=content))
+
+    assert response.status == 200
+    # Blank lines are skipped and don't take an index
+    lines = {line["index"]: line for line in response.lines()}
+    assert sorted(lines) == [0, 1, 2, 3, 4, 5]
+    assert answer(lines[0]) == "first"
+    assert answer(lines[5]) == "last"
+    assert lines[1]["error"]["status_code"] == 400
+    assert lines[1]["error"]["detail"].startswith("Invalid JSON")
+    assert lines[2]["error"] == {"status_code": 400, "detail": "Batch items can't be streamed"}
+    assert lines[3]["error"] == {"status_code": 400, "detail": "Request must be a JSON object"}
+    assert lines[4]["error"]["status_code"] == 400
+
+
+def test_batch_endpoint_rejects_a_malformed_json_array(echo_agent):
+    agent_server = server.create_server("agent/v1/responses")
+    response = asyncio.run(
+        asgi_post(agent_server.app, "/invocations/batch", content=b'[{"input": []}')
+    )
+    assert response.status == 400
+    assert response.json()["detail"].startswith("Invalid batch request body")
+
+
+def test_batch_endpoint_runs_at_most_batch_concurrency_items_at_a_time(echo_agent):
+    echo_agent["delays"] = {f"q{i}": 0.05 for i in range(7)}
+    items = [batch_item(f"q{i}") for i in range(7)]
+    agent_server = server.create_server("agent/v1/responses", batch_concurrency=2)
+    response = asyncio.run(
+        asgi_post(agent_server.app, "/invocations/batch", content=json.dumps(items).encode())
+    )
+
+    assert sorted(line["index"] for line in response.lines()) == list(range(7))
+    assert echo_agent["max_running"] == 2
@@ -0,0 +1,147 @@
+import asyncio
+import time
+
+import pytest
+from conftest import ASGIResponse, asgi_post
+
+from agent_server import server
+from agent_server.cancellation import current_token
+
+REQUEST = {"input": [{"role": "user", "content": "hi"}]}
+STREAM_REQUEST = {**REQUEST, "stream": True}
+
+
+def reply(text: str) -> dict:
+    return {
+        "type": "message",
+        "role": "assistant",
+        "id": "msg-1",
+        "content": [{"type": "output_text", "text": text}],
+    }
+
+
+def requests_counted(agent_server, endpoint: str, status: str) -> int:
+    """The value of the requests counter for `endpoint` and `status` on /metrics"""
+    prefix = f'agent_server_requests_total{{endpoint="{endpoint}",status="{status}"}} '
+    for line in agent_server.metrics.render().splitlines():
+        if line.startswith(prefix):
+            return int(line[len(prefix) :])
+    return 0
+
+
+@pytest.fixture
+def agent_runs(monkeypatch) -> dict:
+    """Registers agents that run until cancelled; records how each run ended"""
+    runs = {"started": asyncio.Event(), "cancelled": []}
+
+    async def invoke(request):
+        runs["started"].set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            runs["cancelled"].append("invoke")
+            raise
+        return {"output": [reply("late")]}
+
+    async def stream(request):
+        yield {"type": "response.output_text.delta", "item_id": "msg-1", "delta": "hel"}
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            runs["cancelled"].append("stream")
+            raise
+        yield {"type": "response.output_item.done", "item": reply("hello")}
+
+    monkeypatch.setattr(server, "_invoke_function", invoke)
+    monkeypatch.setattr(server, "_stream_function", stream)
+    return runs
+
+
+def test_invoke_past_the_deadline_gets_504(agent_runs):
+    agent_server = server.create_server("agent/v1/responses", request_timeout=0.1)
+    started = time.perf_counter()
+    response = asyncio.run(asgi_post(agent_server.app, "/invocations", REQUEST))
+
+    assert time.perf_counter() - started < 2
+    assert response.status == 504
+    assert "deadline exceeded" in response.json()["detail"]
+    assert agent_runs["cancelled"] == ["invoke"]
+    assert requests_counted(agent_server, "invoke", "timeout") == 1
+
+
+def test_sync_invoke_past_the_deadline_gets_504_and_sees_the_cancellation(monkeypatch):
+    stopped = []
+
+    def invoke(request):
+        token = current_token()
+        while not token.cancelled:
+            time.sleep(0.01)
+        stopped.append(token.reason)
+        return {"output": [reply("late")]}
+
+    monkeypatch.setattr(server, "_invoke_function", invoke)
+    agent_server = server.create_server("agent/v1/responses", request_timeout=0.1)
+    response = asyncio.run(asgi_post(agent_server.app, "/invocations", REQUEST))
+
+    assert response.status == 504
+    deadline = time.monotonic() + 2
+    while not stopped and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert stopped == ["deadline exceeded"]
+
+
+def test_stream_past_the_deadline_ends_with_an_error_event(agent_runs):
+    agent_server = server.create_server("agent/v1/responses", request_timeout=0.2)
+    response = asyncio.run(asgi_post(agent_server.app, "/invocations", STREAM_REQUEST))
+
+    events = response.events()
+    assert response.status == 200
+    assert events[0]["chunk"]["delta"] == "hel"
+    assert "deadline exceeded" in events[-1]["error"]
+    assert "[DONE]" not in events
+    assert agent_runs["cancelled"] == ["stream"]
+    assert requests_counted(agent_server, "stream", "timeout") == 1
+
+
+def test_invoke_client_disconnect_is_counted_and_cancels_the_agent(agent_runs):
+    agent_server = server.create_server("agent/v1/responses")
+
+    async def main():
+        disconnect = asyncio.Event()
+        task = asyncio.ensure_future(
+            asgi_post(agent_server.app, "/invocations", REQUEST, disconnect=disconnect)
+        )
+        await agent_runs["started"].wait()
+        disconnect.set()
+        return await asyncio.wait_for(task, 5)
+
+    response = asyncio.run(main())
+    # Nothing reaches a client that is gone
+    assert response.status == 0
+    assert agent_runs["cancelled"] == ["invoke"]
+    assert requests_counted(agent_server, "invoke", "disconnected") == 1
+    assert requests_counted(agent_server, "invoke", "error") == 0
+
+
+def test_stream_client_disconnect_is_counted_and_cancels_the_agent(agent_runs):
+    agent_server = server.create_server("agent/v1/responses")
+
+    async def main():
+        response = ASGIResponse()
+        disconnect = asyncio.Event()
+        task = asyncio.ensure_future(
+            asgi_post(
+                agent_server.app,
+                "/invocations",
+                STREAM_REQUEST,
+                disconnect=disconnect,
+                response=response,
+            )
+        )
+        await response.wait_for("hel")
+        disconnect.set()
+        await asyncio.wait_for(task, 5)
+
+    asyncio.run(main())
+    assert agent_runs["cancelled"] == ["stream"]
+    assert requests_counted(agent_server, "stream", "disconnected") == 1
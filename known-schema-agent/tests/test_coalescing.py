@@ -0,0 +1,223 @@
+import asyncio
+
+import pytest
+from conftest import ASGIResponse, asgi_post
+
+from agent_server import server
+from agent_server.cancellation import current_token
+from agent_server.coalescing import RequestCoalescer
+from agent_server.sessions import InMemorySessionStore
+
+REQUEST = {"input": [{"role": "user", "content": "hi"}]}
+STREAM_REQUEST = {**REQUEST, "stream": True}
+
+
+def reply(text: str) -> dict:
+    return {
+        "type": "message",
+        "role": "assistant",
+        "id": "msg-1",
+        "content": [{"type": "output_text", "text": text}],
+    }
+
+
+def delta(text: str) -> dict:
+    return {"type": "response.output_text.delta", "item_id": "msg-1", "delta": text}
+
+
+@pytest.fixture
+def gated_agent(monkeypatch) -> dict:
+    """Registers agents that count their runs and wait for `release` before finishing; the
+    stream sends "one", waits for `release`, then sends "two" """
+    state = {"runs": 0, "entered": asyncio.Event(), "release": asyncio.Event()}
+
+    async def invoke(request):
+        state["runs"] += 1
+        state["entered"].set()
+        await state["release"].wait()
+        return {"output": [reply(f"run {state['runs']}")]}
+
+    async def stream(request):
+        state["runs"] += 1
+        yield delta("one")
+        await state["release"].wait()
+        yield delta("two")
+        yield {"type": "response.output_item.done", "item": reply("onetwo")}
+
+    monkeypatch.setattr(server, "_invoke_function", invoke)
+    monkeypatch.setattr(server, "_stream_function", stream)
+    return state
+
+
+def test_identical_concurrent_invokes_run_the_agent_once(gated_agent):
+    agent_server = server.create_server("agent/v1/responses", coalesce_requests=True)
+
+    async def main():
+        requests = [
+            asyncio.ensure_future(asgi_post(agent_server.app, "/invocations", REQUEST))
+            for _ in range(3)
+        ]
+        await gated_agent["entered"].wait()
+        await asyncio.sleep(0.05)
+        gated_agent["release"].set()
+        return await asyncio.gather(*requests)
+
+    responses = asyncio.run(main())
+    assert gated_agent["runs"] == 1
+    assert [response.status for response in responses] == [200, 200, 200]
+    assert len({response.body for response in responses}) == 1
+    assert agent_server.coalescer.stats() == {"in_flight": 0, "executions": 1, "coalesced": 2}
+
+
+def test_different_requests_are_not_coalesced(gated_agent):
+    agent_server = server.create_server("agent/v1/responses", coalesce_requests=True)
+    other = {"input": [{"role": "user", "content": "hello"}]}
+
+    async def main():
+        requests = [
+            asyncio.ensure_future(asgi_post(agent_server.app, "/invocations", payload))
+            for payload in [REQUEST, other]
+        ]
+        await asyncio.sleep(0.05)
+        gated_agent["release"].set()
+        return await asyncio.gather(*requests)
+
+    asyncio.run(main())
+    assert gated_agent["runs"] == 2
+
+
+def test_a_late_stream_joiner_gets_earlier_chunks_then_live_ones(gated_agent):
+    agent_server = server.create_server("agent/v1/responses", coalesce_requests=True)
+
+    async def main():
+        first, late = ASGIResponse(), ASGIResponse()
+        requests = [
+            asyncio.ensure_future(
+                asgi_post(agent_server.app, "/invocations", STREAM_REQUEST, response=first)
+            )
+        ]
+        await first.wait_for("one")
+        requests.append(
+            asyncio.ensure_future(
+                asgi_post(agent_server.app, "/invocations", STREAM_REQUEST, response=late)
+            )
+        )
+        # The chunk sent before the late request arrived is replayed to it
+        await late.wait_for("one")
+        assert "two" not in late.body.decode()
+        gated_agent["release"].set()
+        await asyncio.gather(*requests)
+        return first, late
+
+    first, late = asyncio.run(main())
+    assert gated_agent["runs"] == 1
+    chunks = [event["chunk"] for event in first.events()[:-1]]
+    assert [chunk.get("delta") for chunk in chunks] == ["one", "two", None]
+    assert late.events() == first.events()
+    assert first.events()[-1] == "[DONE]"
+
+
+def test_a_shared_stream_keeps_running_until_the_last_client_leaves(monkeypatch):
+    finished = []
+    cancelled = []
+    release = asyncio.Event()
+
+    async def stream(request):
+        try:
+            yield delta("one")
+            await release.wait()
+            yield delta("two")
+            finished.append(True)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    monkeypatch.setattr(server, "_stream_function", stream)
+    agent_server = server.create_server("agent/v1/responses", coalesce_requests=True)
+
+    async def main():
+        first, second = ASGIResponse(), ASGIResponse()
+        first_disconnect = asyncio.Event()
+        requests = [
+            asyncio.ensure_future(
+                asgi_post(
+                    agent_server.app,
+                    "/invocations",
+                    STREAM_REQUEST,
+                    disconnect=disconnect,
+                    response=response,
+                )
+            )
+            for response, disconnect in [(first, first_disconnect), (second, None)]
+        ]
+        await second.wait_for("one")
+        first_disconnect.set()
+        await asyncio.wait_for(requests[0], 5)
+        assert cancelled == []
+        release.set()
+        await requests[1]
+        return second
+
+    second = asyncio.run(main())
+    assert finished == [True]
+    assert cancelled == []
+    assert second.events()[-1] == "[DONE]"
+
+
+def test_the_shared_run_is_cancelled_when_the_last_waiter_leaves():
+    coalescer = RequestCoalescer()
+    state = {"started": asyncio.Event(), "cancelled": False, "token": None}
+
+    async def call():
+        state["token"] = current_token()
+        state["started"].set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    async def main():
+        waiters = [asyncio.ensure_future(coalescer.run("key", call)) for _ in range(2)]
+        await state["started"].wait()
+        waiters[0].cancel()
+        await asyncio.gather(waiters[0], return_exceptions=True)
+        await asyncio.sleep(0.01)
+        assert not state["cancelled"]
+        assert coalescer.stats()["in_flight"] == 1
+        waiters[1].cancel()
+        await asyncio.gather(waiters[1], return_exceptions=True)
+        await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert state["cancelled"]
+    assert state["token"].reason == "client disconnected"
+    assert coalescer.stats()["in_flight"] == 0
+
+
+@pytest.mark.parametrize(
+    "extra",
+    [
+        {"custom_inputs": {"session_id": "s1"}},
+        {"databricks_options": {"return_trace": True}},
+    ],
+)
+def test_session_and_return_trace_requests_are_not_coalesced(gated_agent, extra):
+    agent_server = server.create_server(
+        "agent/v1/responses", coalesce_requests=True, session_store=InMemorySessionStore()
+    )
+    request = {**REQUEST, **extra}
+
+    async def main():
+        requests = [
+            asyncio.ensure_future(asgi_post(agent_server.app, "/invocations", request))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0.05)
+        gated_agent["release"].set()
+        return await asyncio.gather(*requests)
+
+    responses = asyncio.run(main())
+    assert [response.status for response in responses] == [200, 200]
+    assert gated_agent["runs"] == 2
+    assert agent_server.coalescer.stats()["coalesced"] == 0
@@ -0,0 +1,44 @@
+import pytest
+
+from agent_server.completion_cache import (
+    CompletionCache,
+    CompletionCacheBackend,
+    InMemoryCompletionBackend,
+    SqliteCompletionBackend,
+)
+
+
+def test_sqlite_size_does_not_query_the_database(tmp_path):
+    backend = SqliteCompletionBackend(str(tmp_path / "completions.db"), max_entries=2)
+    for key in ["a", "b", "c"]:
+        backend.set(key, [{"delta": key}], ttl=None)
+    backend.close()
+
+    # A closed connection would raise if stats still ran a query
+    cache = CompletionCache(backend, name="sqlite-size")
+    assert cache.stats()["size"] == 2
+    assert cache.stats()["evictions"] == 1
+
+
+def test_sqlite_size_counts_existing_entries(tmp_path):
+    path = str(tmp_path / "completions.db")
+    SqliteCompletionBackend(path).set("a", [{"delta": "a"}], ttl=None)
+    assert SqliteCompletionBackend(path).size() == 1
+
+
+def test_caches_get_distinct_metric_names():
+    first = CompletionCache(InMemoryCompletionBackend())
+    second = CompletionCache(InMemoryCompletionBackend())
+    assert first.name != second.name
+
+    with pytest.raises(ValueError):
+        CompletionCache(InMemoryCompletionBackend(), name=first.name)
+
+
+def test_backends_must_implement_the_storage_methods():
+    class GetOnly(CompletionCacheBackend):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError, match="clear, set, size"):
+        GetOnly()
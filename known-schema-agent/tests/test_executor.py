@@ -0,0 +1,64 @@
+import asyncio
+import threading
+
+from agent_server.executor import SyncExecutor
+
+
+def counting(closed: threading.Event, step: threading.Event = None):
+    """A sync generator that sets `closed` when it is closed; with `step`, each item after the
+    first waits for it"""
+    try:
+        for i in range(100):
+            if i and step is not None:
+                step.wait(5)
+            yield i
+    finally:
+        closed.set()
+
+
+def kept(generators: list, *args):
+    """Make a `counting` generator and keep a reference to it, so it can't be closed by being
+    garbage collected"""
+    generator = counting(*args)
+    generators.append(generator)
+    return generator
+
+
+def test_abandoned_generators_are_closed():
+    executor = SyncExecutor(max_workers=2)
+    closed = threading.Event()
+    generators = []
+
+    async def main():
+        items = executor.iterate(kept, generators, closed)
+        received = [await items.__anext__(), await items.__anext__()]
+        await items.aclose()
+        return received
+
+    assert asyncio.run(main()) == [0, 1]
+    assert closed.is_set()
+    executor.shutdown()
+
+
+def test_generators_abandoned_mid_step_are_closed_once_the_step_returns():
+    executor = SyncExecutor(max_workers=2)
+    closed = threading.Event()
+    generators = []
+    step = threading.Event()
+
+    async def main():
+        async def consume():
+            async for _ in executor.iterate(kept, generators, closed, step):
+                pass
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.05)
+        # The generator is blocked in its second step; cancelling doesn't wait for it
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert not closed.is_set()
+        step.set()
+
+    asyncio.run(main())
+    assert closed.wait(5)
+    executor.shutdown()
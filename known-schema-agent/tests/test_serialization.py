@@ -0,0 +1,46 @@
+import datetime
+import decimal
+import json
+import uuid
+
+import pytest
+from pydantic import BaseModel
+
+from agent_server import serialization
+
+
+class Citation(BaseModel):
+    url: str
+    retrieved_at: datetime.datetime
+
+
+VALUE = {
+    "created": datetime.datetime(2025, 1, 2, 3, 4, 5),
+    "id": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+    "cost": decimal.Decimal("0.25"),
+    "citations": [Citation(url="https://example.com", retrieved_at=datetime.datetime(2025, 1, 2))],
+}
+
+EXPECTED = {
+    "created": "2025-01-02T03:04:05",
+    "id": "12345678-1234-5678-1234-567812345678",
+    "cost": 0.25,
+    "citations": [{"url": "https://example.com", "retrieved_at": "2025-01-02T00:00:00"}],
+}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def backend(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(serialization, "orjson", None)
+    elif serialization.orjson is None:
+        pytest.skip("orjson is not installed")
+
+
+def test_dumps_encodes_values_json_has_no_type_for(backend):
+    assert json.loads(serialization.dumps(VALUE)) == EXPECTED
+
+
+def test_dumps_raises_type_error_for_unencodable_values(backend):
+    with pytest.raises(TypeError):
+        serialization.dumps({"lock": object()})
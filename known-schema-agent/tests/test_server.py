@@ -0,0 +1,151 @@
+import datetime
+import decimal
+import uuid
+
+import mlflow
+import pytest
+from fastapi.testclient import TestClient
+from mlflow.types.responses import ResponsesAgentRequest, ResponsesAgentResponse
+
+from agent_server import server
+
+
+def reply(text: str) -> dict:
+    return {
+        "type": "message",
+        "role": "assistant",
+        "id": "msg-1",
+        "content": [{"type": "output_text", "text": text}],
+    }
+
+
+def test_typed_agents_get_the_validated_request(monkeypatch):
+    seen = []
+
+    async def invoke(request: ResponsesAgentRequest) -> ResponsesAgentResponse:
+        seen.append(request)
+        return ResponsesAgentResponse(output=[reply(request.input[0].content)])
+
+    monkeypatch.setattr(server, "_invoke_function", invoke)
+    client = TestClient(server.create_server("agent/v1/responses").app)
+    response = client.post("/invocations", json={"input": [{"role": "user", "content": "hi"}]})
+
+    assert response.status_code == 200, response.text
+    assert isinstance(seen[0], ResponsesAgentRequest)
+    assert response.json()["output"][0]["content"][0]["text"] == "hi"
+
+
+def test_untyped_agents_get_the_request_dict(monkeypatch):
+    seen = []
+
+    async def invoke(request):
+        seen.append(request)
+        return {"output": [reply("ok")]}
+
+    monkeypatch.setattr(server, "_invoke_function", invoke)
+    client = TestClient(server.create_server("agent/v1/responses").app)
+    response = client.post("/invocations", json={"input": [{"role": "user", "content": "hi"}]})
+
+    assert response.status_code == 200, response.text
+    assert seen == [{"input": [{"role": "user", "content": "hi"}]}]
+
+
+def test_results_with_values_json_has_no_type_for_are_serialized(monkeypatch):
+    async def invoke(request):
+        return {
+            "created": datetime.datetime(2025, 1, 2),
+            "id": uuid.UUID(int=1),
+            "cost": decimal.Decimal("0.5"),
+        }
+
+    monkeypatch.setattr(server, "_invoke_function", invoke)
+    client = TestClient(server.create_server(None).app)
+    response = client.post("/invocations", json={"query": "hi"})
+
+    assert response.status_code == 200, response.text
+    assert response.json() == {
+        "created": "2025-01-02T00:00:00",
+        "id": "00000000-0000-0000-0000-000000000001",
+        "cost": 0.5,
+    }
+
+
+@pytest.mark.parametrize("kwargs", [{"validate_every_nth_chunk": 0}, {"validate_first_chunks": -1}])
+def test_validator_rejects_invalid_sampling(kwargs):
+    with pytest.raises(ValueError):
+        server.AgentValidator("agent/v1/responses", **kwargs)
+
+
+class NeverSample(server.TraceSampler):
+    def sample_head(self, request, return_trace):
+        return False
+
+
+@pytest.mark.parametrize("sampler,traced", [(None, True), (NeverSample(), False)])
+@pytest.mark.parametrize("is_async", [True, False])
+def test_sampled_out_requests_leave_no_nested_traces(
+    monkeypatch, tmp_path, sampler, traced, is_async
+):
+    experiment_id = mlflow.create_experiment(
+        f"sampling-{traced}-{is_async}", artifact_location=tmp_path.as_uri()
+    )
+    mlflow.set_experiment(experiment_id=experiment_id)
+
+    @mlflow.trace
+    def lookup(question):
+        return question.upper()
+
+    if is_async:
+
+        async def invoke(request):
+            return {"output": [reply(lookup(request["input"][0]["content"]))]}
+    else:
+
+        def invoke(request):
+            return {"output": [reply(lookup(request["input"][0]["content"]))]}
+
+    monkeypatch.setattr(server, "_invoke_function", invoke)
+    agent_server = server.create_server("agent/v1/responses", trace_sampler=sampler)
+    with TestClient(agent_server.app) as client:
+        response = client.post("/invocations", json={"input": [{"role": "user", "content": "hi"}]})
+    assert response.status_code == 200, response.text
+    mlflow.flush_trace_async_logging()
+
+    traces = mlflow.search_traces(locations=[experiment_id], return_type="list")
+    assert len(traces) == (1 if traced else 0)
+    if traced:
+        assert {span.name for span in traces[0].data.spans} == {"invoke_invoke", "lookup"}
+
+
+@pytest.fixture
+def uvicorn_runs(monkeypatch) -> list[tuple]:
+    """Records uvicorn.run calls instead of serving"""
+    import uvicorn
+
+    runs = []
+    monkeypatch.setattr(uvicorn, "run", lambda app, **kwargs: runs.append((app, kwargs)))
+    return runs
+
+
+def test_workers_serve_the_app_factory_without_a_server_in_this_process(
+    monkeypatch, uvicorn_runs
+):
+    monkeypatch.setenv("AGENT_SERVER_WORKERS", "3")
+    monkeypatch.setattr(server, "AgentServer", None)
+    server.run_workers("agent_server.agent:create_app", port=8001)
+
+    [(app, kwargs)] = uvicorn_runs
+    assert app == "agent_server.agent:create_app"
+    assert kwargs["factory"] is True
+    assert kwargs["workers"] == 3
+    assert kwargs["port"] == 8001
+
+
+def test_a_single_worker_serves_the_app_in_process(monkeypatch, uvicorn_runs):
+    monkeypatch.setenv("AGENT_SERVER_WORKERS", "1")
+    agent_server = server.create_server("agent/v1/responses")
+    agent_server.run(app_factory="agent_server.agent:create_app")
+
+    [(app, kwargs)] = uvicorn_runs
+    assert app is agent_server.app
+    assert "workers" not in kwargs
@@ -0,0 +1,222 @@
+import asyncio
+import sqlite3
+
+import pytest
+from conftest import ASGIResponse, asgi_post
+
+from agent_server import server, sessions
+from agent_server.sessions import InMemorySessionStore, SessionStore, SqliteSessionStore
+from agent_server.tracing import InMemoryTraceSink, TraceExporter
+
+
+def message(role: str, text: str) -> dict:
+    return {"role": role, "content": text}
+
+
+def reply(text: str) -> dict:
+    return {
+        "type": "message",
+        "role": "assistant",
+        "id": f"msg-{text}",
+        "content": [{"type": "output_text", "text": text}],
+    }
+
+
+def turn(text: str, session_id: str = "s1", stream: bool = False) -> dict:
+    request = {"input": [message("user", text)], "custom_inputs": {"session_id": session_id}}
+    if stream:
+        request["stream"] = True
+    return request
+
+
+@pytest.fixture
+def seen_inputs(monkeypatch) -> list[list[dict]]:
+    """Registers invoke and stream functions that record the input they get"""
+    seen = []
+
+    async def invoke(request):
+        seen.append(request["input"])
+        return {"output": [reply(f"answer{len(seen)}")]}
+
+    async def stream(request):
+        seen.append(request["input"])
+        yield {"type": "response.output_text.delta", "item_id": "x", "delta": "answer"}
+        yield {"type": "response.output_item.done", "item": reply(f"answer{len(seen)}")}
+
+    monkeypatch.setattr(server, "_invoke_function", invoke)
+    monkeypatch.setattr(server, "_stream_function", stream)
+    return seen
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemorySessionStore()
+    return SqliteSessionStore(str(tmp_path / "sessions.db"))
+
+
+def test_history_is_rehydrated_across_turns(seen_inputs, store):
+    agent_server = server.create_server("agent/v1/responses", session_store=store)
+
+    async def main():
+        for text in ["q1", "q2"]:
+            response = await asgi_post(agent_server.app, "/invocations", turn(text))
+            assert response.status == 200, response.body
+        response = await asgi_post(agent_server.app, "/invocations", turn("q3", stream=True))
+        assert response.events()[-1] == "[DONE]"
+        # Requests without a session id run on their input alone
+        await asgi_post(agent_server.app, "/invocations", {"input": [message("user", "solo")]})
+
+    asyncio.run(main())
+    assert [len(items) for items in seen_inputs] == [1, 3, 5, 1]
+    assert [item.get("content") for item in seen_inputs[2][:4:2]] == ["q1", "q2"]
+    assert seen_inputs[2][1]["id"] == "msg-answer1"
+    assert [item.get("id") or item["content"] for item in store.load("s1")] == [
+        "q1",
+        "msg-answer1",
+        "q2",
+        "msg-answer2",
+        "q3",
+        "msg-answer3",
+    ]
+
+
+def test_streams_are_saved_before_done_is_sent(seen_inputs):
+    response = ASGIResponse()
+    body_at_save = []
+
+    class RecordingStore(InMemorySessionStore):
+        def append(self, session_id, items):
+            body_at_save.append(response.body.decode())
+            super().append(session_id, items)
+
+    agent_server = server.create_server("agent/v1/responses", session_store=RecordingStore())
+    asyncio.run(
+        asgi_post(agent_server.app, "/invocations", turn("q1", stream=True), response=response)
+    )
+
+    assert response.events()[-1] == "[DONE]"
+    assert len(body_at_save) == 1
+    assert "answer" in body_at_save[0]
+    assert "[DONE]" not in body_at_save[0]
+
+
+def test_validation_and_tracing_see_only_the_new_items(seen_inputs, monkeypatch):
+    sink = InMemoryTraceSink()
+    exporter = TraceExporter(sinks=[sink], flush_interval=0.01)
+    agent_server = server.create_server(
+        "agent/v1/responses", session_store=InMemorySessionStore(), trace_exporter=exporter
+    )
+    validated = []
+    validate_request = agent_server.validator.validate_request
+
+    def record_validation(data):
+        validated.append(len(data["input"]))
+        return validate_request(data)
+
+    monkeypatch.setattr(agent_server.validator, "validate_request", record_validation)
+
+    async def main():
+        for text in ["q1", "q2", "q3"]:
+            await asgi_post(agent_server.app, "/invocations", turn(text))
+
+    asyncio.run(main())
+    exporter.shutdown()
+
+    assert [len(items) for items in seen_inputs] == [1, 3, 5]
+    assert validated == [1, 1, 1]
+    assert [record["inputs"]["input"] for record in sink.records] == [
+        [message("user", "q1")],
+        [message("user", "q2")],
+        [message("user", "q3")],
+    ]
+
+
+def test_session_store_requires_the_responses_agent_type():
+    with pytest.raises(ValueError):
+        server.create_server(None, session_store=InMemorySessionStore())
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces time.monotonic in the sessions module with a clock the test advances"""
+    now = [1000.0]
+    monkeypatch.setattr(sessions.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_in_memory_sessions_expire_after_being_idle_for_the_ttl(clock):
+    store = InMemorySessionStore(ttl=60)
+    store.append("s1", [message("user", "q1")])
+    clock[0] += 50
+    assert store.load("s1") == [message("user", "q1")]
+    store.append("s1", [message("user", "q2")])
+    # Appending refreshes the session, so it is idle for 50s here
+    clock[0] += 50
+    assert len(store.load("s1")) == 2
+    clock[0] += 61
+    assert store.load("s1") == []
+    # An expired session starts over
+    store.append("s1", [message("user", "q3")])
+    assert store.load("s1") == [message("user", "q3")]
+
+
+def test_in_memory_store_evicts_the_least_recently_used_session(clock):
+    store = InMemorySessionStore(max_sessions=2, ttl=None)
+    store.append("s1", [message("user", "q1")])
+    store.append("s2", [message("user", "q2")])
+    # Loading s1 makes s2 the least recently used
+    store.load("s1")
+    store.append("s3", [message("user", "q3")])
+    assert store.load("s2") == []
+    assert store.load("s1") == [message("user", "q1")]
+    assert store.load("s3") == [message("user", "q3")]
+
+
+def test_sqlite_store_appends_only_the_new_items(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SqliteSessionStore(path)
+    store.append("s1", [message("user", "q1"), reply("a1")])
+    conn = sqlite3.connect(path)
+    before = conn.execute("SELECT rowid, seq FROM session_items ORDER BY seq").fetchall()
+
+    statements = []
+    store._conn.set_trace_callback(statements.append)
+    store.append("s1", [message("user", "q2"), reply("a2")])
+    store._conn.set_trace_callback(None)
+
+    after = conn.execute("SELECT rowid, seq FROM session_items ORDER BY seq").fetchall()
+    # The stored rows are left as they were and the turn adds one row per new item
+    assert after[:2] == before
+    assert [seq for _, seq in after] == [0, 1, 2, 3]
+    inserts = [s for s in statements if s.startswith("INSERT INTO session_items")]
+    assert len(inserts) == 2
+    assert not any(s.startswith(("DELETE", "UPDATE session_items")) for s in statements)
+    assert store.load("s1") == [
+        message("user", "q1"),
+        reply("a1"),
+        message("user", "q2"),
+        reply("a2"),
+    ]
+    # Another connection, e.g. another worker, sees the same history
+    assert SqliteSessionStore(path).load("s1") == store.load("s1")
+
+
+def test_sqlite_sessions_expire_after_the_ttl(tmp_path, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(sessions.time, "time", lambda: now[0])
+    store = SqliteSessionStore(str(tmp_path / "sessions.db"), ttl=60)
+    store.append("s1", [message("user", "q1")])
+    now[0] += 61
+    assert store.load("s1") == []
+    store.append("s1", [message("user", "q2")])
+    assert store.load("s1") == [message("user", "q2")]
+
+
+def test_stores_must_implement_load_append_and_delete():
+    class LoadOnly(SessionStore):
+        def load(self, session_id):
+            return []
+
+    with pytest.raises(TypeError, match="append, delete"):
+        LoadOnly()
@@ -0,0 +1,361 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+from conftest import completion_chunk
+from mlflow.types.responses import ResponsesAgentRequest
+from openai import AsyncOpenAI, OpenAI
+
+from agent_server.tool_agent import (
+    AsyncToolCallingAgent,
+    DatabricksAuth,
+    ToolCallingAgent,
+    ToolInfo,
+)
+
+ADD_SPEC = {
+    "type": "function",
+    "function": {
+        "name": "add",
+        "description": "Add two numbers",
+        "parameters": {
+            "type": "object",
+            "properties": {"a": {"type": "number"}, "b": {"type": "number"}},
+        },
+    },
+}
+
+REQUEST = ResponsesAgentRequest(input=[{"role": "user", "content": "What is 1 + 2?"}])
+
+
+def script_tool_call_turn(fake_llm) -> None:
+    """The LLM calls add(1, 2) with its arguments split across chunks, then answers"""
+    tool_call = {"index": 0, "id": "call_1", "function": {"name": "add", "arguments": ""}}
+    fake_llm.responses.append(
+        [
+            completion_chunk({"role": "assistant", "tool_calls": [tool_call]}),
+            completion_chunk({"tool_calls": [{"index": 0, "function": {"arguments": '{"a": 1,'}}]}),
+            completion_chunk({"tool_calls": [{"index": 0, "function": {"arguments": ' "b": 2}'}}]}),
+            completion_chunk({}, finish_reason="tool_calls"),
+        ]
+    )
+    fake_llm.responses.append(
+        [
+            completion_chunk({"role": "assistant", "content": "The answer"}),
+            completion_chunk({"content": " is 3"}),
+            completion_chunk({}, finish_reason="stop"),
+        ]
+    )
+
+
+def assert_tool_call_turn(fake_llm, events) -> None:
+    done = [event.item for event in events if event.type == "response.output_item.done"]
+    assert [item["type"] for item in done] == ["function_call", "function_call_output", "message"]
+    assert done[0]["name"] == "add"
+    assert done[0]["arguments"] == '{"a": 1, "b": 2}'
+    assert done[1] == {"type": "function_call_output", "call_id": "call_1", "output": "3"}
+    assert done[2]["content"][0]["text"] == "The answer is 3"
+    deltas = [event.delta for event in events if event.type == "response.output_text.delta"]
+    assert "".join(deltas) == "The answer is 3"
+
+    assert len(fake_llm.requests) == 2
+    assert fake_llm.requests[0]["stream"] is True
+    assert fake_llm.requests[0]["tools"] == [ADD_SPEC]
+    messages = fake_llm.requests[1]["messages"]
+    assert messages[0] == {"role": "system", "content": "Be brief"}
+    assert messages[1] == {"role": "user", "content": "What is 1 + 2?"}
+    assert messages[2]["tool_calls"][0]["id"] == "call_1"
+    assert messages[3] == {"role": "tool", "content": "3", "tool_call_id": "call_1"}
+
+
+def test_async_agent_runs_a_streamed_tool_call_turn(fake_llm):
+    script_tool_call_turn(fake_llm)
+
+    async def add(a, b):
+        return a + b
+
+    async def run():
+        client = AsyncOpenAI(base_url=fake_llm.url, api_key="test")
+        agent = AsyncToolCallingAgent(
+            "fake-llm",
+            [ToolInfo(name="add", spec=ADD_SPEC, exec_fn=add)],
+            model_serving_client=client,
+            system_prompt="Be brief",
+        )
+        try:
+            return [event async for event in agent.predict_stream(REQUEST)]
+        finally:
+            await client.close()
+
+    assert_tool_call_turn(fake_llm, asyncio.run(run()))
+
+
+def test_async_agent_runs_sync_tools_in_a_thread(fake_llm):
+    script_tool_call_turn(fake_llm)
+    tool_threads = []
+
+    def add(a, b):
+        tool_threads.append(threading.get_ident())
+        return a + b
+
+    async def run():
+        client = AsyncOpenAI(base_url=fake_llm.url, api_key="test")
+        agent = AsyncToolCallingAgent(
+            "fake-llm",
+            [ToolInfo(name="add", spec=ADD_SPEC, exec_fn=add)],
+            model_serving_client=client,
+            system_prompt="Be brief",
+        )
+        try:
+            response = await agent.predict(REQUEST)
+        finally:
+            await client.close()
+        return response, threading.get_ident()
+
+    response, loop_thread = asyncio.run(run())
+    assert response.output[-1].content[0]["text"] == "The answer is 3"
+    assert tool_threads and tool_threads[0] != loop_thread
+
+
+def test_sync_agent_runs_a_streamed_tool_call_turn(fake_llm):
+    script_tool_call_turn(fake_llm)
+    client = OpenAI(base_url=fake_llm.url, api_key="test")
+    agent = ToolCallingAgent(
+        "fake-llm",
+        [ToolInfo(name="add", spec=ADD_SPEC, exec_fn=lambda a, b: a + b)],
+        model_serving_client=client,
+        system_prompt="Be brief",
+    )
+    try:
+        events = list(agent.predict_stream(REQUEST))
+    finally:
+        client.close()
+    assert_tool_call_turn(fake_llm, events)
+
+
+LOOKUP_SPEC = {
+    "type": "function",
+    "function": {
+        "name": "lookup",
+        "description": "Look up a city's population",
+        "parameters": {"type": "object", "properties": {"city": {"type": "string"}}},
+    },
+}
+
+# Seconds each lookup takes; the first call is the slowest, so it finishes last
+LOOKUP_DELAYS = {"Paris": 0.4, "Rome": 0.05, "Oslo": 0.2}
+
+
+def script_parallel_tool_call_turn(fake_llm) -> None:
+    """The LLM streams three lookup calls in one turn, their fragments interleaved, then answers"""
+    cities = list(LOOKUP_DELAYS)
+    chunks = [completion_chunk({"role": "assistant", "content": None})]
+    for index in range(len(cities)):
+        tool_call = {
+            "index": index,
+            "id": f"call_{index}",
+            "function": {"name": "lookup", "arguments": ""},
+        }
+        chunks.append(completion_chunk({"tool_calls": [tool_call]}))
+    for index in range(len(cities)):
+        fragment = {"index": index, "function": {"arguments": '{"city": '}}
+        chunks.append(completion_chunk({"tool_calls": [fragment]}))
+    for index, city in reversed(list(enumerate(cities))):
+        fragment = {"index": index, "function": {"arguments": f'"{city}"}}'}}
+        chunks.append(completion_chunk({"tool_calls": [fragment]}))
+    chunks.append(completion_chunk({}, finish_reason="tool_calls"))
+    fake_llm.responses.append(chunks)
+    fake_llm.responses.append(
+        [
+            completion_chunk({"role": "assistant", "content": "Done"}),
+            completion_chunk({}, finish_reason="stop"),
+        ]
+    )
+
+
+def assert_parallel_tool_call_turn(fake_llm, events, elapsed: float) -> None:
+    outputs = [
+        event.item
+        for event in events
+        if event.type == "response.output_item.done"
+        and event.item["type"] == "function_call_output"
+    ]
+    # Every output is emitted, as each call finishes
+    assert [item["call_id"] for item in outputs] == ["call_1", "call_2", "call_0"]
+    assert {item["call_id"]: item["output"] for item in outputs} == {
+        "call_0": "Paris: 0.4",
+        "call_1": "Rome: 0.05",
+        "call_2": "Oslo: 0.2",
+    }
+    # The calls overlapped instead of running one after another
+    assert elapsed < sum(LOOKUP_DELAYS.values())
+
+    # The history sent back to the LLM records the outputs in call order
+    messages = fake_llm.requests[1]["messages"]
+    assert [call["id"] for call in messages[1]["tool_calls"]] == ["call_0", "call_1", "call_2"]
+    assert messages[2:] == [
+        {"role": "tool", "content": "Paris: 0.4", "tool_call_id": "call_0"},
+        {"role": "tool", "content": "Rome: 0.05", "tool_call_id": "call_1"},
+        {"role": "tool", "content": "Oslo: 0.2", "tool_call_id": "call_2"},
+    ]
+
+
+@pytest.mark.parametrize("is_async", [True, False])
+def test_agents_run_the_tool_calls_of_a_turn_concurrently(fake_llm, is_async):
+    script_parallel_tool_call_turn(fake_llm)
+
+    def lookup(city):
+        time.sleep(LOOKUP_DELAYS[city])
+        return f"{city}: {LOOKUP_DELAYS[city]}"
+
+    tools = [ToolInfo(name="lookup", spec=LOOKUP_SPEC, exec_fn=lookup)]
+    start = time.perf_counter()
+    if is_async:
+
+        async def run():
+            client = AsyncOpenAI(base_url=fake_llm.url, api_key="test")
+            agent = AsyncToolCallingAgent("fake-llm", tools, model_serving_client=client)
+            try:
+                return [event async for event in agent.predict_stream(REQUEST)]
+            finally:
+                await client.close()
+
+        events = asyncio.run(run())
+    else:
+        client = OpenAI(base_url=fake_llm.url, api_key="test")
+        agent = ToolCallingAgent("fake-llm", tools, model_serving_client=client)
+        try:
+            events = list(agent.predict_stream(REQUEST))
+        finally:
+            client.close()
+    assert_parallel_tool_call_turn(fake_llm, events, time.perf_counter() - start)
+
+
+def test_databricks_auth_refreshes_credentials_off_the_event_loop():
+    auth_threads = []
+
+    class FakeConfig:
+        def authenticate(self):
+            auth_threads.append(threading.get_ident())
+            return {"Authorization": "Bearer test-token"}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={"authorization": request.headers["Authorization"]})
+
+    async def run():
+        async with httpx.AsyncClient(
+            auth=DatabricksAuth(FakeConfig()), transport=httpx.MockTransport(handler)
+        ) as client:
+            response = await client.get("http://workspace/serving-endpoints")
+        return response.json(), threading.get_ident()
+
+    body, loop_thread = asyncio.run(run())
+    assert body == {"authorization": "Bearer test-token"}
+    assert auth_threads and auth_threads[0] != loop_thread
+
+
+def script_early_tool_call(fake_llm, tail: list) -> None:
+    """The LLM completes a lookup call, then keeps streaming `tail` before the turn ends"""
+    tool_call = {
+        "index": 0,
+        "id": "call_0",
+        "function": {"name": "lookup", "arguments": '{"city": "Rome"}'},
+    }
+    fake_llm.responses.append(
+        [completion_chunk({"role": "assistant", "tool_calls": [tool_call]}), *tail]
+    )
+
+
+@pytest.mark.parametrize("is_async", [True, False])
+def test_tool_calls_start_before_the_llm_stream_ends(fake_llm, is_async):
+    script_early_tool_call(fake_llm, [0.3, completion_chunk({}, finish_reason="tool_calls")])
+    fake_llm.responses.append(
+        [completion_chunk({"content": "Done"}), completion_chunk({}, finish_reason="stop")]
+    )
+    started_at = []
+
+    def lookup(city):
+        started_at.append(time.monotonic())
+        return "ok"
+
+    tools = [ToolInfo(name="lookup", spec=LOOKUP_SPEC, exec_fn=lookup)]
+    if is_async:
+
+        async def run():
+            client = AsyncOpenAI(base_url=fake_llm.url, api_key="test")
+            agent = AsyncToolCallingAgent("fake-llm", tools, model_serving_client=client)
+            try:
+                return await agent.predict(REQUEST)
+            finally:
+                await client.close()
+
+        response = asyncio.run(run())
+    else:
+        client = OpenAI(base_url=fake_llm.url, api_key="test")
+        agent = ToolCallingAgent("fake-llm", tools, model_serving_client=client)
+        try:
+            response = agent.predict(REQUEST)
+        finally:
+            client.close()
+
+    assert response.output[-1].content[0]["text"] == "Done"
+    assert len(started_at) == 1
+    assert started_at[0] < fake_llm.finished_at[0]
+
+
+def test_started_tool_calls_are_cancelled_when_the_response_fails(fake_llm):
+    script_early_tool_call(fake_llm, [0.1, b'data: {"broken\n\n'])
+    started = asyncio.Event()
+    outcome = []
+
+    async def lookup(city):
+        started.set()
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            outcome.append("cancelled")
+            raise
+        outcome.append("finished")
+
+    async def run():
+        client = AsyncOpenAI(base_url=fake_llm.url, api_key="test", max_retries=0)
+        agent = AsyncToolCallingAgent(
+            "fake-llm",
+            [ToolInfo(name="lookup", spec=LOOKUP_SPEC, exec_fn=lookup)],
+            model_serving_client=client,
+        )
+        try:
+            with pytest.raises(Exception):
+                await agent.predict(REQUEST)
+            assert started.is_set()
+            # Let the cancellation reach the tool
+            await asyncio.sleep(0.05)
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+    assert outcome == ["cancelled"]
+    assert len(fake_llm.requests) == 1
+
+
+def test_async_agent_is_configured_like_the_sync_agent():
+    options = {
+        "tools": [ToolInfo(name="add", spec=ADD_SPEC, exec_fn=lambda a, b: a + b, cacheable=True)],
+        "context_window": object(),
+        "completion_cache": object(),
+        "system_prompt": "Be brief",
+    }
+    sync_agent = ToolCallingAgent(
+        "fake-llm", model_serving_client=OpenAI(api_key="test"), **options
+    )
+    async_agent = AsyncToolCallingAgent(
+        "fake-llm", model_serving_client=AsyncOpenAI(api_key="test"), **options
+    )
+    assert vars(async_agent).keys() == vars(sync_agent).keys()
+    for name in ["llm_endpoint", "_tools_dict", "context_window", "completion_cache"]:
+        assert getattr(async_agent, name) == getattr(sync_agent, name)
+    assert async_agent.system_prompt == "Be brief"
+    assert isinstance(async_agent.model_serving_client, AsyncOpenAI)
+    assert async_agent._tool_caches.keys() == {"add"}
@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+import pytest
+
+from agent_server.tools import ToolResultCache, ToolRunner, ToolTimeoutError, tool_cache_stats
+
+
+def test_waiters_run_the_tool_when_the_executing_call_is_cancelled():
+    cache = ToolResultCache("lookup")
+    calls = []
+
+    async def call():
+        calls.append(None)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    async def main():
+        leader = asyncio.ensure_future(cache.aget_or_call({"q": 1}, call))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.aget_or_call({"q": 1}, call))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == 2
+    assert cache.get_or_call({"q": 1}, lambda: 0) == 2
+
+
+def test_errors_reach_waiters_and_are_not_cached():
+    cache = ToolResultCache("lookup")
+
+    async def call():
+        await asyncio.sleep(0.05)
+        raise ValueError("bad arguments")
+
+    async def main():
+        return await asyncio.gather(
+            cache.aget_or_call({"q": 1}, call),
+            cache.aget_or_call({"q": 1}, call),
+            return_exceptions=True,
+        )
+
+    assert [type(e) for e in asyncio.run(main())] == [ValueError, ValueError]
+    assert cache.stats()["coalesced"] == 1
+    assert cache.get_or_call({"q": 1}, lambda: "ok") == "ok"
+
+
+def test_a_cancelled_waiter_does_not_cancel_the_execution():
+    cache = ToolResultCache("lookup")
+
+    async def call():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def main():
+        leader = asyncio.ensure_future(cache.aget_or_call({"q": 1}, call))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.aget_or_call({"q": 1}, call))
+        await asyncio.sleep(0)
+        follower.cancel()
+        return await leader
+
+    assert asyncio.run(main()) == "done"
+
+
+def test_stats_of_caches_for_the_same_tool_are_summed():
+    first = ToolResultCache("weather-lookup")
+    second = ToolResultCache("weather-lookup")
+    first.get_or_call({"city": "Rome"}, lambda: "sunny")
+    first.get_or_call({"city": "Rome"}, lambda: "sunny")
+    second.get_or_call({"city": "Oslo"}, lambda: "snow")
+
+    stats = tool_cache_stats()["weather-lookup"]
+    assert stats["size"] == 2
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    # The caches' own stats are left as they are
+    assert first.stats()["size"] == 1
+
+
+def test_calls_past_their_timeout_raise_tool_timeout_error():
+    runner = ToolRunner(max_workers=2)
+    futures = [
+        runner.start(lambda: time.sleep(0.5) or "slow", timeout=0.05),
+        runner.start(lambda: "fast"),
+    ]
+    started = time.perf_counter()
+    results = []
+    with pytest.raises(ToolTimeoutError) as exc_info:
+        for index, result in runner.results(futures):
+            results.append((index, result))
+
+    # Finished calls are still yielded; waiting stops at the timeout, not when the call ends
+    assert results == [(1, "fast")]
+    assert exc_info.value.timeout == 0.05
+    assert time.perf_counter() - started < 0.4
+    runner.shutdown()
+
+
+def test_async_calls_past_their_timeout_raise_tool_timeout_error():
+    runner = ToolRunner()
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(0.5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def main():
+        tasks = [runner.astart(slow, timeout=0.05), runner.astart(lambda: time.sleep(0.5), 0.05)]
+        with pytest.raises(ToolTimeoutError) as exc_info:
+            async for _ in runner.aresults(tasks):
+                pass
+        return exc_info.value
+
+    started = time.perf_counter()
+    error = asyncio.run(main())
+    assert error.timeout == 0.05
+    assert cancelled == [True]
+    assert time.perf_counter() - started < 0.4
+    runner.shutdown()
@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from agent_server.tracing import PendingSpan, StreamOutputReducer, TraceExporter, TraceSink
+
+
+def delta(item_id, text: str) -> dict:
+    return {"type": "response.output_text.delta", "item_id": item_id, "delta": text}
+
+
+def done(item_id: str, text: str) -> dict:
+    return {
+        "type": "response.output_item.done",
+        "item": {
+            "type": "message",
+            "role": "assistant",
+            "id": item_id,
+            "content": [{"type": "output_text", "text": text}],
+        },
+    }
+
+
+def texts(reducer: StreamOutputReducer) -> list[str]:
+    return [item["content"][0]["text"] for item in reducer.output()["output"]]
+
+
+def test_completed_text_is_output_once():
+    reducer = StreamOutputReducer("agent/v1/responses")
+    for chunk in [delta("a", "Hel"), delta("a", "lo"), done("a", "Hello")]:
+        reducer.add(chunk)
+    assert texts(reducer) == ["Hello"]
+
+
+def test_deltas_with_another_id_than_their_done_item_are_not_duplicated():
+    reducer = StreamOutputReducer("agent/v1/responses")
+    for chunk in [delta(None, "Hel"), delta(None, "lo"), done("msg-1", "Hello")]:
+        reducer.add(chunk)
+    assert texts(reducer) == ["Hello"]
+
+
+def test_text_of_an_unfinished_item_is_output():
+    reducer = StreamOutputReducer("agent/v1/responses")
+    for chunk in [delta("a", "Hello"), done("a", "Hello"), delta("b", "Wor")]:
+        reducer.add(chunk)
+    assert texts(reducer) == ["Hello", "Wor"]
+
+
+def test_unfinished_text_counts_against_max_items():
+    reducer = StreamOutputReducer("agent/v1/responses", max_items=2)
+    for chunk in [done("a", "one"), done("b", "two"), delta("c", "thr")]:
+        reducer.add(chunk)
+    assert texts(reducer) == ["one", "two"]
+    assert reducer.dropped_items == 1
+
+
+class StuckSink(TraceSink):
+    """Blocks the exporter's worker until released"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.exporting = threading.Event()
+        self.closed = False
+
+    def export(self, records):
+        self.exporting.set()
+        self.release.wait()
+
+    def close(self):
+        self.closed = True
+
+
+def stuck_exporter(**kwargs) -> tuple[TraceExporter, StuckSink]:
+    """An exporter whose worker is stuck exporting one span, with a full queue of size 1"""
+    sink = StuckSink()
+    exporter = TraceExporter(sinks=[sink], max_queue_size=1, flush_interval=0.01, **kwargs)
+
+    async def fill():
+        await exporter.submit(PendingSpan(None))
+        sink.exporting.wait(5)
+        await exporter.submit(PendingSpan(None))
+
+    asyncio.run(fill())
+    return exporter, sink
+
+
+def test_shutdown_drops_what_a_stuck_worker_cannot_finish():
+    exporter, sink = stuck_exporter()
+    start = time.monotonic()
+    exporter.shutdown(timeout=0.2)
+
+    assert time.monotonic() - start < 1
+    assert exporter.stats()["dropped"] == 1
+    assert sink.closed
+    sink.release.set()
+
+
+def test_block_policy_waits_without_blocking_the_event_loop():
+    exporter, sink = stuck_exporter(drop_policy="block", block_timeout=0.3)
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    async def main():
+        ticker = asyncio.ensure_future(tick())
+        queued = await exporter.submit(PendingSpan(None))
+        ticker.cancel()
+        return queued
+
+    assert asyncio.run(main()) is False
+    assert ticks >= 10
+    assert exporter.stats()["dropped"] == 1
+
+    async def release_soon():
+        asyncio.get_running_loop().call_later(0.05, sink.release.set)
+        return await exporter.submit(PendingSpan(None))
+
+    assert asyncio.run(release_soon()) is True
+    exporter.shutdown()
+
+
+def test_sinks_must_implement_export():
+    class NoExport(TraceSink):
+        def close(self) -> None:
+            pass
+
+    with pytest.raises(TypeError, match="export"):
+        NoExport()
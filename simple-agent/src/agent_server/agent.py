@@ -1,25 +1,20 @@
 import asyncio
-import json
-from typing import Any, AsyncGenerator, Callable, Generator, Optional
-from uuid import uuid4
+from typing import AsyncGenerator, Callable, Generator, Optional
 
 import mlflow
-import openai
-from databricks.sdk import WorkspaceClient
 from databricks_openai import UCFunctionToolkit, VectorSearchRetrieverTool
-from mlflow.entities import SpanType
-from mlflow.pyfunc import ResponsesAgent
 from mlflow.types.responses import (
     ResponsesAgentRequest,
     ResponsesAgentResponse,
     ResponsesAgentStreamEvent,
 )
-from openai import OpenAI
-from pydantic import BaseModel
 from unitycatalog.ai.core.base import get_uc_function_client
 
+from agent_server.completion_cache import CompletionCache, InMemoryCompletionBackend
+from agent_server.context import ContextWindow
 from agent_server.mlflow_config import setup_mlflow
-from agent_server.server import create_server, invoke, stream
+from agent_server.server import create_server, invoke, run_workers, server_workers, stream
+from agent_server.tool_agent import AsyncToolCallingAgent, ToolCallingAgent, ToolInfo
 
 # ############################################
 # # Define your LLM endpoint and system prompt
@@ -28,6 +23,14 @@ from agent_server.server import create_server, invoke, stream
 
 # SYSTEM_PROMPT = """"""
 
+# # Token budget for messages sent to the LLM; older history is trimmed to fit (see ContextWindow)
+# CONTEXT_WINDOW = ContextWindow(max_tokens=100_000, max_tool_output_tokens=8_000)
+
+# # Replays the response to an identical LLM request instead of calling the endpoint again. Only
+# # enable it where repeating an earlier answer is acceptable (see CompletionCache)
+# COMPLETION_CACHE = None
+# # COMPLETION_CACHE = CompletionCache(InMemoryCompletionBackend(max_entries=1024), ttl=3600)
+
 
 # ###############################################################################
 # ## Define tools for your agent, enabling it to retrieve data or take actions
@@ -35,20 +38,8 @@ from agent_server.server import create_server, invoke, stream
 # ## To create and see usage examples of more tools, see
 # ## https://docs.databricks.com/generative-ai/agent-framework/agent-tool.html
 # ###############################################################################
-# class ToolInfo(BaseModel):
-#     """
-#     Class representing a tool for the agent.
-#     - "name" (str): The name of the tool.
-#     - "spec" (dict): JSON description of the tool (matches OpenAI Responses format)
-#     - "exec_fn" (Callable): Function that implements the tool logic
-#     """
-
-#     name: str
-#     spec: dict
-#     exec_fn: Callable
-
-
-# def create_tool_info(tool_spec, exec_fn_param: Optional[Callable] = None):
+# # See ToolInfo in agent_server.tool_agent for the per-tool cache and timeout options
+# def create_tool_info(tool_spec, exec_fn_param: Optional[Callable] = None, **tool_options):
 #     tool_spec["function"].pop("strict", None)
 #     tool_name = tool_spec["function"]["name"]
 #     udf_name = tool_name.replace("__", ".")
@@ -62,7 +53,9 @@ from agent_server.server import create_server, invoke, stream
 #         else:
 #             return function_result.value
 
-#     return ToolInfo(name=tool_name, spec=tool_spec, exec_fn=exec_fn_param or exec_fn)
+#     return ToolInfo(
+#         name=tool_name, spec=tool_spec, exec_fn=exec_fn_param or exec_fn, **tool_options
+#     )
 
 
 # TOOL_INFOS = []
@@ -74,6 +67,7 @@ from agent_server.server import create_server, invoke, stream
 # uc_toolkit = UCFunctionToolkit(function_names=UC_TOOL_NAMES)
 # uc_function_client = get_uc_function_client()
 # for tool_spec in uc_toolkit.tools:
+#     # Pass cacheable=True (and optionally cache_ttl / cache_max_entries) for deterministic tools
 #     TOOL_INFOS.append(create_tool_info(tool_spec))
 
 
@@ -93,198 +87,53 @@ from agent_server.server import create_server, invoke, stream
 # # )
 
 
-# class ToolCallingAgent(ResponsesAgent):
-#     """
-#     Class representing a tool-calling Agent
-#     """
-
-#     def __init__(self, llm_endpoint: str, tools: list[ToolInfo]):
-#         """Initializes the ToolCallingAgent with tools."""
-#         self.llm_endpoint = llm_endpoint
-#         self.workspace_client = WorkspaceClient()
-#         self.model_serving_client: OpenAI = (
-#             self.workspace_client.serving_endpoints.get_open_ai_client()
-#         )
-#         # Internal message list holds conversation state in completion-message format
-#         self.messages: list[dict[str, Any]] = None
-#         self._tools_dict = {tool.name: tool for tool in tools}
-
-#     def get_tool_specs(self) -> list[dict]:
-#         """Returns tool specifications in the format OpenAI expects."""
-#         return [tool_info.spec for tool_info in self._tools_dict.values()]
-
-#     @mlflow.trace(span_type=SpanType.TOOL)
-#     def execute_tool(self, tool_name: str, args: dict) -> Any:
-#         """Executes the specified tool with the given arguments."""
-#         return self._tools_dict[tool_name].exec_fn(**args)
-
-#     def _responses_to_cc(self, message: dict[str, Any]) -> list[dict[str, Any]]:
-#         """Convert from a Responses API output item to  a list of ChatCompletion messages."""
-#         msg_type = message.get("type")
-#         if msg_type == "function_call":
-#             return [
-#                 {
-#                     "role": "assistant",
-#                     "content": "tool call",  # empty content is not supported by claude models
-#                     "tool_calls": [
-#                         {
-#                             "id": message["call_id"],
-#                             "type": "function",
-#                             "function": {
-#                                 "arguments": message["arguments"],
-#                                 "name": message["name"],
-#                             },
-#                         }
-#                     ],
-#                 }
-#             ]
-#         elif msg_type == "message" and isinstance(message.get("content"), list):
-#             return [
-#                 {"role": message["role"], "content": content["text"]}
-#                 for content in message["content"]
-#             ]
-#         elif msg_type == "reasoning":
-#             return [{"role": "assistant", "content": json.dumps(message["summary"])}]
-#         elif msg_type == "function_call_output":
-#             return [
-#                 {
-#                     "role": "tool",
-#                     "content": message["output"],
-#                     "tool_call_id": message["call_id"],
-#                 }
-#             ]
-#         compatible_keys = ["role", "content", "name", "tool_calls", "tool_call_id"]
-#         if not message.get("content") and message.get("tool_calls"):
-#             message["content"] = "tool call"
-#         filtered = {k: v for k, v in message.items() if k in compatible_keys}
-#         return [filtered] if filtered else []
-
-#     def prep_msgs_for_llm(self, messages: list[dict[str, Any]]) -> list[dict[str, Any]]:
-#         """Filter out message fields that are not compatible with LLM message formats and convert from Responses API to ChatCompletion compatible"""
-#         chat_msgs = []
-#         for msg in messages:
-#             chat_msgs.extend(self._responses_to_cc(msg))
-#         return chat_msgs
-
-#     def call_llm(self) -> Generator[dict[str, Any], None, None]:
-#         for chunk in self.model_serving_client.chat.completions.create(
-#             model=self.llm_endpoint,
-#             messages=self.prep_msgs_for_llm(self.messages),
-#             tools=self.get_tool_specs(),
-#             stream=True,
-#         ):
-#             yield chunk.to_dict()
-
-#     def handle_tool_calls(
-#         self, tool_calls: list[dict[str, Any]]
-#     ) -> Generator[ResponsesAgentStreamEvent, None, None]:
-#         """
-#         Execute tool calls, add them to the running message history, and return a ResponsesStreamEvent w/ tool output
-#         """
-#         for tool_call in tool_calls:
-#             function = tool_call["function"]
-#             args = json.loads(function["arguments"])
-#             # Cast tool result to a string, since not all tools return as tring
-#             result = str(self.execute_tool(tool_name=function["name"], args=args))
-#             self.messages.append(
-#                 {"role": "tool", "content": result, "tool_call_id": tool_call["id"]}
-#             )
-#             yield ResponsesAgentStreamEvent(
-#                 type="response.output_item.done",
-#                 item=self.create_function_call_output_item(
-#                     tool_call["id"],
-#                     result,
-#                 ),
-#             )
-
-#     def call_and_run_tools(
-#         self,
-#         max_iter: int = 10,
-#     ) -> Generator[ResponsesAgentStreamEvent, None, None]:
-#         for _ in range(max_iter):
-#             last_msg = self.messages[-1]
-#             if tool_calls := last_msg.get("tool_calls", None):
-#                 yield from self.handle_tool_calls(tool_calls)
-#             elif last_msg.get("role", None) == "assistant":
-#                 return
-#             else:
-#                 # aggregate the chat completions stream to add to internal state
-#                 llm_content = ""
-#                 tool_calls = []
-#                 msg_id = None
-#                 for chunk in self.call_llm():
-#                     delta = chunk["choices"][0]["delta"]
-#                     msg_id = chunk.get("id", None)
-#                     content = delta.get("content", None)
-#                     if tc := delta.get("tool_calls"):
-#                         if not tool_calls:  # only accomodate for single tool call right now
-#                             tool_calls = tc
-#                         else:
-#                             tool_calls[0]["function"]["arguments"] += tc[0]["function"]["arguments"]
-#                     elif content is not None:
-#                         llm_content += content
-#                         yield ResponsesAgentStreamEvent(
-#                             **self.create_text_delta(content, item_id=msg_id)
-#                         )
-#                 llm_output = {"role": "assistant", "content": llm_content, "tool_calls": tool_calls}
-#                 self.messages.append(llm_output)
-
-#                 # yield an `output_item.done` `output_text` event that aggregates the stream
-#                 # this enables tracing and payload logging
-#                 if llm_output["content"]:
-#                     yield ResponsesAgentStreamEvent(
-#                         type="response.output_item.done",
-#                         item=self.create_text_output_item(llm_output["content"], msg_id),
-#                     )
-#                 # yield an `output_item.done` `function_call` event for each tool call
-#                 if tool_calls := llm_output.get("tool_calls", None):
-#                     for tool_call in tool_calls:
-#                         yield ResponsesAgentStreamEvent(
-#                             type="response.output_item.done",
-#                             item=self.create_function_call_item(
-#                                 str(uuid4()),
-#                                 tool_call["id"],
-#                                 tool_call["function"]["name"],
-#                                 tool_call["function"]["arguments"],
-#                             ),
-#                         )
-
-#         yield ResponsesAgentStreamEvent(
-#             type="response.output_item.done",
-#             item=self.create_text_output_item("Max iterations reached. Stopping.", str(uuid4())),
-#         )
-
-#     def predict(self, request: ResponsesAgentRequest) -> ResponsesAgentResponse:
-#         outputs = [
-#             event.item
-#             for event in self.predict_stream(request)
-#             if event.type == "response.output_item.done"
-#         ]
-#         return ResponsesAgentResponse(output=outputs, custom_outputs=request.custom_inputs)
-
-#     def predict_stream(
-#         self, request: ResponsesAgentRequest
-#     ) -> Generator[ResponsesAgentStreamEvent, None, None]:
-#         self.messages = self.prep_msgs_for_llm([i.model_dump() for i in request.input])
-#         if SYSTEM_PROMPT:
-#             self.messages.insert(0, {"role": "system", "content": SYSTEM_PROMPT})
-#         yield from self.call_and_run_tools()
-
-
 # mlflow.openai.autolog()
-# AGENT = ToolCallingAgent(llm_endpoint=LLM_ENDPOINT_NAME, tools=TOOL_INFOS)
-
-
+# # ToolCallingAgent and AsyncToolCallingAgent live in agent_server.tool_agent.
+# # A single agent instance safely serves concurrent requests. The async agent runs every request
+# # on the server's event loop.
+# AGENT = AsyncToolCallingAgent(
+#     llm_endpoint=LLM_ENDPOINT_NAME,
+#     tools=TOOL_INFOS,
+#     context_window=CONTEXT_WINDOW,
+#     completion_cache=COMPLETION_CACHE,
+#     system_prompt=SYSTEM_PROMPT,
+# )
+
+
+# # Annotated with ResponsesAgentRequest, the functions get the request object the server already
+# # validated instead of the request dict
 # @invoke()
-# def predict(request: dict) -> ResponsesAgentResponse:
-#     return AGENT.predict(ResponsesAgentRequest(**request))
+# async def predict(request: ResponsesAgentRequest) -> ResponsesAgentResponse:
+#     return await AGENT.predict(request)
 
 
 # @stream()
-# def predict_stream(
-#     request: dict,
-# ) -> Generator[ResponsesAgentStreamEvent, None, None]:
-#     yield from AGENT.predict_stream(ResponsesAgentRequest(**request))
+# async def predict_stream(
+#     request: ResponsesAgentRequest,
+# ) -> AsyncGenerator[ResponsesAgentStreamEvent, None]:
+#     async for event in AGENT.predict_stream(request):
+#         yield event
+
+
+# # # To use the sync agent instead, register plain functions; the server runs them on its
+# # # sync thread pool
+# # AGENT = ToolCallingAgent(
+# #     llm_endpoint=LLM_ENDPOINT_NAME,
+# #     tools=TOOL_INFOS,
+# #     context_window=CONTEXT_WINDOW,
+# #     completion_cache=COMPLETION_CACHE,
+# #     system_prompt=SYSTEM_PROMPT,
+# # )
+# #
+# # @invoke()
+# # def predict(request: ResponsesAgentRequest) -> ResponsesAgentResponse:
+# #     return AGENT.predict(request)
+# #
+# # @stream()
+# # def predict_stream(
+# #     request: ResponsesAgentRequest,
+# # ) -> Generator[ResponsesAgentStreamEvent, None, None]:
+# #     yield from AGENT.predict_stream(request)
 
 
 # Example for ResponsesAgent
@@ -329,11 +178,33 @@ async def stream(
     }
 
 
-def main():
-    server = create_server("agent/v1/responses")
+def server_kwargs() -> dict:
+    """Options for create_server(), shared by main() and create_app() so that every worker
+    process serves the same configuration. Built per process, so stores and exporters with
+    their own connections or threads aren't shared across a fork."""
+    return {
+        "agent_type": "agent/v1/responses",
+        # See AgentServer for the available options, e.g.
+        # "max_concurrent_invokes": 64,
+        # "trace_sampler": RatioTraceSampler(0.1),
+    }
+
+
+def create_app():
+    """App factory used by each worker process when serving with multiple workers."""
     setup_mlflow()
+    return create_server(**server_kwargs()).app
+
+
+def main():
     print("Single endpoint: POST /invocations")
+    if server_workers() > 1:
+        # Each worker process builds its own server with create_app()
+        run_workers("agent_server.agent:create_app")
+        return
 
+    server = create_server(**server_kwargs())
+    setup_mlflow()
     server.run()
 
 
@@ -0,0 +1,289 @@
+"""Offline batch runner: sends every request in a JSONL file straight to the agent, without HTTP.
+
+Run with `agent-batch requests.jsonl -o results.jsonl` or `python -m agent_server.batch ...`.
+"""
+
+import argparse
+import asyncio
+import importlib
+import inspect
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
+from typing import Any, BinaryIO, Iterator, Optional, get_args
+
+from agent_server import serialization, server
+from agent_server.cancellation import (
+    DEADLINE_EXCEEDED,
+    CancelToken,
+    RequestCancelled,
+    set_current_token,
+)
+from agent_server.executor import SyncExecutor
+from agent_server.tracing import StreamOutputReducer
+
+
+def read_requests(path: str, skip: frozenset[int] = frozenset()) -> Iterator[tuple[int, Any]]:
+    """Yield (index, request) for each non-blank line of a JSONL file, reading it lazily.
+
+    Indexes count non-blank lines from 0, like /invocations/batch. Lines in `skip` are not
+    parsed, and a line that isn't valid JSON is yielded as its exception.
+    """
+    with open(path, "rb") as f:
+        index = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if index not in skip:
+                try:
+                    yield index, serialization.loads(line)
+                except Exception as e:
+                    yield index, ValueError(f"Invalid JSON: {e}")
+            index += 1
+
+
+def completed_indexes(path: str) -> frozenset[int]:
+    """Indexes answered successfully in an earlier run's output file.
+
+    A last line cut off by an interruption is truncated, so appended results start on a fresh
+    line. Failed requests are not included and run again.
+    """
+    if not os.path.exists(path):
+        return frozenset()
+    done = set()
+    with open(path, "rb+") as f:
+        end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            end += len(line)
+            try:
+                record = serialization.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and "response" in record:
+                done.add(record["index"])
+        f.truncate(end)
+    return frozenset(done)
+
+
+def _run_in_process(agent_type: Optional[str], stream: bool, request: Any) -> dict:
+    """Run a sync agent on one request in a pool process, where the agent module was imported"""
+    validator = server.AgentValidator(agent_type)
+    if not stream:
+        return validator.validate_and_convert_result(server._invoke_function(request))
+    reducer = StreamOutputReducer(agent_type, max_items=None)
+    for chunk in server._stream_function(request):
+        reducer.add(validator.validate_and_convert_result(chunk, stream=True))
+    return reducer.output()
+
+
+class BatchRunner:
+    """Runs requests through the registered invoke (or stream) function, `concurrency` at a time.
+
+    Async agents run on the event loop. Sync agents run on a SyncExecutor of `concurrency`
+    threads, or in `processes` worker processes that import `agent_module`. With `stream`, the
+    stream function is used and its output items are collected into one response. A request
+    running longer than `timeout` seconds fails; agents see the deadline through their
+    CancelToken, but calls in worker processes can't be interrupted.
+    """
+
+    def __init__(
+        self,
+        agent_type: Optional[server.AgentType] = "agent/v1/responses",
+        concurrency: int = 8,
+        stream: bool = False,
+        processes: Optional[int] = None,
+        agent_module: str = "agent_server.agent",
+        timeout: Optional[float] = None,
+    ):
+        self.func = server._stream_function if stream else server._invoke_function
+        if self.func is None:
+            kind = "stream" if stream else "invoke"
+            raise ValueError(f"No {kind} function registered by {agent_module}")
+        self.agent_type = agent_type
+        self.concurrency = concurrency
+        self.stream = stream
+        self.timeout = timeout
+        self.validator = server.AgentValidator(agent_type)
+        self.request_type = server._request_type(self.func)
+        self.is_async = inspect.iscoroutinefunction(self.func) or inspect.isasyncgenfunction(
+            self.func
+        )
+        self.sync_executor = None
+        self.process_pool = None
+        if processes is not None:
+            if self.is_async:
+                raise ValueError("processes only apply to synchronous agents")
+            self.process_pool = ProcessPoolExecutor(
+                processes, initializer=importlib.import_module, initargs=(agent_module,)
+            )
+        elif not self.is_async:
+            self.sync_executor = SyncExecutor(concurrency)
+        self.succeeded = 0
+        self.failed = 0
+
+    async def _call_agent(self, request: Any) -> dict:
+        if self.process_pool is not None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.process_pool, _run_in_process, self.agent_type, self.stream, request
+            )
+        if not self.stream:
+            if self.is_async:
+                result = await self.func(request)
+            else:
+                result = await self.sync_executor.run(self.func, request)
+            return self.validator.validate_and_convert_result(result)
+
+        reducer = StreamOutputReducer(self.agent_type, max_items=None)
+        if self.is_async:
+            chunks = self.func(request)
+        else:
+            chunks = self.sync_executor.iterate(self.func, request)
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                reducer.add(
+                    self.validator.validate_and_convert_result(
+                        chunk, stream=True, chunk_index=reducer.chunk_count
+                    )
+                )
+        return reducer.output()
+
+    async def _run_request(self, index: int, request: Any) -> bytes:
+        """The output line for one request: its response, or the error it failed with, in the
+        same format as /invocations/batch"""
+        if isinstance(request, Exception):
+            return self._error_line(index, 400, str(request))
+        if not isinstance(request, dict):
+            return self._error_line(index, 400, "Request must be a JSON object")
+        request.pop("stream", None)
+        try:
+            validated = self.validator.validate_request(request)
+        except ValueError as e:
+            return self._error_line(index, 400, f"Invalid parameters for {self.agent_type}: {e}")
+        # Agents annotated with the request model get the validated object, like in the server
+        if self.request_type is not None and isinstance(validated, self.request_type):
+            request = validated
+
+        try:
+            # Each request runs in its own task, so the token only applies to this one
+            token = CancelToken(self.timeout)
+            set_current_token(token)
+            timeout = asyncio.timeout(token.remaining())
+            try:
+                async with timeout:
+                    response = await self._call_agent(request)
+            except TimeoutError:
+                if not timeout.expired():
+                    raise
+                token.cancel(DEADLINE_EXCEEDED)
+                raise RequestCancelled(DEADLINE_EXCEEDED) from None
+        except Exception as e:
+            return self._error_line(index, server.AgentServer._failure_status(e)[1], str(e))
+        self.succeeded += 1
+        return serialization.dumps({"index": index, "response": response}) + b"\n"
+
+    def _error_line(self, index: int, status_code: int, detail: str) -> bytes:
+        self.failed += 1
+        error = {"status_code": status_code, "detail": detail}
+        return serialization.dumps({"index": index, "error": error}) + b"\n"
+
+    async def run(self, requests: Iterator[tuple[int, Any]], output: BinaryIO) -> None:
+        """Run (index, request) pairs, writing each output line as soon as its request finishes.
+
+        Requests are pulled from the iterator only as slots free up, so inputs of any size run
+        in constant memory. Output is flushed after every write, so an interrupted run can be
+        resumed from the output file.
+        """
+        pending: set[asyncio.Task] = set()
+        try:
+            while True:
+                for index, request in itertools.islice(requests, self.concurrency - len(pending)):
+                    pending.add(asyncio.ensure_future(self._run_request(index, request)))
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    output.write(task.result())
+                output.flush()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def shutdown(self) -> None:
+        if self.sync_executor is not None:
+            self.sync_executor.shutdown()
+        if self.process_pool is not None:
+            self.process_pool.shutdown(cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="JSONL file with one request per line")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file to write results to")
+    parser.add_argument(
+        "--agent-module",
+        default="agent_server.agent",
+        help="Module that registers the @invoke()/@stream() functions",
+    )
+    parser.add_argument(
+        "--agent-type",
+        default="agent/v1/responses",
+        choices=[*get_args(server.AgentType), "none"],
+        help="Use 'none' for agents without a known schema, whose requests aren't validated",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--stream", action="store_true", help="Use the stream function and collect its output"
+    )
+    parser.add_argument(
+        "--processes", type=int, help="Run a sync agent in this many processes instead of threads"
+    )
+    parser.add_argument("--timeout", type=float, help="Seconds before a request fails")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip requests already answered in the output file and append to it",
+    )
+    args = parser.parse_args()
+
+    importlib.import_module(args.agent_module)
+    skip = completed_indexes(args.output) if args.resume else frozenset()
+    runner = BatchRunner(
+        agent_type=None if args.agent_type == "none" else args.agent_type,
+        concurrency=args.concurrency,
+        stream=args.stream,
+        processes=args.processes,
+        agent_module=args.agent_module,
+        timeout=args.timeout,
+    )
+    start = time.perf_counter()
+    interrupted = False
+    try:
+        with open(args.output, "ab" if args.resume else "wb") as output:
+            asyncio.run(runner.run(read_requests(args.input, skip), output))
+    except KeyboardInterrupt:
+        interrupted = True
+    finally:
+        runner.shutdown()
+
+    elapsed = time.perf_counter() - start
+    finished = runner.succeeded + runner.failed
+    print(
+        f"{runner.succeeded} succeeded, {runner.failed} failed, {len(skip)} skipped "
+        f"in {elapsed:.1f}s ({finished / elapsed if elapsed else 0.0:.1f} requests/s)",
+        file=sys.stderr,
+    )
+    if interrupted:
+        print("Interrupted; rerun with --resume to continue", file=sys.stderr)
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
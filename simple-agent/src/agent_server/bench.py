@@ -0,0 +1,323 @@
+"""Micro-benchmarks for the agent server hot paths.
+
+Run with `python -m agent_server.bench <benchmark> [options]`.
+"""
+
+import argparse
+import json
+import time
+from typing import Callable
+
+from agent_server import serialization
+
+
+def _cpu_us_per_call(fn: Callable[[], None], iterations: int) -> float:
+    fn()  # warm up
+    start = time.process_time_ns()
+    for _ in range(iterations):
+        fn()
+    return (time.process_time_ns() - start) / iterations / 1000
+
+
+def _report(title: str, results: dict[str, float]) -> None:
+    print(title)
+    baseline = next(iter(results.values()))
+    for name, us in results.items():
+        print(f"  {name:<24} {us:>12.1f} us/request  ({baseline / us:.2f}x)")
+
+
+def synthetic_history(turns: int, text_size: int) -> list[dict]:
+    """Multi-turn Responses API input with user messages, tool calls and tool outputs"""
+    text = "lorem ipsum " * (text_size // 12)
+    items = []
+    for i in range(turns):
+        items.append({"role": "user", "content": f"question {i}: {text}"})
+        items.append(
+            {
+                "type": "function_call",
+                "id": f"fc_{i}",
+                "call_id": f"call_{i}",
+                "name": "system__ai__python_exec",
+                "arguments": json.dumps({"code": f"print({i} * 3)"}),
+            }
+        )
+        items.append({"type": "function_call_output", "call_id": f"call_{i}", "output": text})
+        items.append(
+            {
+                "type": "message",
+                "id": f"msg_{i}",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": text}],
+            }
+        )
+    return items
+
+
+def bench_serialization(args: argparse.Namespace) -> None:
+    """Per-request CPU spent on JSON for /invocations: previous triple-serialization vs single pass"""
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+
+    history = synthetic_history(args.turns, args.text_size)
+    body = json.dumps({"input": history, "stream": False}).encode()
+    result = {"output": history[-4:]}
+
+    def previous():
+        data = json.loads(body)
+        len(json.dumps(data))  # request_size
+        request_data = {k: v for k, v in data.items() if k != "stream"}
+        assert request_data
+        len(json.dumps(result))  # response_size
+        JSONResponse(jsonable_encoder(result))  # FastAPI response serialization
+
+    def single_pass():
+        data = serialization.loads(body)
+        data.pop("stream", False)
+        len(body)
+        len(serialization.dumps(result))
+
+    print(
+        f"request: {len(body) / 1024:.0f} KiB, {len(history)} input items, "
+        f"json backend: {serialization.JSON_BACKEND}"
+    )
+    _report(
+        "serialization",
+        {
+            "previous": _cpu_us_per_call(previous, args.iterations),
+            "single_pass": _cpu_us_per_call(single_pass, args.iterations),
+        },
+    )
+
+
+def bench_validation(args: argparse.Namespace) -> None:
+    """Per-stream CPU spent validating text delta chunks: every chunk vs sampled"""
+    from mlflow.types.responses import ResponsesAgentStreamEvent
+
+    from agent_server.server import AgentValidator
+
+    chunks = [
+        {"type": "response.output_text.delta", "item_id": "msg_1", "delta": f"token{i} "}
+        for i in range(args.chunks)
+    ]
+    every_chunk = AgentValidator("agent/v1/responses")
+    sampled = AgentValidator(
+        "agent/v1/responses",
+        validate_first_chunks=args.first,
+        validate_every_nth_chunk=args.every,
+    )
+
+    def previous():
+        for chunk in chunks:
+            ResponsesAgentStreamEvent(**chunk)
+
+    def validate(validator: AgentValidator) -> Callable[[], None]:
+        def run():
+            for i, chunk in enumerate(chunks):
+                validator.validate_and_convert_result(chunk, stream=True, chunk_index=i)
+
+        return run
+
+    print(f"stream: {args.chunks} text delta chunks")
+    _report(
+        "validation",
+        {
+            "previous": _cpu_us_per_call(previous, args.iterations),
+            "compiled": _cpu_us_per_call(validate(every_chunk), args.iterations),
+            f"sampled({args.first},{args.every})": _cpu_us_per_call(
+                validate(sampled), args.iterations
+            ),
+        },
+    )
+
+
+def bench_sse(args: argparse.Namespace) -> None:
+    """Per-stream CPU spent encoding text delta chunks into SSE frames"""
+    from agent_server.sse import SSEWriter
+
+    chunks = [
+        {"type": "response.output_text.delta", "item_id": "msg_1", "delta": f"token{i} "}
+        for i in range(args.chunks)
+    ]
+
+    def previous():
+        for chunk in chunks:
+            f"data: {json.dumps({'chunk': chunk})}\n\n".encode("utf-8")
+
+    def writer():
+        sse = SSEWriter()
+        for chunk in chunks:
+            sse.chunk(chunk)
+
+    print(f"stream: {args.chunks} text delta chunks, json backend: {serialization.JSON_BACKEND}")
+    _report(
+        "sse",
+        {
+            "previous": _cpu_us_per_call(previous, args.iterations),
+            "sse_writer": _cpu_us_per_call(writer, args.iterations),
+        },
+    )
+
+
+def bench_conversion(args: argparse.Namespace) -> None:
+    """Per-request CPU spent converting history to chat messages over a multi-turn tool loop"""
+    from agent_server.messages import to_chat_messages
+
+    history = synthetic_history(args.turns, args.text_size)
+    tool_call = {
+        "role": "assistant",
+        "content": "tool call",
+        "tool_calls": [
+            {
+                "id": "call_loop",
+                "type": "function",
+                "function": {"name": "system__ai__python_exec", "arguments": "{}"},
+            }
+        ],
+    }
+    tool_output = {"role": "tool", "content": "lorem ipsum", "tool_call_id": "call_loop"}
+
+    def previous():
+        # The whole history was re-converted before every LLM call
+        messages = to_chat_messages(history)
+        for _ in range(args.llm_calls):
+            to_chat_messages(messages)
+            messages.extend((tool_call, tool_output))
+
+    def incremental():
+        messages = to_chat_messages(history)
+        for _ in range(args.llm_calls):
+            messages.extend((tool_call, tool_output))
+
+    print(f"history: {len(history)} input items, {args.llm_calls} LLM calls per request")
+    _report(
+        "conversion",
+        {
+            "previous": _cpu_us_per_call(previous, args.iterations),
+            "incremental": _cpu_us_per_call(incremental, args.iterations),
+        },
+    )
+
+
+def synthetic_chunks(count: int, tool_calls: int) -> list:
+    """Chat completion chunks: text deltas, then interleaved tool call argument fragments"""
+    from openai.types.chat import ChatCompletionChunk
+
+    def chunk(delta: dict):
+        return ChatCompletionChunk.model_validate(
+            {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "bench",
+                "choices": [{"index": 0, "delta": delta}],
+            }
+        )
+
+    text_chunks = count // 2
+    chunks = [chunk({"content": "lorem "}) for _ in range(text_chunks)]
+    for index in range(tool_calls):
+        chunks.append(
+            chunk(
+                {
+                    "tool_calls": [
+                        {
+                            "index": index,
+                            "id": f"call_{index}",
+                            "type": "function",
+                            "function": {"name": "system__ai__python_exec", "arguments": ""},
+                        }
+                    ]
+                }
+            )
+        )
+    for i in range(count - len(chunks)):
+        fragment = {"index": i % tool_calls, "function": {"arguments": '"ab",'}}
+        chunks.append(chunk({"tool_calls": [fragment]}))
+    return chunks
+
+
+def bench_accumulate(args: argparse.Namespace) -> None:
+    """CPU spent assembling a streamed LLM response into text and tool calls"""
+    from agent_server.accumulator import StreamAccumulator
+
+    chunks = synthetic_chunks(args.chunks, args.tool_calls)
+
+    def previous():
+        # Every chunk was converted to a dict and fragments were concatenated with +=
+        llm_content = ""
+        tool_calls_by_index = {}
+        for chunk in chunks:
+            chunk = chunk.to_dict()
+            delta = chunk["choices"][0]["delta"]
+            if tc := delta.get("tool_calls"):
+                for fragment in tc:
+                    current = tool_calls_by_index.setdefault(
+                        fragment["index"],
+                        {"id": fragment.get("id"), "function": {"name": None, "arguments": ""}},
+                    )
+                    function = fragment.get("function") or {}
+                    current["function"]["name"] = current["function"]["name"] or function.get(
+                        "name"
+                    )
+                    current["function"]["arguments"] += function.get("arguments") or ""
+            elif (content := delta.get("content")) is not None:
+                llm_content += content
+
+    def accumulator():
+        stream = StreamAccumulator()
+        for chunk in chunks:
+            stream.add(chunk)
+        stream.text
+        stream.tool_calls()
+
+    print(f"stream: {len(chunks)} chunks, {args.tool_calls} tool calls")
+    _report(
+        "accumulate",
+        {
+            "previous": _cpu_us_per_call(previous, args.iterations),
+            "accumulator": _cpu_us_per_call(accumulator, args.iterations),
+        },
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    serialization_parser = subparsers.add_parser("serialization", help=bench_serialization.__doc__)
+    serialization_parser.add_argument("--turns", type=int, default=50)
+    serialization_parser.add_argument("--text-size", type=int, default=2000)
+    serialization_parser.add_argument("--iterations", type=int, default=200)
+    serialization_parser.set_defaults(func=bench_serialization)
+
+    validation_parser = subparsers.add_parser("validation", help=bench_validation.__doc__)
+    validation_parser.add_argument("--chunks", type=int, default=1000)
+    validation_parser.add_argument("--first", type=int, default=10)
+    validation_parser.add_argument("--every", type=int, default=20)
+    validation_parser.add_argument("--iterations", type=int, default=20)
+    validation_parser.set_defaults(func=bench_validation)
+
+    sse_parser = subparsers.add_parser("sse", help=bench_sse.__doc__)
+    sse_parser.add_argument("--chunks", type=int, default=1000)
+    sse_parser.add_argument("--iterations", type=int, default=50)
+    sse_parser.set_defaults(func=bench_sse)
+
+    conversion_parser = subparsers.add_parser("conversion", help=bench_conversion.__doc__)
+    conversion_parser.add_argument("--turns", type=int, default=200)
+    conversion_parser.add_argument("--text-size", type=int, default=2000)
+    conversion_parser.add_argument("--llm-calls", type=int, default=10)
+    conversion_parser.add_argument("--iterations", type=int, default=50)
+    conversion_parser.set_defaults(func=bench_conversion)
+
+    accumulate_parser = subparsers.add_parser("accumulate", help=bench_accumulate.__doc__)
+    accumulate_parser.add_argument("--chunks", type=int, default=10000)
+    accumulate_parser.add_argument("--tool-calls", type=int, default=4)
+    accumulate_parser.add_argument("--iterations", type=int, default=20)
+    accumulate_parser.set_defaults(func=bench_accumulate)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
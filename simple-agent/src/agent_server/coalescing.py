@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import json
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Optional, Sequence
+
+from agent_server.cancellation import CLIENT_DISCONNECTED, CancelToken, set_current_token
+
+
+class _Flight:
+    """One shared execution and the requests waiting on it"""
+
+    def __init__(self, token: CancelToken):
+        self.token = token
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        # Streams only: every item produced so far, and a pulse for each new one
+        self.items: list[Any] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+
+    def leave(self) -> None:
+        """Drop a waiter; the execution is cancelled once nobody is waiting for it"""
+        self.waiters -= 1
+        if self.waiters == 0 and self.task is not None and not self.task.done():
+            self.token.cancel(CLIENT_DISCONNECTED)
+            self.task.cancel()
+
+
+class RequestCoalescer:
+    """Runs identical concurrent requests once and shares the outcome with every caller.
+
+    Requests are identical when the canonical JSON of their `key_fields` (the whole request if
+    None) matches. Invoke callers all get the single result (or exception). Stream callers that
+    join late first get the chunks emitted so far, then the live ones. A request that arrives
+    after the shared execution finished starts a new one; nothing is cached.
+
+    The shared execution has its own CancelToken with the given timeout, and is cancelled only
+    once every caller has gone.
+    """
+
+    def __init__(self, key_fields: Optional[Sequence[str]] = None):
+        self.key_fields = tuple(key_fields) if key_fields is not None else None
+        self._flights: dict[str, _Flight] = {}
+        self._executions = 0
+        self._coalesced = 0
+
+    def key(self, endpoint: str, request_data: dict) -> str:
+        if self.key_fields is not None:
+            request_data = {field: request_data.get(field) for field in self.key_fields}
+        canonical = json.dumps(
+            [endpoint, request_data], sort_keys=True, separators=(",", ":"), default=str
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _join(self, key: str, timeout: Optional[float]) -> tuple[_Flight, bool]:
+        """The flight for key and whether the caller must start it"""
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self._flights[key] = _Flight(CancelToken(timeout))
+            self._executions += 1
+        else:
+            self._coalesced += 1
+        flight.waiters += 1
+        return flight, leader
+
+    def _finish(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def run(
+        self, key: str, call: Callable[[], Awaitable[Any]], timeout: Optional[float] = None
+    ) -> Any:
+        """Await call() once for all concurrent callers with the same key"""
+        flight, leader = self._join(key, timeout)
+        if leader:
+
+            async def execute():
+                set_current_token(flight.token)
+                try:
+                    return await call()
+                finally:
+                    self._finish(key, flight)
+
+            flight.task = asyncio.get_running_loop().create_task(execute())
+        try:
+            # Shielded so one caller going away doesn't cancel the others' result
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.leave()
+
+    async def stream(
+        self, key: str, start: Callable[[], AsyncIterator[Any]], timeout: Optional[float] = None
+    ) -> AsyncGenerator[Any, None]:
+        """Iterate start() once for all concurrent callers with the same key"""
+        flight, leader = self._join(key, timeout)
+        if leader:
+
+            async def produce():
+                set_current_token(flight.token)
+                items = start()
+                try:
+                    async for item in items:
+                        flight.items.append(item)
+                        flight.changed.set()
+                        flight.changed.clear()
+                except BaseException as e:
+                    flight.error = e
+                finally:
+                    aclose = getattr(items, "aclose", None)
+                    if aclose is not None:
+                        await aclose()
+                    flight.finished = True
+                    flight.changed.set()
+                    self._finish(key, flight)
+
+            flight.task = asyncio.get_running_loop().create_task(produce())
+        index = 0
+        try:
+            while True:
+                if index < len(flight.items):
+                    index += 1
+                    yield flight.items[index - 1]
+                elif flight.finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                else:
+                    await flight.changed.wait()
+        finally:
+            flight.leave()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "executions": self._executions,
+            "coalesced": self._coalesced,
+        }
@@ -0,0 +1,102 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncGenerator, Callable, Optional
+
+_EXHAUSTED = object()
+
+
+class SyncExecutor:
+    """Bounded thread pool that runs synchronous agent functions off the event loop.
+
+    Calls run in a copy of the caller's context so MLflow spans opened on the event loop stay
+    the parent of spans created inside the sync function.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.logger = logging.getLogger(__name__)
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="agent-server-sync"
+        )
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._active = 0
+        self._completed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _call(
+        self, ctx: contextvars.Context, submitted_at: float, func: Callable, args: tuple
+    ) -> Any:
+        wait = time.perf_counter() - submitted_at
+        with self._lock:
+            self._active += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+        try:
+            return ctx.run(func, *args)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._completed += 1
+
+    def _submit(self, ctx: contextvars.Context, func: Callable, *args: Any) -> Future:
+        with self._lock:
+            self._submitted += 1
+        return self._pool.submit(self._call, ctx, time.perf_counter(), func, args)
+
+    async def _run_in_context(self, ctx: contextvars.Context, func: Callable, *args: Any) -> Any:
+        return await asyncio.wrap_future(self._submit(ctx, func, *args))
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        """Run a synchronous function in the pool and await its result"""
+        return await self._run_in_context(contextvars.copy_context(), func, *args)
+
+    async def iterate(self, func: Callable, *args: Any) -> AsyncGenerator[Any, None]:
+        """Call a synchronous generator function in the pool and pull each item through it.
+
+        If the consumer stops early (e.g. the client disconnected), the generator is closed as
+        soon as the step it is running returns, so it stops at its next yield.
+        """
+        # A single context is reused for every step so context changes made inside the
+        # generator (e.g. nested spans) persist between chunks
+        ctx = contextvars.copy_context()
+        iterator = iter(await self._run_in_context(ctx, func, *args))
+        step: Optional[Future] = None
+        try:
+            while True:
+                step = self._submit(ctx, next, iterator, _EXHAUSTED)
+                chunk = await asyncio.wrap_future(step)
+                if chunk is _EXHAUSTED:
+                    return
+                yield chunk
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                if step is not None and not step.done():
+                    # A generator can't be closed while it runs; don't hold up the caller
+                    step.add_done_callback(lambda _: self._submit(ctx, close))
+                else:
+                    await self._run_in_context(ctx, close)
+
+    def stats(self) -> dict:
+        """Snapshot of pool utilization"""
+        with self._lock:
+            started = self._completed + self._active
+            return {
+                "max_workers": self.max_workers,
+                "active": self._active,
+                "queued": self._submitted - started,
+                "completed": self._completed,
+                "avg_wait_s": self._total_wait / started if started else 0.0,
+                "max_wait_s": self._max_wait,
+            }
+
+    def shutdown(self) -> None:
+        self.logger.info("Shutting down sync executor", extra=self.stats())
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,49 @@
+import json
+from typing import Any, Iterable
+
+# Keys a chat completions message may carry; anything else is dropped before calling the LLM
+CHAT_MESSAGE_KEYS = ("role", "content", "name", "tool_calls", "tool_call_id")
+
+# Empty content is not supported by claude models
+TOOL_CALL_CONTENT = "tool call"
+
+
+def responses_to_chat_messages(item: dict[str, Any]) -> list[dict[str, Any]]:
+    """Convert a Responses API item to a list of ChatCompletion messages, without mutating it"""
+    item_type = item.get("type")
+    if item_type == "function_call":
+        return [
+            {
+                "role": "assistant",
+                "content": TOOL_CALL_CONTENT,
+                "tool_calls": [
+                    {
+                        "id": item["call_id"],
+                        "type": "function",
+                        "function": {"arguments": item["arguments"], "name": item["name"]},
+                    }
+                ],
+            }
+        ]
+    elif item_type == "message" and isinstance(item.get("content"), list):
+        return [{"role": item["role"], "content": content["text"]} for content in item["content"]]
+    elif item_type == "reasoning":
+        return [{"role": "assistant", "content": json.dumps(item["summary"])}]
+    elif item_type == "function_call_output":
+        return [{"role": "tool", "content": item["output"], "tool_call_id": item["call_id"]}]
+    filtered = {key: item[key] for key in CHAT_MESSAGE_KEYS if key in item}
+    if not filtered.get("content") and filtered.get("tool_calls"):
+        filtered["content"] = TOOL_CALL_CONTENT
+    return [filtered] if filtered else []
+
+
+def to_chat_messages(items: Iterable[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Convert Responses API items to ChatCompletion messages.
+
+    Run this once per request on its input: messages the agent adds afterwards are already in
+    chat completions format and can be appended as-is.
+    """
+    messages = []
+    for item in items:
+        messages.extend(responses_to_chat_messages(item))
+    return messages
@@ -0,0 +1,207 @@
+"""Prometheus-style metrics for the agent server, rendered in the text exposition format."""
+
+import bisect
+import threading
+from typing import Callable, Iterable, Sequence
+
+# Latency buckets in seconds, from sub-millisecond overheads up to long agent runs
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+)  # fmt: skip
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield from super().render()
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: [per-bucket counts (last one is +Inf), sum, count]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> Iterable[str]:
+        yield from super().render()
+        with self._lock:
+            values = [
+                (key, list(counts), total, count)
+                for key, (counts, total, count) in self._values.items()
+            ]
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                labels = _format_labels(self.labelnames, key, f'le="{le}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class ServerMetrics:
+    """All metrics exported by AgentServer on /metrics.
+
+    Latencies are in seconds. Collectors run before rendering so gauges that mirror other
+    components (executor, trace exporter) are read at scrape time.
+    """
+
+    def __init__(self, prefix: str = "agent_server"):
+        self.requests = Counter(
+            f"{prefix}_requests_total", "Requests to /invocations.", ("endpoint", "status")
+        )
+        self.in_flight = Gauge(
+            f"{prefix}_requests_in_flight", "Requests currently being handled.", ("endpoint",)
+        )
+        self.request_latency = Histogram(
+            f"{prefix}_request_duration_seconds",
+            "End-to-end request latency, until the last byte for streams.",
+            ("endpoint",),
+        )
+        self.time_to_first_chunk = Histogram(
+            f"{prefix}_stream_time_to_first_chunk_seconds",
+            "Time from request receipt to the first streamed chunk.",
+        )
+        self.inter_chunk_latency = Histogram(
+            f"{prefix}_stream_inter_chunk_seconds", "Time between consecutive streamed chunks."
+        )
+        self.validation_latency = Histogram(
+            f"{prefix}_validation_seconds",
+            "Time spent validating requests, responses and stream chunks.",
+            ("kind",),
+        )
+        self.serialization_latency = Histogram(
+            f"{prefix}_serialization_seconds",
+            "Time spent encoding response bodies and SSE frames.",
+            ("endpoint",),
+        )
+        self.trace_export_latency = Histogram(
+            f"{prefix}_trace_export_seconds", "Time spent finalizing and exporting request spans."
+        )
+        self.sync_executor = Gauge(
+            f"{prefix}_sync_executor", "Sync executor utilization by state.", ("state",)
+        )
+        self.trace_exporter = Gauge(
+            f"{prefix}_trace_exporter", "Trace exporter queue depth and totals.", ("stat",)
+        )
+        self.admission_wait = Histogram(
+            f"{prefix}_admission_wait_seconds",
+            "Time admitted requests spent queued for capacity.",
+            ("endpoint",),
+        )
+        self.admission = Gauge(
+            f"{prefix}_admission", "Admission controller state and totals.", ("endpoint", "stat")
+        )
+        self.tool_cache = Gauge(
+            f"{prefix}_tool_cache", "Tool result cache size and hit/miss totals.", ("tool", "stat")
+        )
+        self.coalescing = Gauge(
+            f"{prefix}_coalescing",
+            "Shared executions of identical concurrent requests and requests that joined one.",
+            ("stat",),
+        )
+        self.completion_cache = Gauge(
+            f"{prefix}_completion_cache",
+            "LLM completion cache size, hit/miss totals and hit ratio.",
+            ("cache", "stat"),
+        )
+        self._registry: list[_Metric] = [
+            value for value in vars(self).values() if isinstance(value, _Metric)
+        ]
+        self._collectors: list[Callable[[], None]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Add a metric defined by another component to the exposition"""
+        self._registry.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """Call collector before each render, e.g. to refresh gauges"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._registry:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,38 @@
+"""JSON encoding for the /invocations hot path. Uses orjson when it is installed."""
+
+import json
+from typing import Any
+
+from fastapi.encoders import jsonable_encoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the optional "fast" extra
+    orjson = None
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(data: bytes) -> Any:
+    """Parse a JSON document from raw request bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _default(obj: Any) -> Any:
+    """Encode values JSON has no type for (datetime, UUID, Decimal, pydantic models, ...) the
+    way FastAPI encodes responses"""
+    try:
+        return jsonable_encoder(obj)
+    except ValueError as e:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable") from e
+
+
+def dumps(obj: Any) -> bytes:
+    """Serialize obj to compact UTF-8 JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(
+        obj, ensure_ascii=False, separators=(",", ":"), default=_default
+    ).encode("utf-8")
@@ -0,0 +1,206 @@
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from agent_server import serialization
+
+# Key in `custom_inputs` that names the conversation a request continues
+SESSION_ID_KEY = "session_id"
+
+
+@dataclass
+class SessionTurn:
+    """One request on a session: the request as sent, carrying only the new input items"""
+
+    session_id: str
+    request: dict
+
+    @property
+    def new_items(self) -> list[dict]:
+        return self.request.get("input") or []
+
+
+class SessionStore(ABC):
+    """Conversation history by session id, as Responses API items.
+
+    Turns of one session are expected to be sequential; concurrent requests on the same session
+    each see the history as of when they started. Set `blocking` on stores that do I/O so the
+    server calls them from its thread pool.
+    """
+
+    blocking = False
+
+    @abstractmethod
+    def load(self, session_id: str) -> list[dict]:
+        """The stored history, or an empty list for unknown or expired sessions"""
+
+    @abstractmethod
+    def append(self, session_id: str, items: list[dict]) -> None: ...
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None: ...
+
+
+class InMemorySessionStore(SessionStore):
+    """Per-process store keeping the `max_sessions` most recently used sessions.
+
+    Sessions idle for more than `ttl` seconds expire (never if None).
+    """
+
+    def __init__(self, max_sessions: int = 10000, ttl: Optional[float] = 3600.0):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, updated_at: float) -> bool:
+        return self.ttl is not None and time.monotonic() - updated_at > self.ttl
+
+    def load(self, session_id: str) -> list[dict]:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return []
+            if self._expired(entry[0]):
+                del self._sessions[session_id]
+                return []
+            self._sessions.move_to_end(session_id)
+            return list(entry[1])
+
+    def append(self, session_id: str, items: list[dict]) -> None:
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            history = [] if entry is None or self._expired(entry[0]) else entry[1]
+            history.extend(items)
+            self._sessions[session_id] = (time.monotonic(), history)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class SqliteSessionStore(SessionStore):
+    """Single-node store in a SQLite file, so sessions survive restarts and are shared by workers.
+
+    Each item is a row, so appending a turn writes only the new items. Sessions idle for more
+    than `ttl` seconds expire and are purged every `purge_every` appends.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, ttl: Optional[float] = 7 * 24 * 3600.0, purge_every: int = 1000):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._appends = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS session_items (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                item BLOB NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+            """
+        )
+
+    def _cutoff(self) -> float:
+        return time.time() - self.ttl if self.ttl is not None else float("-inf")
+
+    def load(self, session_id: str) -> list[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT updated_at FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None or row[0] < self._cutoff():
+                return []
+            rows = self._conn.execute(
+                "SELECT item FROM session_items WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+        return [serialization.loads(item) for (item,) in rows]
+
+    def append(self, session_id: str, items: list[dict]) -> None:
+        encoded = [serialization.dumps(item) for item in items]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT updated_at FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                if row is not None and row[0] < self._cutoff():
+                    self._delete(session_id)
+                    row = None
+                start = 0
+                if row is not None:
+                    start = self._conn.execute(
+                        "SELECT COALESCE(MAX(seq) + 1, 0) FROM session_items WHERE session_id = ?",
+                        (session_id,),
+                    ).fetchone()[0]
+                self._conn.executemany(
+                    "INSERT INTO session_items (session_id, seq, item) VALUES (?, ?, ?)",
+                    [(session_id, start + i, item) for i, item in enumerate(encoded)],
+                )
+                self._conn.execute(
+                    "INSERT INTO sessions (session_id, updated_at) VALUES (?, ?) "
+                    "ON CONFLICT (session_id) DO UPDATE SET updated_at = excluded.updated_at",
+                    (session_id, time.time()),
+                )
+                self._appends += 1
+                if self.ttl is not None and self._appends % self.purge_every == 0:
+                    self._purge()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _delete(self, session_id: str) -> None:
+        self._conn.execute("DELETE FROM session_items WHERE session_id = ?", (session_id,))
+        self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def _purge(self) -> None:
+        cutoff = self._cutoff()
+        self._conn.execute(
+            "DELETE FROM session_items WHERE session_id IN "
+            "(SELECT session_id FROM sessions WHERE updated_at < ?)",
+            (cutoff,),
+        )
+        self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (cutoff,))
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._delete(session_id)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def session_turn(request_data: dict) -> Optional[SessionTurn]:
+    """The SessionTurn for a request that names a session in its custom_inputs"""
+    custom_inputs = request_data.get("custom_inputs")
+    if not isinstance(custom_inputs, dict):
+        return None
+    session_id = custom_inputs.get(SESSION_ID_KEY)
+    if not session_id:
+        return None
+    return SessionTurn(str(session_id), request_data)
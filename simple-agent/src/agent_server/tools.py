@@ -0,0 +1,287 @@
+import asyncio
+import contextvars
+import inspect
+import json
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, AsyncGenerator, Awaitable, Callable, Generator, Optional, Sequence
+
+from agent_server.cancellation import CancelToken, current_token
+
+# Every ToolResultCache in the process, so the server can export their stats
+_CACHES: "weakref.WeakSet[ToolResultCache]" = weakref.WeakSet()
+# Result handed to the waiters of an interrupted execution, telling them to look the key up again
+_RETRY = object()
+
+
+class ToolTimeoutError(TimeoutError):
+    """A tool call ran past its timeout"""
+
+    def __init__(self, timeout: float):
+        super().__init__(f"Tool call timed out after {timeout}s")
+        self.timeout = timeout
+
+
+class ToolRunner:
+    """Runs the independent tool calls of one agent turn concurrently.
+
+    Calls are started one at a time as they become known with start() (or astart()) and
+    collected with results() (or aresults()), which yield `(index, result)` pairs in completion
+    order, so callers can stream each tool output as soon as it is ready and still record
+    results in call order. Every call runs in its own copy of the caller's context, so MLflow
+    tool spans stay children of the request span. If a call raises, the exception propagates
+    and the other calls are cancelled. Calls started with a `timeout` raise ToolTimeoutError
+    once it passes. While collecting results, the current request's CancelToken is honored:
+    waiting stops and pending calls are cancelled as soon as the request is abandoned. Threads
+    that are already running a call can't be interrupted; their results are discarded.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="agent-server-tools"
+        )
+        # (deadline, timeout) of calls started with a timeout
+        self._deadlines: "weakref.WeakKeyDictionary[Future, tuple[float, float]]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def start(self, call: Callable[[], Any], timeout: Optional[float] = None) -> Future:
+        """Start a zero-argument callable on the pool"""
+        future = self._pool.submit(contextvars.copy_context().run, call)
+        if timeout is not None:
+            self._deadlines[future] = (time.monotonic() + timeout, timeout)
+        return future
+
+    def _wait_timeout(self, pending: set[Future], token: Optional[CancelToken]) -> Optional[float]:
+        deadlines = [self._deadlines[future][0] for future in pending if future in self._deadlines]
+        if token is not None and token.deadline is not None:
+            deadlines.append(token.deadline)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def _raise_if_expired(self, pending: set[Future]) -> None:
+        now = time.monotonic()
+        for future in pending:
+            entry = self._deadlines.get(future)
+            if entry is not None and entry[0] <= now:
+                raise ToolTimeoutError(entry[1])
+
+    def results(self, futures: Sequence[Future]) -> Generator[tuple[int, Any], None, None]:
+        """Yield `(index, result)` for started calls as each finishes"""
+        indexes = {future: index for index, future in enumerate(futures)}
+        token = current_token()
+        # Resolved when the request is cancelled, to wake up the wait below
+        cancelled: Future = Future()
+
+        def on_cancel():
+            cancelled.set_result(None)
+
+        if token is not None:
+            token.add_callback(on_cancel)
+        try:
+            pending = set(futures)
+            while pending:
+                done, _ = wait(
+                    pending | {cancelled},
+                    timeout=self._wait_timeout(pending, token),
+                    return_when=FIRST_COMPLETED,
+                )
+                if token is not None:
+                    token.raise_if_cancelled()
+                for future in done:
+                    pending.discard(future)
+                    yield indexes[future], future.result()
+                self._raise_if_expired(pending)
+        finally:
+            if token is not None:
+                token.remove_callback(on_cancel)
+            for future in futures:
+                future.cancel()
+
+    async def _acall(self, call: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        timer = asyncio.timeout(timeout)
+        try:
+            async with timer:
+                if inspect.iscoroutinefunction(call):
+                    return await call()
+                result = await asyncio.wrap_future(self.start(call))
+                if inspect.isawaitable(result):
+                    result = await result
+                return result
+        except TimeoutError:
+            if not timer.expired():
+                raise
+            raise ToolTimeoutError(timeout) from None
+
+    def astart(self, call: Callable[[], Any], timeout: Optional[float] = None) -> asyncio.Task:
+        """Start a call as a task on the running event loop; synchronous callables use the pool"""
+        return asyncio.get_running_loop().create_task(self._acall(call, timeout))
+
+    async def aresults(
+        self, tasks: Sequence[asyncio.Task]
+    ) -> AsyncGenerator[tuple[int, Any], None]:
+        """Yield `(index, result)` for started tasks as each finishes"""
+        indexes = {task: index for index, task in enumerate(tasks)}
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield indexes[task], task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ToolResultCache:
+    """Result cache for one deterministic tool, keyed on its canonicalized arguments.
+
+    Entries expire after `ttl` seconds (never if None) and the least recently used entry is
+    evicted beyond `max_entries`. Concurrent calls with the same arguments share a single
+    execution. Errors are never cached. If the executing call is interrupted (cancelled, or a
+    KeyboardInterrupt) instead of failing, the calls waiting on it run the tool themselves.
+    """
+
+    def __init__(self, tool_name: str, max_entries: int = 256, ttl: Optional[float] = 300.0):
+        self.tool_name = tool_name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._in_flight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+        _CACHES.add(self)
+
+    @staticmethod
+    def key(args: dict) -> str:
+        return json.dumps(args, sort_keys=True, separators=(",", ":"), default=str)
+
+    def _lookup(self, key: str) -> tuple[bool, Any, Optional[Future], bool]:
+        """Returns (hit, value, future, leader); the leader must compute and publish the value"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return True, value, None, False
+                del self._entries[key]
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._coalesced += 1
+                return False, None, future, False
+            self._misses += 1
+            future = self._in_flight[key] = Future()
+            return False, None, future, True
+
+    def _publish(
+        self, key: str, future: Future, value: Any = None, error: Optional[Exception] = None
+    ) -> None:
+        with self._lock:
+            del self._in_flight[key]
+            if error is None:
+                expires_at = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+                self._entries[key] = (expires_at, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._evictions += 1
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def _abandon(self, key: str, future: Future) -> None:
+        """Drop an interrupted execution; its waiters look the key up again"""
+        with self._lock:
+            del self._in_flight[key]
+        future.set_result(_RETRY)
+
+    def get_or_call(self, args: dict, call: Callable[[], Any]) -> Any:
+        """Return the cached result for args, or run call() once and cache its result"""
+        key = self.key(args)
+        while True:
+            hit, value, future, leader = self._lookup(key)
+            if hit:
+                return value
+            if leader:
+                break
+            value = future.result()
+            if value is not _RETRY:
+                return value
+        try:
+            value = call()
+        except Exception as e:
+            self._publish(key, future, error=e)
+            raise
+        except BaseException:
+            self._abandon(key, future)
+            raise
+        self._publish(key, future, value)
+        return value
+
+    async def aget_or_call(self, args: dict, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Async get_or_call(); waiting for another caller's execution doesn't block the loop"""
+        key = self.key(args)
+        while True:
+            hit, value, future, leader = self._lookup(key)
+            if hit:
+                return value
+            if leader:
+                break
+            # Shielded so a waiter being cancelled doesn't cancel the shared execution
+            value = await asyncio.shield(asyncio.wrap_future(future))
+            if value is not _RETRY:
+                return value
+        try:
+            value = await call()
+        except Exception as e:
+            self._publish(key, future, error=e)
+            raise
+        except BaseException:
+            self._abandon(key, future)
+            raise
+        self._publish(key, future, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "coalesced": self._coalesced,
+                "evictions": self._evictions,
+            }
+
+
+def tool_cache_stats() -> dict[str, dict]:
+    """Stats of every live ToolResultCache, summed by tool name: several agents (or agent
+    instances) can each cache a tool of the same name"""
+    totals: dict[str, dict] = {}
+    for cache in list(_CACHES):
+        stats = cache.stats()
+        if (total := totals.get(cache.tool_name)) is None:
+            totals[cache.tool_name] = stats
+        else:
+            for stat, value in stats.items():
+                total[stat] += value
+    return totals